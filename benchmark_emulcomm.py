@@ -0,0 +1,583 @@
+"""
+This script runs benchmarks against the emulcomm network layer, to
+catch performance regressions. The network benchmarks only use loopback,
+and go through the namespace-wrapped API that sandboxed programs see, so
+argument checking and nanny accounting are included in the timings. It
+must be run from a directory that contains the Repy runtime, e.g. one
+prepared with preparetest.py.
+
+Unless a restrictions file is given, a generous one is written to a
+temporary file and the resource nanny is started with it, so that the
+benchmarks are not throttled.
+
+<Usage>
+  benchmark_emulcomm.py [options]
+
+    -n or --iterations sets how many times each small operation is timed
+    -p or --port sets the first of the local ports used
+    -r or --restrictions starts the nanny with the given restrictions file.
+       It must allow the ports used and enough sockets.
+    -s or --sockets sets how many concurrent connections are opened
+    -j or --json writes the results as JSON to a file, or - for stdout
+    -b or --baseline compares the results against an earlier JSON file
+    -t or --threshold sets the percentage change that is a regression
+    -o or --only runs only the named benchmarks, separated by commas
+
+  The exit status is 1 if a regression against the baseline was found.
+
+<Example>
+    user@vm:dist$ python preparetest.py /tmp/test
+    user@vm:dist$ cd /tmp/test
+    user@vm:test$ python benchmark_emulcomm.py -j baseline.json
+    (make changes)
+    user@vm:test$ python benchmark_emulcomm.py -b baseline.json
+
+"""
+
+import os
+import sys
+import time
+import json
+import tempfile
+import threading
+import optparse
+
+import emulcomm
+import namespace
+import nanny
+
+from exception_hierarchy import *
+
+
+
+# The addresses used by the address validation benchmarks. These are the
+# kinds of strings that sandboxed programs send to over and over.
+BENCHMARK_ADDRESSES = ["127.0.0.1", "192.168.1.20", "10.0.0.1", "128.208.4.15"]
+
+# The address the network benchmarks use
+LOOPBACK_IP = "127.0.0.1"
+
+# How many client ports the connection setup benchmark cycles through
+CONNECT_PORT_COUNT = 50
+
+# For each unit, whether a bigger result is better
+HIGHER_IS_BETTER = {"us" : False, "conn/s" : True, "msg/s" : True, "MB/s" : True}
+
+# The resources every restrictions file must assign, and the generous
+# values used when we write our own
+BENCHMARK_RESOURCES = {"cpu" : 1.0, "memory" : 2000000000, "diskused" : 100000000,
+                       "events" : 1000, "filewrite" : 100000000, "fileread" : 100000000,
+                       "filesopened" : 100, "insockets" : 10000, "outsockets" : 10000,
+                       "netsend" : 1000000000, "netrecv" : 1000000000,
+                       "loopsend" : 100000000000, "looprecv" : 100000000000,
+                       "lograte" : 1000000, "random" : 1000000}
+
+
+
+def time_per_call(func, iterations):
+  """
+  Returns the average time, in seconds, of calling func() iterations times.
+  """
+  starttime = time.time()
+  for count in xrange(iterations):
+    func()
+  return (time.time() - starttime) / iterations
+
+
+
+def write_restrictions_file(firstport, portcount):
+  """
+  Writes a restrictions file with generous limits that allows portcount
+  ports from firstport, and returns its name.
+  """
+  (fd, filename) = tempfile.mkstemp(prefix="benchmark_emulcomm", suffix=".restrictions")
+  restrictionsfile = os.fdopen(fd, "w")
+  try:
+    for resource in sorted(BENCHMARK_RESOURCES):
+      restrictionsfile.write("resource %s %s\n" % (resource, BENCHMARK_RESOURCES[resource]))
+    for port in xrange(firstport, firstport + portcount):
+      restrictionsfile.write("resource connport %d\n" % port)
+      restrictionsfile.write("resource messport %d\n" % port)
+  finally:
+    restrictionsfile.close()
+  return filename
+
+
+
+def raise_file_limit(needed):
+  """
+  Tries to raise the limit on open files to needed, and returns the
+  limit, or None if it is not known.
+  """
+  try:
+    import resource
+  except ImportError:
+    return None
+
+  (soft, hard) = resource.getrlimit(resource.RLIMIT_NOFILE)
+  if soft < needed and (hard == resource.RLIM_INFINITY or soft < hard):
+    if hard == resource.RLIM_INFINITY:
+      soft = needed
+    else:
+      soft = min(needed, hard)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+  return soft
+
+
+
+class BenchmarkContext:
+  """
+  The wrapped API and settings shared by the network benchmarks.
+  """
+  def __init__(self, api, options):
+    self.api = api
+    self.options = options
+    self.port = options.port
+
+
+  def allocate_ports(self, count):
+    """
+    Returns the first of count ports that no other benchmark uses.
+    """
+    firstport = self.port
+    self.port += count
+    return firstport
+
+
+  def wait_for_connection(self, server):
+    # Waits for a connection on a wrapped TCPServerSocket and returns it
+    while True:
+      self.api["waitforsocket"](server, "r", 1.0)
+      try:
+        return server.getconnection()[2]
+      except SocketWouldBlockError:
+        pass
+
+
+  def connect_pair(self, server, serverport, clientport):
+    # Returns a connected (client, server side) pair of wrapped sockets
+    client = self.api["openconnection"](LOOPBACK_IP, serverport, LOOPBACK_IP, clientport, 5.0)
+    return (client, self.wait_for_connection(server))
+
+
+  def recvexactly(self, sock, count):
+    # Blocks until count bytes have been read from a wrapped socket
+    while True:
+      self.api["waitforsocket"](sock, "r", 1.0)
+      try:
+        return sock.recvexactly(count)
+      except SocketWouldBlockError:
+        pass
+
+
+
+def bench_address_validation(context):
+  """
+  Compares validating and classifying an IP address string from scratch,
+  as every send / connect used to, against the cached _get_address_info().
+  """
+  iterations = context.options.iterations
+
+  def uncached():
+    for ipaddr in BENCHMARK_ADDRESSES:
+      emulcomm._check_ip_address(ipaddr)
+      emulcomm._check_loopback_ipaddr(ipaddr)
+
+  def cached():
+    for ipaddr in BENCHMARK_ADDRESSES:
+      emulcomm._get_address_info(ipaddr)
+
+  calls = len(BENCHMARK_ADDRESSES)
+  return [("address_validation_uncached", time_per_call(uncached, iterations) / calls * 1000000, "us"),
+          ("address_validation_cached", time_per_call(cached, iterations) / calls * 1000000, "us")]
+
+
+
+def bench_connection_setup(context):
+  """
+  Measures how fast connections can be opened, accepted and closed.
+  The server side closes first, so the client ports do not linger in
+  TIME_WAIT and can be cycled through.
+  """
+  api = context.api
+  serverport = context.allocate_ports(1)
+  firstclientport = context.allocate_ports(CONNECT_PORT_COUNT)
+  connections = min(context.options.iterations, 2000)
+
+  server = api["listenforconnection"](LOOPBACK_IP, serverport)
+  try:
+    starttime = time.time()
+    for count in xrange(connections):
+      (client, serverside) = context.connect_pair(server, serverport,
+                                                  firstclientport + count % CONNECT_PORT_COUNT)
+      serverside.close()
+      client.close()
+    elapsed = time.time() - starttime
+  finally:
+    server.close()
+
+  return [("connection_setup_rate", connections / elapsed, "conn/s")]
+
+
+
+def bench_round_trip(context):
+  """
+  Measures the latency of bouncing a small message over a connection.
+  """
+  api = context.api
+  serverport = context.allocate_ports(1)
+  clientport = context.allocate_ports(1)
+  message = "x" * 64
+  round_trips = min(context.options.iterations, 20000)
+
+  server = api["listenforconnection"](LOOPBACK_IP, serverport)
+  try:
+    (client, serverside) = context.connect_pair(server, serverport, clientport)
+    try:
+      starttime = time.time()
+      for count in xrange(round_trips):
+        client.sendall(message)
+        serverside.sendall(context.recvexactly(serverside, len(message)))
+        context.recvexactly(client, len(message))
+      elapsed = time.time() - starttime
+    finally:
+      client.close()
+      serverside.close()
+  finally:
+    server.close()
+
+  return [("round_trip_latency", elapsed / round_trips * 1000000, "us")]
+
+
+
+def bench_wrapped_send_recv(context):
+  """
+  Measures a one byte send() and recv() on a connection, through the
+  wrapped API and directly on the underlying sockets. The difference is
+  what the namespace layer costs on the calls sandboxed programs make
+  most.
+  """
+  api = context.api
+  serverport = context.allocate_ports(1)
+  clientport = context.allocate_ports(1)
+  iterations = context.options.iterations
+
+  server = api["listenforconnection"](LOOPBACK_IP, serverport)
+  try:
+    (client, serverside) = context.connect_pair(server, serverport, clientport)
+    try:
+      def wrapped():
+        client.send("x")
+        serverside.recv(1)
+
+      rawclient = client._wrapped__object
+      rawserverside = serverside._wrapped__object
+
+      def direct():
+        rawclient.send("x")
+        rawserverside.recv(1)
+
+      wrapped_time = time_per_call(wrapped, iterations)
+      direct_time = time_per_call(direct, iterations)
+    finally:
+      client.close()
+      serverside.close()
+  finally:
+    server.close()
+
+  return [("wrapped_send_recv", wrapped_time * 1000000, "us"),
+          ("direct_send_recv", direct_time * 1000000, "us"),
+          ("namespace_send_recv_overhead", (wrapped_time - direct_time) * 1000000, "us")]
+
+
+
+def bench_namespace_copy(context):
+  """
+  Measures how long the namespace layer takes to copy large return values,
+  one nested and one flat, each with 100000 items.
+  """
+  copies = max(1, min(context.options.iterations / 1000, 20))
+
+  nested = {}
+  for index in xrange(10000):
+    nested["key" + str(index)] = [index, str(index), (index, float(index)), {"value": index}]
+  flat = dict((index, str(index)) for index in xrange(100000))
+
+  return [("namespace_copy_nested", time_per_call(lambda: namespace._copy(nested), copies) * 1000000, "us"),
+          ("namespace_copy_flat", time_per_call(lambda: namespace._copy(flat), copies) * 1000000, "us")]
+
+
+
+def bench_bulk_throughput(context):
+  """
+  Measures how fast data can be pushed over a single connection, with
+  the receiver in its own thread.
+  """
+  api = context.api
+  serverport = context.allocate_ports(1)
+  clientport = context.allocate_ports(1)
+  chunk = "x" * 65536
+  totalbytes = context.options.bulk_mb * 1024 * 1024
+
+  server = api["listenforconnection"](LOOPBACK_IP, serverport)
+  try:
+    (client, serverside) = context.connect_pair(server, serverport, clientport)
+    received = [0]
+
+    def receiver():
+      while received[0] < totalbytes:
+        api["waitforsocket"](serverside, "r", 1.0)
+        try:
+          received[0] += len(serverside.recv(1024 * 1024))
+        except SocketWouldBlockError:
+          pass
+
+    receiverthread = threading.Thread(target=receiver)
+    starttime = time.time()
+    receiverthread.start()
+    try:
+      sent = 0
+      while sent < totalbytes:
+        sent += client.sendall(chunk)
+      receiverthread.join()
+      elapsed = time.time() - starttime
+    finally:
+      client.close()
+      serverside.close()
+  finally:
+    server.close()
+
+  return [("bulk_throughput", totalbytes / elapsed / (1024 * 1024), "MB/s")]
+
+
+
+def bench_udp_messages(context):
+  """
+  Measures how many small UDP messages per second can be sent with
+  sendmessage() and received with getmessage(). Messages are sent in
+  small bursts, so the socket buffer does not overflow.
+  """
+  api = context.api
+  serverport = context.allocate_ports(1)
+  clientport = context.allocate_ports(1)
+  message = "x" * 64
+  burst = 32
+  messages = context.options.iterations - context.options.iterations % burst
+
+  server = api["listenformessage"](LOOPBACK_IP, serverport)
+  try:
+    received = 0
+    starttime = time.time()
+    for count in xrange(messages / burst):
+      for index in xrange(burst):
+        api["sendmessage"](LOOPBACK_IP, serverport, message, LOOPBACK_IP, clientport)
+      pending = burst
+      while pending:
+        try:
+          server.getmessage()
+          pending -= 1
+          received += 1
+        except SocketWouldBlockError:
+          # Anything not here by now was dropped
+          if not api["waitforsocket"](server, "r", 0.1):
+            break
+    elapsed = time.time() - starttime
+  finally:
+    server.close()
+
+  return [("udp_message_rate", received / elapsed, "msg/s"),
+          ("udp_messages_lost", 100.0 * (messages - received) / messages, "%")]
+
+
+
+def bench_many_sockets(context):
+  """
+  Opens many concurrent connections, then measures how long it takes to
+  deliver one message on each of them with sendall() and waitforsockets().
+  The messages are sent and received by a new thread, whose own file
+  descriptors are then above those of the sockets. With the default number
+  of sockets, that is past FD_SETSIZE, which select() can't handle.
+  """
+  api = context.api
+  sockets = context.options.sockets
+  serverport = context.allocate_ports(1)
+  firstclientport = context.allocate_ports(sockets)
+
+  # Each connection uses two file descriptors
+  limit = raise_file_limit(2 * sockets + 64)
+  if limit is not None and limit < 2 * sockets + 64:
+    sockets = (limit - 64) / 2
+
+  server = api["listenforconnection"](LOOPBACK_IP, serverport)
+  clients = []
+  serversides = []
+  try:
+    starttime = time.time()
+    for index in xrange(sockets):
+      (client, serverside) = context.connect_pair(server, serverport, firstclientport + index)
+      clients.append(client)
+      serversides.append(serverside)
+    setup_elapsed = time.time() - starttime
+
+    def sweep():
+      for client in clients:
+        client.sendall("x")
+
+      pending = set(xrange(sockets))
+      while pending:
+        waitlist = sorted(pending)
+        readylist = api["waitforsockets"]([serversides[index] for index in waitlist], "r", 1.0)
+        for position in readylist:
+          index = waitlist[position]
+          serversides[index].recv(1)
+          pending.discard(index)
+
+      # One more message, received through waitforsocket()
+      clients[-1].sendall("x")
+      context.recvexactly(serversides[-1], 1)
+
+    errors = []
+    def sweep_thread():
+      try:
+        sweep()
+      except Exception, e:
+        errors.append(e)
+
+    starttime = time.time()
+    sweeper = threading.Thread(target=sweep_thread, name="ManySocketsSweep")
+    sweeper.start()
+    sweeper.join()
+    sweep_elapsed = time.time() - starttime
+
+    if errors:
+      raise errors[0]
+
+  finally:
+    for sock in clients + serversides:
+      sock.close()
+    server.close()
+
+  return [("many_sockets_count", sockets, "sockets"),
+          ("many_sockets_setup_rate", sockets / setup_elapsed, "conn/s"),
+          ("many_sockets_message_latency", sweep_elapsed / sockets * 1000000, "us")]
+
+
+
+# The benchmarks that are run, in order
+BENCHMARKS = [bench_address_validation, bench_connection_setup, bench_round_trip,
+              bench_wrapped_send_recv, bench_namespace_copy, bench_bulk_throughput,
+              bench_udp_messages, bench_many_sockets]
+
+
+
+def compare_to_baseline(results, baseline, threshold):
+  """
+  Prints how each result changed from the baseline, and returns the
+  names of the results that got worse by more than threshold percent.
+  """
+  regressions = []
+  for name in sorted(results):
+    if name not in baseline:
+      continue
+    value = results[name]["value"]
+    basevalue = baseline[name]["value"]
+    unit = results[name]["unit"]
+    if unit not in HIGHER_IS_BETTER or not basevalue:
+      continue
+
+    change = 100.0 * (value - basevalue) / basevalue
+    if HIGHER_IS_BETTER[unit]:
+      worse = -change
+    else:
+      worse = change
+
+    if worse > threshold:
+      verdict = "REGRESSION"
+      regressions.append(name)
+    elif worse < -threshold:
+      verdict = "improved"
+    else:
+      verdict = ""
+    print "%-32s %12.3f -> %12.3f %-8s %+7.1f%% %s" % (name, basevalue, value, unit, change, verdict)
+
+  return regressions
+
+
+
+def main():
+  parser = optparse.OptionParser(usage="%prog [options]")
+  parser.add_option("-n", "--iterations", dest="iterations", type="int",
+                    default=10000, help="how many times each small operation is timed")
+  parser.add_option("-p", "--port", dest="port", type="int",
+                    default=12345, help="the first local port to use")
+  parser.add_option("-r", "--restrictions", dest="restrictions",
+                    help="start the nanny with this restrictions file")
+  parser.add_option("-s", "--sockets", dest="sockets", type="int",
+                    default=1000, help="how many concurrent connections to open")
+  parser.add_option("--bulk-mb", dest="bulk_mb", type="int",
+                    default=64, help="how many megabytes to send for the throughput test")
+  parser.add_option("-j", "--json", dest="json",
+                    help="write the results as JSON to this file, or - for stdout")
+  parser.add_option("-b", "--baseline", dest="baseline",
+                    help="compare the results against this JSON file")
+  parser.add_option("-t", "--threshold", dest="threshold", type="float",
+                    default=10.0, help="the percentage change that is a regression")
+  parser.add_option("-o", "--only", dest="only",
+                    help="only run these benchmarks, separated by commas")
+  (options, args) = parser.parse_args()
+
+  # Start the nanny, so that resources are accounted for as usual
+  restrictions = options.restrictions
+  if restrictions is None:
+    restrictions = write_restrictions_file(options.port, options.sockets + CONNECT_PORT_COUNT + 16)
+  try:
+    nanny.start_resource_nanny(restrictions)
+  finally:
+    if options.restrictions is None:
+      os.remove(restrictions)
+
+  # Get the API as sandboxed programs see it
+  api = {}
+  namespace.wrap_and_insert_api_functions(api)
+  context = BenchmarkContext(api, options)
+
+  benchmarks = BENCHMARKS
+  if options.only:
+    names = options.only.split(",")
+    benchmarks = [benchmark for benchmark in BENCHMARKS
+                  if benchmark.__name__[len("bench_"):] in names]
+
+  results = {}
+  for benchmark in benchmarks:
+    for (name, value, unit) in benchmark(context):
+      results[name] = {"value" : value, "unit" : unit}
+      if options.json != "-":
+        print "%-32s %12.3f %s" % (name, value, unit)
+
+  if options.json == "-":
+    print json.dumps(results, indent=2, sort_keys=True)
+  elif options.json:
+    jsonfile = open(options.json, "w")
+    try:
+      json.dump(results, jsonfile, indent=2, sort_keys=True)
+    finally:
+      jsonfile.close()
+
+  if options.baseline:
+    baselinefile = open(options.baseline)
+    try:
+      baseline = json.load(baselinefile)
+    finally:
+      baselinefile.close()
+
+    print
+    regressions = compare_to_baseline(results, baseline, options.threshold)
+    if regressions:
+      print
+      print "Regressions: " + ", ".join(regressions)
+      sys.exit(1)
+
+
+
+if __name__ == '__main__':
+  main()
@@ -45,9 +45,24 @@ import idhelper
 # for sleep
 import time 
 
+# Used for the wake pipes of the readiness engine
+import os
+
 # Armon: Used for decoding the error messages
 import errno
 
+# Used for the validated address cache
+import collections
+
+# Used to build and parse sock_diag netlink messages
+import struct
+
+# Used to find sockets that are dropped without being closed
+import weakref
+
+# Used to hand names to the resolver threads
+import Queue
+
 # Armon: Used for getting the constant IP values for resolving our external IP
 import repy_constants 
 
@@ -84,6 +99,41 @@ user_specified_ip_interface_list = []
 allowediplist = []
 cachelock = threading.Lock()  # This allows only a single simultaneous cache update
 
+# A frozenset of the IP's in allowediplist, for fast membership tests
+allowedipset = frozenset()
+
+# How long the allowed IP cache is used before it is rebuilt, in seconds.
+# On Linux the cache is also invalidated as soon as the kernel reports an
+# address or link change.
+IP_CACHE_TTL = 5.0
+
+# The runtime at which the allowed IP cache was last rebuilt. This is None
+# if the cache has never been built, or has been invalidated.
+_ip_cache_updated_at = None
+
+# This is incremented whenever the cache is invalidated, so that a rebuild
+# which raced with an invalidation does not mark the cache as fresh.
+_ip_cache_generation = 0
+
+# Whether we have tried to start the address change watcher thread
+_address_watcher_started = False
+
+# The maximum number of IP address strings whose validation is cached
+ADDRESS_CACHE_SIZE = 1024
+
+# This caches the validation of IP address strings.
+# Key - The IP address string
+# Val - A (is_valid, is_loopback, packed_int) tuple, see _get_address_info()
+_address_cache = {}
+_address_cache_order = collections.deque() # Keys of _address_cache, oldest first
+_address_cache_lock = threading.Lock()     # Serializes insertion / eviction
+
+# Netlink constants used to watch for address changes on Linux
+_NETLINK_ROUTE = 0
+_RTMGRP_LINK = 0x1
+_RTMGRP_IPV4_IFADDR = 0x10
+_RTMGRP_IPV4_ROUTE = 0x40
+
 
 ##### Internal Functions
 
@@ -99,7 +149,7 @@ def _ip_is_allowed(ip):
   <Returns>
     True, if allowed. False, otherwise.
   """
-  global allowediplist
+  global allowedipset
   global user_ip_interface_preferences
   global allow_nonspecified_ips
   
@@ -108,8 +158,8 @@ def _ip_is_allowed(ip):
   if not user_ip_interface_preferences or allow_nonspecified_ips:
     return True
   
-  # Check the list of allowed IP's
-  return (ip in allowediplist)
+  # Check the set of allowed IP's
+  return (ip in allowedipset)
 
 
 # Only appends the elem to lst if the elem is unique
@@ -117,23 +167,95 @@ def _unique_append(lst, elem):
   if elem not in lst:
     lst.append(elem)
       
+# This function marks the allowed IP cache as stale, so the next call to
+# update_ip_cache will rebuild it, and wakes up the getmyip() refresher
+def invalidate_ip_cache():
+  global _ip_cache_updated_at
+  global _ip_cache_generation
+
+  _ip_cache_generation += 1
+  _ip_cache_updated_at = None
+
+  # Have getmyip() look again too
+  _myip_refresh_event.set()
+
+
+# Watches a netlink socket for address, link and route changes, and
+# invalidates the allowed IP cache whenever one happens
+def _address_change_loop(nlsock):
+  while True:
+    try:
+      nlsock.recv(65535)
+    except Exception, e:
+      if _is_recoverable_network_exception(e):
+        continue
+      # Give up, the cache TTL still applies
+      nlsock.close()
+      return
+
+    invalidate_ip_cache()
+
+
+# Starts the address change watcher, if the platform supports it.
+# The cachelock should be held when calling this.
+def _start_address_change_watcher():
+  global _address_watcher_started
+
+  if _address_watcher_started:
+    return
+  _address_watcher_started = True
+
+  # Netlink is Linux only, elsewhere we just rely on the cache TTL
+  if not hasattr(socket, "AF_NETLINK"):
+    return
+
+  try:
+    nlsock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, _NETLINK_ROUTE)
+    nlsock.bind((0, _RTMGRP_LINK | _RTMGRP_IPV4_IFADDR | _RTMGRP_IPV4_ROUTE))
+  except socket.error:
+    return
+
+  watcher = threading.Thread(target=_address_change_loop, args=(nlsock,), name="AddressChangeWatcher")
+  watcher.setDaemon(True)
+  watcher.start()
+
+
 # This function updates the allowed IP cache
 # It iterates through all possible IP's and stores ones which are bindable as part of the allowediplist
+# The result is cached for IP_CACHE_TTL seconds, or until the addresses change.
 def update_ip_cache():
   global allowediplist
+  global allowedipset
   global user_ip_interface_preferences
   global user_specified_ip_interface_list
   global allow_nonspecified_ips
+  global _ip_cache_updated_at
   
   # If there is no preference, this is a no-op
   if not user_ip_interface_preferences:
     return
+
+  # If the cache is still fresh, this is a no-op
+  updated_at = _ip_cache_updated_at
+  if updated_at is not None and nonportable.getruntime() - updated_at < IP_CACHE_TTL:
+    return
     
   # Acquire the lock to update the cache
   cachelock.acquire()
   
   # If there is any exception release the cachelock
   try:  
+    # Another thread may have rebuilt the cache while we waited
+    updated_at = _ip_cache_updated_at
+    if updated_at is not None and nonportable.getruntime() - updated_at < IP_CACHE_TTL:
+      return
+
+    _start_address_change_watcher()
+
+    # Remember when we started, and which generation we are building
+    starttime = nonportable.getruntime()
+    generation = _ip_cache_generation
+
     # Stores the IP's
     allowed_list = []
   
@@ -174,6 +296,11 @@ def update_ip_cache():
   
     # Update the global cache
     allowediplist = bindable_list
+    allowedipset = frozenset(bindable_list)
+
+    # Only mark the cache fresh if nothing changed while we were building it
+    if generation == _ip_cache_generation:
+      _ip_cache_updated_at = starttime
   
   finally:      
     # Release the lock
@@ -182,40 +309,94 @@ def update_ip_cache():
 
 ############## General Purpose socket functions ##############
 
-def _is_already_connected_exception(exceptionobj):
+# The categories of network errors returned by _classify_network_exception()
+_ERROR_ALREADY_CONNECTED = "already connected"
+_ERROR_ADDR_IN_USE = "address in use"
+_ERROR_ADDR_UNAVAILABLE = "address unavailable"
+_ERROR_CONN_REFUSED = "connection refused"
+_ERROR_NETWORK_DOWN = "network down"
+_ERROR_RECOVERABLE = "recoverable"
+_ERROR_TERMINATED = "terminated"
+
+# The error names in each category. (The "WSA" ones are the Windows
+# Sockets API's renditions of the Linux/BSD errno.h preprocessor macros).
+_ERROR_CATEGORY_NAMES = {
+  _ERROR_ALREADY_CONNECTED : ["EISCONN", "WSAEISCONN"],
+  _ERROR_ADDR_IN_USE : ["EADDRINUSE", "WSAEADDRINUSE"],
+  _ERROR_ADDR_UNAVAILABLE : ["EADDRNOTAVAIL", "WSAEADDRNOTAVAIL"],
+  _ERROR_CONN_REFUSED : ["ECONNREFUSED", "WSAECONNREFUSED"],
+  _ERROR_NETWORK_DOWN : ["ENETDOWN", "EHOSTUNREACH", "ENETUNREACH",
+                         "WSAENETDOWN", "WSAEHOSTUNREACH", "WSAENETUNREACH"],
+  _ERROR_RECOVERABLE : ["EINTR","EAGAIN","EBUSY","EWOULDBLOCK","ETIMEDOUT","ERESTART",
+                        "WSAEINTR","WSAEWOULDBLOCK","WSAETIMEDOUT","EALREADY","WSAEALREADY",
+                        "EINPROGRESS","WSAEINPROGRESS"],
+  _ERROR_TERMINATED : ["EPIPE","EBADF","EBADR","ENOLINK","EBADFD","ENETRESET",
+                       "ECONNRESET","WSAEBADF","WSAENOTSOCK","WSAECONNRESET",],
+}
+
+# Maps each error number on this platform to its category. This is built
+# from errno.errorcode, so an error number is classified by the same name
+# that used to be looked up on every call.
+_ERRNO_CATEGORIES = {}
+for _errnum, _errname in errno.errorcode.items():
+  for _category in _ERROR_CATEGORY_NAMES:
+    if _errname in _ERROR_CATEGORY_NAMES[_category]:
+      _ERRNO_CATEGORIES[_errnum] = _category
+
+
+def _classify_network_exception(exceptionobj):
   """
   <Purpose>
-    Determines if a given error number indicates that the socket
-    is already connected.
+    Determines which category of error an exception from a network
+    call belongs to. This is a single dict lookup.
 
   <Arguments>
     An exception object from a network call.
 
   <Returns>
-    True if already connected, false otherwise
+    One of the _ERROR_* categories, or None if the error is not in any
+    of them. socket.timeout is always recoverable. For select.error, only
+    _ERROR_RECOVERABLE and _ERROR_TERMINATED are returned.
   """
   # Get the type
   exception_type = type(exceptionobj)
 
-  # Only continue if the type is socket.error
-  if exception_type is not socket.error:
-    return False
+  # socket.timeout is recoverable always
+  if exception_type is socket.timeout:
+    return _ERROR_RECOVERABLE
+
+  # Only continue if the type is socket.error or select.error
+  if exception_type is not socket.error and exception_type is not select.error:
+    return None
 
   # Get the error number
-  errnum = exceptionobj[0]
+  try:
+    errnum = exceptionobj[0]
+  except IndexError:
+    return None
 
-  # Store a list of error messages meaning we are connected
-  connected_errors = ["EISCONN", "WSAEISCONN"]
+  category = _ERRNO_CATEGORIES.get(errnum)
 
-  # Convert the errno to and error string name
-  try:
-    errname = errno.errorcode[errnum]
-  except Exception,e:
-    # The error is unknown for some reason...
-    errname = None
-  
-  # Return if the error name is in our white list
-  return (errname in connected_errors)
+  if exception_type is select.error and category is not _ERROR_RECOVERABLE \
+      and category is not _ERROR_TERMINATED:
+    return None
+
+  return category
+
+
+def _is_already_connected_exception(exceptionobj):
+  """
+  <Purpose>
+    Determines if a given error number indicates that the socket
+    is already connected.
+
+  <Arguments>
+    An exception object from a network call.
+
+  <Returns>
+    True if already connected, false otherwise
+  """
+  return _classify_network_exception(exceptionobj) is _ERROR_ALREADY_CONNECTED
 
 
 def _is_addr_in_use_exception(exceptionobj):
@@ -231,28 +412,7 @@ def _is_addr_in_use_exception(exceptionobj):
   <Returns>
     True if already in use, false otherwise
   """
-  # Get the type
-  exception_type = type(exceptionobj)
-
-  # Only continue if the type is socket.error
-  if exception_type is not socket.error:
-    return False
-
-  # Get the error number
-  errnum = exceptionobj[0]
-
-  # Store a list of error messages meaning we are in use
-  in_use_errors = ["EADDRINUSE", "WSAEADDRINUSE"]
-
-  # Convert the errno to and error string name
-  try:
-    errname = errno.errorcode[errnum]
-  except Exception,e:
-    # The error is unknown for some reason...
-    errname = None
-  
-  # Return if the error name is in our white list
-  return (errname in in_use_errors)
+  return _classify_network_exception(exceptionobj) is _ERROR_ADDR_IN_USE
 
 
 def _is_addr_unavailable_exception(exceptionobj):
@@ -268,28 +428,7 @@ def _is_addr_unavailable_exception(exceptionobj):
   <Returns>
     True if already in use, false otherwise
   """
-  # Get the type
-  exception_type = type(exceptionobj)
-
-  # Only continue if the type is socket.error
-  if exception_type is not socket.error:
-    return False
-
-  # Get the error number
-  errnum = exceptionobj[0]
-
-  # Store a list of error messages meaning the address is not available
-  not_avail_errors = ["EADDRNOTAVAIL", "WSAEADDRNOTAVAIL"]
-
-  # Convert the errno to and error string name
-  try:
-    errname = errno.errorcode[errnum]
-  except Exception,e:
-    # The error is unknown for some reason...
-    errname = None
-  
-  # Return if the error name is in our white list
-  return (errname in not_avail_errors)
+  return _classify_network_exception(exceptionobj) is _ERROR_ADDR_UNAVAILABLE
 
 
 def _is_conn_refused_exception(exceptionobj):
@@ -305,28 +444,7 @@ def _is_conn_refused_exception(exceptionobj):
   <Returns>
     True if the error indicates the connection was refused, false otherwise
   """
-  # Get the type
-  exception_type = type(exceptionobj)
-
-  # Only continue if the type is socket.error
-  if exception_type is not socket.error:
-    return False
-
-  # Get the error number
-  errnum = exceptionobj[0]
-
-  # Store a list of error messages meaning the host refused
-  refused_errors = ["ECONNREFUSED", "WSAECONNREFUSED"]
-
-  # Convert the errno to and error string name
-  try:
-    errname = errno.errorcode[errnum]
-  except Exception,e:
-    # The error is unknown for some reason...
-    errname = None
-  
-  # Return if the error name is in our white list
-  return (errname in refused_errors)
+  return _classify_network_exception(exceptionobj) is _ERROR_CONN_REFUSED
 
 
 def _is_network_down_exception(exceptionobj):
@@ -341,31 +459,7 @@ def _is_network_down_exception(exceptionobj):
   <Returns>
     True if the network is down, false otherwise
   """
-  # Get the type
-  exception_type = type(exceptionobj)
-
-  # Only continue if the type is socket.error
-  if exception_type is not socket.error:
-    return False
-
-  # Get the error number
-  errnum = exceptionobj[0]
-
-  # These error messages mean we are disconnected.
-  # (The "WSA" ones are the Windows Sockets API's renditions of 
-  # the Linux/BSD errno.h preprocessor macros).
-  net_down_errors = ["ENETDOWN", "EHOSTUNREACH", "ENETUNREACH", 
-      "WSAENETDOWN", "WSAEHOSTUNREACH", "WSAENETUNREACH"] 
-
-  # Convert the errno to and error string name
-  try:
-    errname = errno.errorcode[errnum]
-  except Exception,e:
-    # The error is unknown for some reason...
-    errname = None
-  
-  # Return if the error name is in our white list
-  return (errname in net_down_errors)
+  return _classify_network_exception(exceptionobj) is _ERROR_NETWORK_DOWN
 
 
 def _is_recoverable_network_exception(exceptionobj):
@@ -379,34 +473,7 @@ def _is_recoverable_network_exception(exceptionobj):
   <Returns>
     True if potentially recoverable, False if fatal.
   """
-  # Get the type
-  exception_type = type(exceptionobj)
-
-  # socket.timeout is recoverable always
-  if exception_type == socket.timeout:
-    return True
-
-  # Only continue if the type is socket.error or select.error
-  elif exception_type != socket.error and exception_type != select.error:
-    return False
-  
-  # Get the error number
-  errnum = exceptionobj[0]
-
-  # Store a list of recoverable error numbers
-  recoverable_errors = ["EINTR","EAGAIN","EBUSY","EWOULDBLOCK","ETIMEDOUT","ERESTART",
-                        "WSAEINTR","WSAEWOULDBLOCK","WSAETIMEDOUT","EALREADY","WSAEALREADY",
-                       "EINPROGRESS","WSAEINPROGRESS"]
-
-  # Convert the errno to and error string name
-  try:
-    errname = errno.errorcode[errnum]
-  except Exception,e:
-    # The error is unknown for some reason...
-    errname = None
-  
-  # Return if the error name is in our white list
-  return (errname in recoverable_errors)
+  return _classify_network_exception(exceptionobj) is _ERROR_RECOVERABLE
 
 
 # Determines based on exception if the connection has been terminated
@@ -422,34 +489,14 @@ def _is_terminated_connection_exception(exceptionobj):
     True if the connection is terminated, False otherwise.
     False means we could not determine with certainty if the socket is closed.
   """
-  # Get the type
-  exception_type = type(exceptionobj)
-
-  # We only want to continue if it is socket.error or select.error
-  if exception_type != socket.error and exception_type != select.error:
-    return False
-
-  # Get the error number
-  errnum = exceptionobj[0]
-
-  # Store a list of errors which indicate connection closed
-  connection_closed_errors = ["EPIPE","EBADF","EBADR","ENOLINK","EBADFD","ENETRESET",
-                              "ECONNRESET","WSAEBADF","WSAENOTSOCK","WSAECONNRESET",]
-
-  # Convert the errnum to an error string
-  try:
-    errname = errno.errorcode[errnum]
-  except:
-    # The error number is not defined...
-    errname = None
-
-  # Return whether the errname is in our pre-defined list
-  return (errname in connection_closed_errors)
+  return _classify_network_exception(exceptionobj) is _ERROR_TERMINATED
 
 
 
 # Armon: This is used for semantics, to determine if we have a valid IP.
-def _is_valid_ip_address(ipaddr):
+# This does the actual work, callers should use the cached
+# _is_valid_ip_address() or _get_address_info().
+def _check_ip_address(ipaddr):
   """
   <Purpose>
     Determines if ipaddr is a valid IP address.
@@ -529,8 +576,9 @@ def _is_valid_network_port(port):
 
 
 # Used to decide if an IP is the loopback IP or not.   This is needed for 
-# accounting
-def _is_loopback_ipaddr(host):
+# accounting. This does the actual work, callers should use the cached
+# _is_loopback_ipaddr() or _get_address_info().
+def _check_loopback_ipaddr(host):
   if not host.startswith('127.'):
     return False
   if len(host.split('.')) != 4:
@@ -549,6 +597,69 @@ def _is_loopback_ipaddr(host):
   return True
 
 
+# The result of _get_address_info() for anything that is not a string
+_INVALID_ADDRESS_INFO = (False, False, None)
+
+
+# Caches the validation of IP address strings, since the same few strings
+# are checked on every send / connect.
+def _get_address_info(ipaddr):
+  """
+  <Purpose>
+    Determines if ipaddr is a valid IP address, and if it is on loopback.
+    The result is cached, so the common case is a single dict lookup.
+
+  <Arguments>
+    ipaddr: The IP address to check.
+
+  <Returns>
+    A tuple (is_valid, is_loopback, packed_int), where packed_int is the
+    address as an integer, or None if it is not valid.
+  """
+  # Only strings are cached. u"127.0.0.1" is equal to "127.0.0.1", so
+  # it would otherwise share the entry.
+  if type(ipaddr) is not str:
+    return _INVALID_ADDRESS_INFO
+
+  addressinfo = _address_cache.get(ipaddr)
+  if addressinfo is not None:
+    return addressinfo
+
+  # Not cached yet, do the real checks
+  is_valid = _check_ip_address(ipaddr)
+  is_loopback = _check_loopback_ipaddr(ipaddr)
+  packed_int = None
+  if is_valid:
+    packed_int = 0
+    for octet in ipaddr.split("."):
+      packed_int = (packed_int << 8) | int(octet)
+
+  addressinfo = (is_valid, is_loopback, packed_int)
+
+  _address_cache_lock.acquire()
+  try:
+    if ipaddr not in _address_cache:
+      # Evict the oldest entry if the cache is full
+      if len(_address_cache_order) >= ADDRESS_CACHE_SIZE:
+        del _address_cache[_address_cache_order.popleft()]
+      _address_cache[ipaddr] = addressinfo
+      _address_cache_order.append(ipaddr)
+  finally:
+    _address_cache_lock.release()
+
+  return addressinfo
+
+
+# Determines if ipaddr is a valid IP address. See _check_ip_address().
+def _is_valid_ip_address(ipaddr):
+  return _get_address_info(ipaddr)[0]
+
+
+# Determines if host is a loopback IP address. See _check_loopback_ipaddr().
+def _is_loopback_ipaddr(host):
+  return _get_address_info(host)[1]
+
+
 # Checks if binding to the local port is allowed
 # type should be "TCP" or "UDP".
 def _is_allowed_localport(type, localport):
@@ -570,6 +681,221 @@ def _is_allowed_localport(type, localport):
 
 
 
+##### Name resolution cache
+
+# gethostbyname() results are cached for DNS_CACHE_TTL seconds, and names
+# that do not resolve for DNS_NEGATIVE_TTL seconds. The system resolver
+# does not tell us the TTLs of the records, so these are fixed.
+DNS_CACHE_TTL = 60.0 # In seconds
+DNS_NEGATIVE_TTL = 5.0 # In seconds
+DNS_CACHE_SIZE = 256
+
+# The number of threads that look up names in the background. A cached
+# name that is used within DNS_REFRESH_AHEAD seconds of expiring is looked
+# up again by one of these, so callers keep getting a cached answer. 0
+# disables the threads, and background lookups get a thread each.
+DNS_RESOLVER_THREADS = 2
+DNS_REFRESH_AHEAD = 10.0 # In seconds
+
+# Maps name -> (expires_at, ip). ip is None if the name did not resolve.
+_dns_cache = {}
+_dns_cache_order = collections.deque() # Keys of _dns_cache, oldest first
+_dns_cache_lock = threading.Lock()     # Serializes updates and _dns_pending
+
+# Maps name -> _PendingLookup for the names being looked up, so that
+# callers asking for the same name share one lookup
+_dns_pending = {}
+
+# (name, _PendingLookup) tuples for the resolver threads to look up
+_dns_queue = Queue.Queue()
+_dns_resolvers_started = False
+
+
+class _PendingLookup:
+  """
+  A lookup in progress. Other callers wait for done, or add a callback
+  that is called with the IP, or None if the name did not resolve.
+  """
+  __slots__ = ["done", "ip", "callbacks"]
+
+  def __init__(self):
+    self.done = threading.Event()
+    self.ip = None
+    self.callbacks = []
+
+
+
+def _resolve_hostname(name, pending):
+  """
+  <Purpose>
+    Does a real lookup of a name, charging for it, caches the result and
+    wakes up the callers waiting for it.
+
+  <Arguments>
+    name: The host name
+    pending: The _PendingLookup of the name, in _dns_pending
+
+  <Exceptions>
+    As with socket.gethostbyname(), other than socket.gaierror.
+
+  <Resource Consumption>
+    4K netrecv, 1K netsend.
+
+  <Returns>
+    The IP, or None if the name did not resolve.
+  """
+  ip = None
+  ttl = None
+  try:
+    # charge 4K for a look up...   I don't know the right number, but we should
+    # charge something.   We'll always charge to the netsend interface...
+    nanny.tattle_quantity('netsend', 1024) 
+    nanny.tattle_quantity('netrecv', 4096)
+
+    try:
+      ip = socket.gethostbyname(name)
+      ttl = DNS_CACHE_TTL
+    except socket.gaierror:
+      ttl = DNS_NEGATIVE_TTL
+
+  finally:
+    # Anything other than a failed lookup is not cached
+    _dns_cache_lock.acquire()
+    try:
+      if ttl is not None:
+        if name not in _dns_cache:
+          # Evict the oldest entry if the cache is full
+          if len(_dns_cache_order) >= DNS_CACHE_SIZE:
+            del _dns_cache[_dns_cache_order.popleft()]
+          _dns_cache_order.append(name)
+        _dns_cache[name] = (nonportable.getruntime() + ttl, ip)
+      del _dns_pending[name]
+    finally:
+      _dns_cache_lock.release()
+
+    pending.ip = ip
+    pending.done.set()
+    for callback in pending.callbacks:
+      callback(ip)
+
+  return ip
+
+
+
+def _resolve_in_background(name, pending):
+  try:
+    _resolve_hostname(name, pending)
+  except Exception:
+    # The waiting callers have been told it did not resolve
+    pass
+
+
+
+def _dns_resolver_loop():
+  while True:
+    (name, pending) = _dns_queue.get()
+    _resolve_in_background(name, pending)
+
+
+
+def _queue_lookup(name, pending):
+  # Has the resolver threads look up a name. The _dns_cache_lock should be
+  # held when calling this.
+  global _dns_resolvers_started
+
+  if DNS_RESOLVER_THREADS <= 0:
+    resolver = threading.Thread(target=_resolve_in_background, args=(name, pending), name="DNSResolver")
+    resolver.setDaemon(True)
+    resolver.start()
+    return
+
+  _dns_queue.put((name, pending))
+
+  if not _dns_resolvers_started:
+    _dns_resolvers_started = True
+    for count in range(DNS_RESOLVER_THREADS):
+      resolver = threading.Thread(target=_dns_resolver_loop, name="DNSResolver")
+      resolver.setDaemon(True)
+      resolver.start()
+
+
+
+def _is_dotted_quad(name):
+  # Determines if name is an IPv4 address in the dotted quad form, which
+  # socket.gethostbyname() returns unchanged
+  try:
+    return socket.inet_ntoa(socket.inet_aton(name)) == name
+  except socket.error:
+    return False
+
+
+
+def _lookup_hostname(name, callback=None):
+  """
+  <Purpose>
+    Looks up a name, from the cache if possible. If another caller is
+    already looking up the name, waits for that lookup instead.
+
+  <Arguments>
+    name: The host name
+    callback: If given, the lookup is done in the background, and this
+              is called with the IP, or None if the name did not resolve.
+
+  <Exceptions>
+    As with _resolve_hostname().
+
+  <Returns>
+    The IP, or None if the name did not resolve. If a callback was given,
+    this is None, and the result is passed to the callback.
+  """
+  now = nonportable.getruntime()
+  entry = _dns_cache.get(name)
+  if entry is not None and entry[0] > now:
+    (expires_at, ip) = entry
+    # Look up names in use again before they expire
+    if ip is not None and expires_at - now < DNS_REFRESH_AHEAD and name not in _dns_pending:
+      _dns_cache_lock.acquire()
+      try:
+        if name not in _dns_pending:
+          pending = _PendingLookup()
+          _dns_pending[name] = pending
+          _queue_lookup(name, pending)
+      finally:
+        _dns_cache_lock.release()
+
+    if callback is not None:
+      callback(ip)
+      return None
+    return ip
+
+  # Join a lookup in progress, or start one
+  _dns_cache_lock.acquire()
+  try:
+    pending = _dns_pending.get(name)
+    if pending is None:
+      pending = _PendingLookup()
+      _dns_pending[name] = pending
+      if callback is not None:
+        pending.callbacks.append(callback)
+        _queue_lookup(name, pending)
+        return None
+      leader = True
+    else:
+      if callback is not None:
+        pending.callbacks.append(callback)
+        return None
+      leader = False
+  finally:
+    _dns_cache_lock.release()
+
+  if leader:
+    return _resolve_hostname(name, pending)
+
+  pending.done.wait()
+  return pending.ip
+
+
+
 # Public interface
 def gethostbyname(name):
   """
@@ -577,7 +903,8 @@ def gethostbyname(name):
       Provides information about a hostname. Calls socket.gethostbyname().
       Translate a host name to IPv4 address format. The IPv4 address is
       returned as a string, such as '100.50.200.5'. If the host name is an
-      IPv4 address itself it is returned unchanged.
+      IPv4 address itself it is returned unchanged. Results are cached,
+      see DNS_CACHE_TTL and DNS_NEGATIVE_TTL.
 
    <Arguments>
      name:
@@ -594,6 +921,7 @@ def gethostbyname(name):
    <Resource Consumption>
      This operation consumes network bandwidth of 4K netrecv, 1K netsend.
      (It's hard to tell how much was actually sent / received at this level.)
+     Nothing is consumed if the result is cached, or the name is an IP.
 
    <Returns>
      The IPv4 address as a string.
@@ -602,56 +930,132 @@ def gethostbyname(name):
   if type(name) is not str:
     raise RepyArgumentError("gethostbyname() takes a string as argument.")
 
-  # charge 4K for a look up...   I don't know the right number, but we should
-  # charge something.   We'll always charge to the netsend interface...
-  nanny.tattle_quantity('netsend', 1024) 
-  nanny.tattle_quantity('netrecv', 4096)
+  # There is nothing to look up for an IP
+  if _is_dotted_quad(name):
+    return name
 
-  try:
-    return socket.gethostbyname(name)
-  except socket.gaierror:
+  ip = _lookup_hostname(name)
+  if ip is None:
     raise NetworkAddressError("The hostname '"+name+"' could not be resolved.")
+  return ip
 
 
 
-# Public interface
-def getmyip():
-  """
-   <Purpose>
-      Provides the IP of this computer on its public facing interface.  
-      Does some clever trickery. 
+##### Public IP cache
 
-   <Arguments>
-      None
+# getmyip() used to look for the public facing IP on every call. Now a
+# background thread does that every MYIP_REFRESH_INTERVAL seconds, or as
+# soon as the address change watcher sees a change, and getmyip() returns
+# the cached result.
+MYIP_REFRESH_INTERVAL = 5.0 # In seconds
 
-   <Exceptions>
-      InternetConnectivityError is the host is not connected to the internet.
+# The cached result, as a (myip, interfaces) tuple. myip is None if we
+# are not connected to the internet, and interfaces maps each interface
+# name to a list of its IPs. This is replaced as a whole, so readers do
+# not need a lock. It is None until the first lookup.
+_myip_state = None
 
-   <Side Effects>
-      None.
+# Serializes lookups and starting the refresher thread
+_myip_lock = threading.Lock()
 
-   <Resource Consumption>
-      This operations consumes 256 netsend and 128 netrecv.
+# Whether we have started the refresher thread
+_myip_refresher_started = False
 
-   <Returns>
-      The localhost's IP address
-  """
-  # Charge for the resources
-  nanny.tattle_quantity("netsend", 256)
-  nanny.tattle_quantity("netrecv", 128)
+# Set to make the refresher thread look up the IP now
+_myip_refresh_event = threading.Event()
 
-  # I got some of this from: http://groups.google.com/group/comp.lang.python/browse_thread/thread/d931cdc326d7032b?hl=en
-  
-  # Update the cache and return the first allowed IP
-  # Only if a preference is set
+# Functions called with (myip, interfaces) when the cached result changes
+_myip_callbacks = []
+
+# Linux ioctl to list the IPv4 addresses of the interfaces
+_SIOCGIFCONF = 0x8912
+_MAX_INTERFACES = 128
+
+
+def _get_interface_addresses():
+  """
+  <Purpose>
+    Lists the IPv4 addresses of the network interfaces of this computer.
+
+  <Arguments>
+    None
+
+  <Exceptions>
+    None
+
+  <Returns>
+    A dict that maps interface names to lists of IP addresses. This is
+    only the interfaces the user specified if there is a preference, and
+    is empty if the interfaces cannot be listed.
+  """
+  interfaces = {}
+
+  # If the user named interfaces, only report those
+  if user_ip_interface_preferences:
+    for (is_ip_addr, value) in user_specified_ip_interface_list:
+      if not is_ip_addr:
+        try:
+          interfaces[value] = list(nonportable.os_api.get_interface_ip_addresses(value))
+        except:
+          # Catch exceptions if the NIC does not exist
+          pass
+    return interfaces
+
+  if nonportable.ostype != "Linux":
+    return interfaces
+
+  try:
+    import fcntl
+    import array
+
+    # struct ifreq is a 16 byte name then a sockaddr, padded to 40
+    # bytes on 64 bit systems and 32 bytes on 32 bit systems
+    ifreq_size = 40 if struct.calcsize("P") == 8 else 32
+    names = array.array("B", "\0" * (ifreq_size * _MAX_INTERFACES))
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+      ifconf = struct.pack("iL", len(names), names.buffer_info()[0])
+      length = struct.unpack("iL", fcntl.ioctl(sock.fileno(), _SIOCGIFCONF, ifconf))[0]
+    finally:
+      sock.close()
+  except Exception:
+    return interfaces
+
+  names = names.tostring()
+  for offset in range(0, length, ifreq_size):
+    name = names[offset:offset+16].split("\0", 1)[0]
+    ip = socket.inet_ntoa(names[offset+20:offset+24])
+    _unique_append(interfaces.setdefault(name, []), ip)
+
+  return interfaces
+
+
+
+def _lookup_myip():
+  """
+  <Purpose>
+    Finds the IP of this computer on its public facing interface, by
+    seeing which local IP would be used to reach each of
+    repy_constants.STABLE_PUBLIC_IPS.
+
+  <Arguments>
+    None
+
+  <Exceptions>
+    None
+
+  <Returns>
+    The IP, or None if we are not connected to the internet.
+  """
+  # Use the first allowed IP if a preference is set
   if user_ip_interface_preferences:
     update_ip_cache()
-    # Return the first allowed ip, there is always at least 1 element (loopback)
+    # There is always at least 1 element (loopback)
     return allowediplist[0]
 
-  # Initialize these to None, so we can detect a failure
-  myip = None
-  
+  # I got some of this from: http://groups.google.com/group/comp.lang.python/browse_thread/thread/d931cdc326d7032b?hl=en
+
   # It's possible on some platforms (Windows Mobile) that the IP will be
   # 0.0.0.0 even when I have a public IP and the external IP is up. However, if
   # I get a real connection with SOCK_STREAM, then I should get the real
@@ -674,10 +1078,229 @@ def getmyip():
       if _is_valid_ip_address(myip): 
         return myip
 
+  return None
+
+
+
+def _refresh_myip():
+  """
+  <Purpose>
+    Looks up the public facing IP and the interface addresses, updates
+    the cache, and calls the change callbacks if anything changed.
+
+  <Arguments>
+    None
+
+  <Exceptions>
+    None
+
+  <Returns>
+    The new (myip, interfaces) tuple.
+  """
+  global _myip_state
+
+  _myip_lock.acquire()
+  try:
+    oldstate = _myip_state
+    newstate = (_lookup_myip(), _get_interface_addresses())
+    _myip_state = newstate
+    callbacks = list(_myip_callbacks)
+  finally:
+    _myip_lock.release()
+
+  if oldstate is not None and newstate != oldstate:
+    for callback in callbacks:
+      try:
+        callback(newstate[0], newstate[1])
+      except Exception:
+        # A broken callback must not stop the others, or the refresher
+        pass
+
+  return newstate
+
+
+
+def _myip_refresh_loop():
+  while True:
+    _myip_refresh_event.wait(MYIP_REFRESH_INTERVAL)
+    _myip_refresh_event.clear()
+    try:
+      _refresh_myip()
+    except Exception:
+      # Keep the old result, and try again next time
+      pass
+
+
+
+def _get_myip_state():
+  """
+  <Purpose>
+    Returns the cached (myip, interfaces) tuple, doing the first lookup
+    and starting the refresher thread if needed.
+
+  <Arguments>
+    None
+
+  <Exceptions>
+    None
+
+  <Returns>
+    The (myip, interfaces) tuple.
+  """
+  global _myip_refresher_started
+
+  state = _myip_state
+  if state is not None and state[0] is not None:
+    return state
+
+  # Nothing cached yet, or we were not connected last time. Look now
+  # rather than making the caller wait for the refresher.
+  state = _refresh_myip()
+
+  if not _myip_refresher_started:
+    _myip_lock.acquire()
+    try:
+      if not _myip_refresher_started:
+        _myip_refresher_started = True
+
+        # Refresh as soon as the addresses change
+        cachelock.acquire()
+        try:
+          _start_address_change_watcher()
+        finally:
+          cachelock.release()
+
+        refresher = threading.Thread(target=_myip_refresh_loop, name="MyIPRefresher")
+        refresher.setDaemon(True)
+        refresher.start()
+    finally:
+      _myip_lock.release()
+
+  return state
+
+
+
+def add_myip_callback(callback):
+  """
+  <Purpose>
+    Registers a function to call whenever the result of getmyip() or
+    getmyips() changes.
+
+  <Arguments>
+    callback: A function taking (myip, interfaces), as returned by
+              getmyips(). myip is None if the internet is unreachable.
+              It is called from the refresher thread.
+
+  <Exceptions>
+    None
+
+  <Returns>
+    None
+  """
+  _myip_lock.acquire()
+  try:
+    _myip_callbacks.append(callback)
+  finally:
+    _myip_lock.release()
+
+
+
+def remove_myip_callback(callback):
+  """
+  <Purpose>
+    Unregisters a function registered with add_myip_callback().
+
+  <Arguments>
+    callback: The function
+
+  <Exceptions>
+    ValueError if the function is not registered.
+
+  <Returns>
+    None
+  """
+  _myip_lock.acquire()
+  try:
+    _myip_callbacks.remove(callback)
+  finally:
+    _myip_lock.release()
+
 
-  # Since we haven't returned yet, we must have failed.
-  # Raise an exception, we must not be connected to the internet
-  raise InternetConnectivityError("Cannot detect a connection to the Internet.")
+
+# Public interface
+def getmyip():
+  """
+   <Purpose>
+      Provides the IP of this computer on its public facing interface.  
+      Does some clever trickery. The IP is cached, and looked up again
+      in the background every MYIP_REFRESH_INTERVAL seconds or when the
+      addresses change.
+
+   <Arguments>
+      None
+
+   <Exceptions>
+      InternetConnectivityError is the host is not connected to the internet.
+
+   <Side Effects>
+      None.
+
+   <Resource Consumption>
+      This operations consumes 256 netsend and 128 netrecv.
+
+   <Returns>
+      The localhost's IP address
+  """
+  # Charge for the resources
+  nanny.tattle_quantity("netsend", 256)
+  nanny.tattle_quantity("netrecv", 128)
+
+  myip = _get_myip_state()[0]
+  if myip is None:
+    # We must not be connected to the internet
+    raise InternetConnectivityError("Cannot detect a connection to the Internet.")
+
+  return myip
+
+
+
+# Public interface
+def getmyips():
+  """
+   <Purpose>
+      Provides the IP of this computer on its public facing interface,
+      and the IPs of each of its network interfaces, from the same cache
+      as getmyip().
+
+   <Arguments>
+      None
+
+   <Exceptions>
+      None.
+
+   <Side Effects>
+      None.
+
+   <Resource Consumption>
+      As with getmyip().
+
+   <Returns>
+      A tuple (myip, interfaces). myip is as returned by getmyip(), or
+      None if the host is not connected to the internet. interfaces is a
+      dict mapping each interface name to a list of its IPs.
+  """
+  # Charge for the resources
+  nanny.tattle_quantity("netsend", 256)
+  nanny.tattle_quantity("netrecv", 128)
+
+  (myip, interfaces) = _get_myip_state()
+
+  # Don't let callers change the cache
+  copied = {}
+  for (name, ips) in interfaces.items():
+    copied[name] = list(ips)
+
+  return (myip, copied)
 
 
 
@@ -732,37 +1355,156 @@ def _get_localIP_to_remoteIP(connection_type, external_ip, external_port=80):
 # Armon: How frequently should we check for the availability of the socket?
 RETRY_INTERVAL = 0.2 # In seconds
 
+# The listen backlog of TCPServerSockets. If there is an outsockets
+# restriction, the backlog is no more than that, as we could not accept
+# more connections anyway.
+LISTEN_BACKLOG = 128
 
-def _cleanup_socket(self):
+# SO_REUSEPORT, which lets several sockets listen on the same address with
+# the kernel spreading the connections over them. Python 2 does not
+# define it, so use the Linux value there. None if it is not supported.
+_SO_REUSEPORT = getattr(socket, "SO_REUSEPORT", None)
+if _SO_REUSEPORT is None and nonportable.ostype == "Linux":
+  _SO_REUSEPORT = 15
+
+# The initial size of the receive buffer used by EmulatedSocket.recvexactly()
+# and recvuntil(), and the largest it is allowed to grow to.
+RECV_BUFFER_SIZE = 64 * 1024
+MAX_RECV_BUFFER_SIZE = 1024 * 1024
+
+# Every socket that has used recvexactly() or recvuntil() keeps a buffer of
+# RECV_BUFFER_SIZE. Buffers that grow past that are released once the data
+# in them has been returned, and the memory they use beyond
+# RECV_BUFFER_SIZE, over all sockets together, may not be more than this.
+MAX_TOTAL_RECV_BUFFER_SIZE = 32 * 1024 * 1024
+
+# The memory reserved by every _RecvBufferReservation together
+_recv_buffer_reserved = 0
+_recv_buffer_lock = threading.Lock()
+
+
+
+class _RecvBufferReservation(object):
+  """
+  The memory an EmulatedSocket's receive buffer uses beyond
+  RECV_BUFFER_SIZE. This is kept apart from the socket object, so that it
+  can be given back if the socket is dropped without being closed. It is
+  only used while the socket lock is held, or once the socket is gone.
+  """
+  __slots__ = ["size"]
+
+  def __init__(self):
+    self.size = 0
+
+
+  def resize(self, buffersize):
+    # Reserves the memory for a buffer of buffersize bytes, giving back
+    # what is no longer needed. Raises ResourceExhaustedError if this would
+    # go over MAX_TOTAL_RECV_BUFFER_SIZE.
+    global _recv_buffer_reserved
+
+    size = max(0, buffersize - RECV_BUFFER_SIZE)
+    if size == self.size:
+      return
+
+    _recv_buffer_lock.acquire()
+    try:
+      if size > self.size and _recv_buffer_reserved + size - self.size > MAX_TOTAL_RECV_BUFFER_SIZE:
+        raise ResourceExhaustedError("Sockets are buffering too much received data!")
+      _recv_buffer_reserved += size - self.size
+      self.size = size
+    finally:
+      _recv_buffer_lock.release()
+
+
+
+##### Socket reclamation
+
+# Sockets that are dropped without being closed still hold a real socket
+# and an insocket / outsocket. Rather than releasing these in __del__,
+# during garbage collection and with the socket lock, each socket object
+# has a weak reference in _live_sockets. When the object goes away, the
+# callback only moves what needs releasing to _dead_sockets. It is
+# released the next time a socket is created, or by the background thread
+# started by _track_socket(), within ACCOUNTING_FLUSH_INTERVAL seconds.
+
+# Maps a weak reference to a socket object -> (realsock, stats, accounting,
+# recv_reservation), for the socket objects that have not been closed
+_live_sockets = {}
+
+# (realsock, stats, accounting, recv_reservation) tuples for socket objects
+# that went away without being closed
+_dead_sockets = collections.deque()
+
+
+def _socket_collected(ref):
+  # Called when a socket object goes away, possibly by the garbage
+  # collector, so this must not take any locks.
+  resources = _live_sockets.pop(ref, None)
+  if resources is not None:
+    _dead_sockets.append(resources)
+
+
+
+def _track_socket(self, recv_reservation=None):
   """
   <Purpose>
-    Internal cleanup method for open sockets. The socket
-    lock for the socket should be acquired prior to
-    calling.
+    Registers a new socket object, so that its real socket is reclaimed
+    if the object goes away without being closed.
 
   <Arguments>
+    self: An EmulatedSocket, UDPServerSocket or TCPServerSocket.
+    recv_reservation: The _RecvBufferReservation of an EmulatedSocket.
+
+  <Returns>
     None
+  """
+  _live_sockets[weakref.ref(self, _socket_collected)] = (self.socketobj, self.stats, self.accounting,
+                                                         recv_reservation)
+
+  # The accounting flusher also reclaims dropped sockets
+  if not _accounting_flusher_started:
+    _start_accounting_flusher()
+
+
+
+def _release_socket(sock, stats, accounting, recv_reservation=None):
+  """
+  <Purpose>
+    Releases a real socket and everything that goes with it.
+
+  <Arguments>
+    sock: The real socket
+    stats: The _SocketStatistics of the socket, or None
+    accounting: The _AccountingBuffer of the socket, or None
+    recv_reservation: The _RecvBufferReservation of the socket, or None
+
   <Side Effects>
     The insocket/outsocket handle will be released.
 
-  <Exceptions>
-    InternalRepyError is raised if the socket lock is not held
-    prior to calling the function.
-
   <Returns>
     None
   """
-  sock = self.socketobj
-  socket_lock = self.sock_lock
-  # Make sure the lock is already acquired
-  # BUG: We don't know which thread exactly acquired the lock.
-  if socket_lock.acquire(False):
-    socket_lock.release()
-    raise InternalRepyError("Socket lock should be acquired before calling _cleanup_socket!")
+  # Stop tracking the socket, this wakes up any threads waiting on it
+  _readiness_engine.unregister(sock)
+
+  if stats is not None:
+    _forget_socket_statistics(stats)
+
+  # Pass on any charges that are still buffered
+  if accounting is not None:
+    accounting.flush()
+
+  # Give back the memory of the receive buffer
+  if recv_reservation is not None:
+    recv_reservation.resize(0)
+
+  # Stop sendmessage() from borrowing a closed UDP socket
+  if sock.type == socket.SOCK_DGRAM:
+    for (key, bound_socket) in _BOUND_SOCKETS.items():
+      if bound_socket is sock:
+        del _BOUND_SOCKETS[key]
 
-  if (sock == None):  
-    # Already cleaned up
-    return
   # Shutdown the socket for writing prior to close
   # to unblock any threads that are writing
   try:
@@ -782,17 +1524,287 @@ def _cleanup_socket(self):
   nanny.tattle_remove_item('outsockets', sockid)
 
 
-####################### Message sending #############################
 
+def reclaim_sockets():
+  """
+  <Purpose>
+    Releases the real sockets of socket objects that went away without
+    being closed. This is done whenever a socket is created, and
+    periodically by the accounting flusher thread, so it only needs
+    calling to release them sooner.
 
+  <Arguments>
+    None
 
-# Public interface!!!
-def sendmessage(destip, destport, message, localip, localport):
-  """
-   <Purpose>
-      Send a message to a host / port
+  <Exceptions>
+    None
 
-   <Arguments>
+  <Side Effects>
+    The insocket/outsocket handles of the sockets will be released.
+
+  <Returns>
+    The number of sockets that were released.
+  """
+  count = 0
+  while _dead_sockets:
+    try:
+      (sock, stats, accounting, recv_reservation) = _dead_sockets.popleft()
+    except IndexError:
+      # Another thread got there first
+      break
+    _release_socket(sock, stats, accounting, recv_reservation)
+    count += 1
+
+  return count
+
+
+
+def _cleanup_socket(self):
+  """
+  <Purpose>
+    Internal cleanup method for open sockets. The socket
+    lock for the socket should be acquired prior to
+    calling.
+
+  <Arguments>
+    None
+  <Side Effects>
+    The insocket/outsocket handle will be released.
+
+  <Exceptions>
+    InternalRepyError is raised if the socket lock is not held
+    prior to calling the function.
+
+  <Returns>
+    None
+  """
+  sock = self.socketobj
+  socket_lock = self.sock_lock
+  # Make sure the lock is already acquired
+  # BUG: We don't know which thread exactly acquired the lock.
+  if socket_lock.acquire(False):
+    socket_lock.release()
+    raise InternalRepyError("Socket lock should be acquired before calling _cleanup_socket!")
+
+  if (sock == None):  
+    # Already cleaned up
+    return
+
+  # Closed, so there is nothing to reclaim if the object goes away
+  _live_sockets.pop(weakref.ref(self), None)
+
+  _release_socket(sock, self.stats, self.accounting)
+
+
+####################### Message sending #############################
+
+
+
+# When nothing is listening on the local address, sendmessage() sends from
+# a bound UDP socket kept in this pool, rather than binding a new socket
+# for every message. Each pooled socket holds an outsocket. At most
+# UDP_SEND_POOL_SIZE sockets are kept, and sockets that have not been used
+# for UDP_SEND_POOL_IDLE_TIME seconds are closed.
+UDP_SEND_POOL_SIZE = 16
+UDP_SEND_POOL_IDLE_TIME = 10.0 # In seconds
+
+# Maps (localip, localport) -> [socket, time last used, number of senders
+# using the socket, whether the socket is still in the pool]. A socket
+# that is taken out of the pool while senders are using it is closed by
+# the last of them, in _release_udp_send_socket().
+_udp_send_pool = {}
+_udp_send_pool_lock = threading.Lock()
+_udp_send_pool_swept_at = 0.0
+
+
+def _close_udp_send_socket(entry):
+  # Closes the socket of a pool entry and gives back its outsocket.
+  try:
+    entry[0].close()
+  except:
+    pass
+  nanny.tattle_remove_item('outsockets', id(entry[0]))
+
+
+def _close_pooled_udp_socket(key):
+  # Takes the pooled socket for key, if there is one, out of the pool and
+  # closes it. If it is being sent on, it is closed once the sends are
+  # done. Returns the pool entry, or None. The pool lock must be held.
+  entry = _udp_send_pool.pop(key, None)
+  if entry is None:
+    return None
+  entry[3] = False
+  if entry[2] == 0:
+    _close_udp_send_socket(entry)
+  return entry
+
+
+def _sweep_udp_send_pool(now):
+  # Closes idle sockets, and the least recently used ones until there is
+  # room for a new socket. Sockets that are being sent on are left alone.
+  # The pool lock must be held.
+  global _udp_send_pool_swept_at
+  _udp_send_pool_swept_at = now
+
+  for (key, entry) in _udp_send_pool.items():
+    if entry[2] == 0 and now - entry[1] >= UDP_SEND_POOL_IDLE_TIME:
+      _close_pooled_udp_socket(key)
+
+  while len(_udp_send_pool) >= UDP_SEND_POOL_SIZE:
+    unused = [item for item in _udp_send_pool.items() if item[1][2] == 0]
+    if not unused:
+      break
+    oldest = min(unused, key=lambda item: item[1][1])[0]
+    _close_pooled_udp_socket(oldest)
+
+
+def flush_udp_send_pool():
+  """
+  <Purpose>
+    Closes every socket in the UDP send pool, giving back their
+    outsockets. Sockets that are being sent on are closed when the
+    send is done.
+
+  <Arguments>
+    None
+
+  <Exceptions>
+    None
+
+  <Returns>
+    None
+  """
+  _udp_send_pool_lock.acquire()
+  try:
+    for key in _udp_send_pool.keys():
+      _close_pooled_udp_socket(key)
+  finally:
+    _udp_send_pool_lock.release()
+
+
+def _tattle_add_outsocket(sockid):
+  """
+  <Purpose>
+    Registers a socket as an outsocket with nanny. Idle sockets in the
+    UDP send pool hold outsockets, so if there are none left the pool is
+    emptied and this is tried again.
+
+  <Arguments>
+    sockid: The id of the socket
+
+  <Exceptions>
+    ResourceExhaustedError if there are no outsockets left, even after
+    the pool is emptied.
+
+  <Returns>
+    None
+  """
+  try:
+    nanny.tattle_add_item('outsockets', sockid)
+  except ResourceExhaustedError:
+    flush_udp_send_pool()
+    nanny.tattle_add_item('outsockets', sockid)
+
+
+def _get_udp_send_socket(localip, localport):
+  """
+  <Purpose>
+    Returns a UDP socket bound to the local address to send from. This is
+    the listening socket if there is one, and otherwise a pooled socket,
+    which is created if needed. A pooled socket is marked as in use, and
+    must be given back with _release_udp_send_socket().
+
+  <Arguments>
+    localip, localport: The local address to send from
+
+  <Exceptions>
+    Any error from binding the socket. ResourceExhaustedError if there
+    are no outsockets left, even after the pool is emptied.
+
+  <Returns>
+    A tuple (socket, pool entry). The pool entry is None for a listening
+    socket.
+  """
+  bound_socket = _BOUND_SOCKETS.get(("UDP", localip, localport))
+  if bound_socket is not None:
+    return (bound_socket, None)
+
+  key = (localip, localport)
+  now = nonportable.getruntime()
+
+  _udp_send_pool_lock.acquire()
+  try:
+    if now - _udp_send_pool_swept_at >= UDP_SEND_POOL_IDLE_TIME:
+      _sweep_udp_send_pool(now)
+
+    entry = _udp_send_pool.get(key)
+    if entry is not None:
+      entry[1] = now
+      entry[2] += 1
+      return (entry[0], entry)
+
+    _sweep_udp_send_pool(now)
+
+    # Get the socket
+    sock = _get_udp_socket(localip, localport)
+
+    # Register this socket with nanny. The pool may be holding the
+    # outsockets we need, so give them back and try again.
+    try:
+      nanny.tattle_add_item("outsockets", id(sock))
+    except ResourceExhaustedError:
+      for otherkey in _udp_send_pool.keys():
+        _close_pooled_udp_socket(otherkey)
+      try:
+        nanny.tattle_add_item("outsockets", id(sock))
+      except:
+        sock.close()
+        raise
+
+    entry = [sock, now, 1, True]
+    _udp_send_pool[key] = entry
+    return (sock, entry)
+
+  finally:
+    _udp_send_pool_lock.release()
+
+
+def _release_udp_send_socket(localip, localport, entry, failed):
+  # Gives back a socket from _get_udp_send_socket(). A pooled socket that
+  # had an error is taken out of the pool, and a socket that is out of the
+  # pool is closed by its last sender. Listening sockets are only
+  # borrowed, so there is nothing to do for them.
+  if entry is None:
+    return
+
+  _udp_send_pool_lock.acquire()
+  try:
+    entry[2] -= 1
+    if failed and entry[3]:
+      _close_pooled_udp_socket((localip, localport))
+    elif not entry[3] and entry[2] == 0:
+      _close_udp_send_socket(entry)
+  finally:
+    _udp_send_pool_lock.release()
+
+
+def _listening_socket_was_closed(localip, localport, sock, entry):
+  # Returns True if sock is a borrowed listening socket that has been
+  # closed since it was handed out, so sending should be retried from
+  # another socket.
+  if entry is not None:
+    return False
+  return _BOUND_SOCKETS.get(("UDP", localip, localport)) is not sock
+
+
+
+# Public interface!!!
+def sendmessage(destip, destport, message, localip, localport):
+  """
+   <Purpose>
+      Send a message to a host / port
+
+   <Arguments>
       destip:
          The host to send a message to
       destport:
@@ -846,7 +1858,8 @@ def sendmessage(destip, destport, message, localip, localport):
 
 
   # Check the input arguments (sanity)
-  if not _is_valid_ip_address(destip):
+  (destip_valid, dest_on_loopback, destip_int) = _get_address_info(destip)
+  if not destip_valid:
     raise RepyArgumentError("Provided destip is not valid! IP: '"+destip+"'")
   if not _is_valid_ip_address(localip):
     raise RepyArgumentError("Provided localip is not valid! IP: '"+localip+"'")
@@ -870,26 +1883,31 @@ def sendmessage(destip, destport, message, localip, localport):
     raise ResourceForbiddenError("Provided localport is not allowed! Port: "+str(localport))
 
   # Wait for netsend
-  if _is_loopback_ipaddr(destip):
+  if dest_on_loopback:
     nanny.tattle_quantity('loopsend', 0)
   else:
     nanny.tattle_quantity('netsend', 0)
 
   try:
-    sock = None
+    while True:
+      # Get a bound socket, this is the listening one if there is one
+      (sock, entry) = _get_udp_send_socket(localip, localport)
 
-    if ("UDP", localip, localport) in _BOUND_SOCKETS:
-      sock = _BOUND_SOCKETS[("UDP", localip, localport)]       
-    else:
-      # Get the socket
-      sock = _get_udp_socket(localip, localport)      
-      # Register this socket with nanny
-      nanny.tattle_add_item("outsockets", id(sock))
-    # Send the message
-    bytessent = sock.sendto(message, (destip, destport))
+      # Send the message. If the listening socket we borrowed was closed
+      # in the meantime, send from a pooled socket instead.
+      try:
+        bytessent = sock.sendto(message, (destip, destport))
+      except Exception:
+        _release_udp_send_socket(localip, localport, entry, True)
+        if _listening_socket_was_closed(localip, localport, sock, entry):
+          continue
+        raise
+
+      _release_udp_send_socket(localip, localport, entry, False)
+      break
 
     # Account for the resources
-    if _is_loopback_ipaddr(destip):
+    if dest_on_loopback:
       nanny.tattle_quantity('loopsend', bytessent + 64)
     else:
       nanny.tattle_quantity('netsend', bytessent + 64)
@@ -898,13 +1916,6 @@ def sendmessage(destip, destport, message, localip, localport):
 
   except Exception, e:
         
-    try:
-      # If we're borrowing the socket, closing is not appropriate.
-      if not ("UDP", localip, localport) in _BOUND_SOCKETS:
-        sock.close()
-    except:
-      pass
-
     # Check if address is already in use
     if _is_addr_in_use_exception(e):
       raise DuplicateTupleError("Provided Local IP and Local Port is already in use!")
@@ -919,6 +1930,150 @@ def sendmessage(destip, destport, message, localip, localport):
 
 
 
+# Public interface!!!
+def sendmessages(messagelist, localip, localport):
+  """
+   <Purpose>
+      Send a batch of messages from a single local IP / port. This is
+      equivalent to calling sendmessage() for each message, but the
+      arguments are checked and the resources are accounted for once
+      for the whole batch.
+
+   <Arguments>
+      messagelist:
+         A list of (destip, destport, message) tuples.
+      localip:
+         The local IP to send the messages from
+      localport:
+         The local port to send the messages from
+
+   <Exceptions>
+      As with sendmessage(). If an error occurs part way through the batch,
+      the messages before it have been sent and are accounted for.
+
+   <Side Effects>
+      None.
+
+   <Resource Consumption>
+      This operation consumes 64 bytes + number of bytes transmitted for
+      each message. This requires that the localport is allowed.
+
+   <Returns>
+      A list with the number of bytes sent for each message.
+  """
+  # Check the input arguments (type)
+  if type(messagelist) is not list:
+    raise RepyArgumentError("Provided messagelist must be a list!")
+  if type(localip) is not str:
+    raise RepyArgumentError("Provided localip must be a string!")
+  if type(localport) is not int:
+    raise RepyArgumentError("Provided localport must be an int!")
+
+  for item in messagelist:
+    if type(item) is not tuple or len(item) != 3:
+      raise RepyArgumentError("Provided messagelist must contain (destip, destport, message) tuples!")
+
+    destip, destport, message = item
+    if type(destip) is not str:
+      raise RepyArgumentError("Provided destip must be a string!")
+    if type(destport) is not int:
+      raise RepyArgumentError("Provided destport must be an int!")
+    if type(message) is not str:
+      raise RepyArgumentError("Provided message must be a string!")
+
+
+  # Check the input arguments (sanity)
+  if not _is_valid_ip_address(localip):
+    raise RepyArgumentError("Provided localip is not valid! IP: '"+localip+"'")
+  if not _is_valid_network_port(localport):
+    raise RepyArgumentError("Provided localport is not valid! Port: "+str(localport))
+
+  # Remember which destinations are on loopback for accounting
+  loopback_list = []
+  for destip, destport, message in messagelist:
+    if not _is_valid_ip_address(destip):
+      raise RepyArgumentError("Provided destip is not valid! IP: '"+destip+"'")
+    if not _is_valid_network_port(destport):
+      raise RepyArgumentError("Provided destport is not valid! Port: "+str(destport))
+
+    # Check that if localip == destip, then localport != destport
+    if localip == destip and localport == destport:
+      raise RepyArgumentError("Local socket name cannot match destination socket name! Local/Dest IP and Port match.")
+
+    loopback_list.append(_is_loopback_ipaddr(destip))
+
+  if not messagelist:
+    return []
+
+  # Check the input arguments (permission)
+  update_ip_cache()
+  if not _ip_is_allowed(localip):
+    raise ResourceForbiddenError("Provided localip is not allowed! IP: "+localip)
+
+  if not _is_allowed_localport("UDP", localport):
+    raise ResourceForbiddenError("Provided localport is not allowed! Port: "+str(localport))
+
+  # Wait for netsend / loopsend, once for the whole batch
+  if True in loopback_list:
+    nanny.tattle_quantity('loopsend', 0)
+  if False in loopback_list:
+    nanny.tattle_quantity('netsend', 0)
+
+  bytessent_list = []
+  loopsend = 0
+  netsend = 0
+
+  try:
+    while len(bytessent_list) < len(messagelist):
+      # Get a bound socket, this is the listening one if there is one
+      (sock, entry) = _get_udp_send_socket(localip, localport)
+
+      # Send the messages. If the listening socket we borrowed was closed
+      # in the meantime, send the rest from a pooled socket instead.
+      try:
+        for index in range(len(bytessent_list), len(messagelist)):
+          destip, destport, message = messagelist[index]
+          bytessent = sock.sendto(message, (destip, destport))
+          bytessent_list.append(bytessent)
+
+          if loopback_list[index]:
+            loopsend += bytessent + 64
+          else:
+            netsend += bytessent + 64
+
+      except Exception:
+        _release_udp_send_socket(localip, localport, entry, True)
+        if _listening_socket_was_closed(localip, localport, sock, entry):
+          continue
+        raise
+
+      _release_udp_send_socket(localip, localport, entry, False)
+
+    return bytessent_list
+
+  except Exception, e:
+
+    # Check if address is already in use
+    if _is_addr_in_use_exception(e):
+      raise DuplicateTupleError("Provided Local IP and Local Port is already in use!")
+
+    if _is_addr_unavailable_exception(e):
+      raise AddressBindingError("Cannot bind to the specified local ip, invalid!")
+
+    # Unknown error...
+    else:
+      raise
+
+  finally:
+    # Account for the resources of everything that was sent
+    if loopsend:
+      nanny.tattle_quantity('loopsend', loopsend)
+    if netsend:
+      nanny.tattle_quantity('netsend', netsend)
+
+
+
+
 # Public interface!!!
 def listenformessage(localip, localport):
   """
@@ -979,6 +2134,11 @@ def listenformessage(localip, localport):
 
   if not _is_allowed_localport("UDP", localport):
     raise ResourceForbiddenError("Provided localport is not allowed! Port: "+str(localport))
+
+  # Release sockets that were dropped without being closed, as they may
+  # hold the port or the insockets / outsockets we need
+  reclaim_sockets()
+
   # This identity tuple will be used to check for an existing connection with same identity
   identity = ("UDP", localip, localport, None, None)
 
@@ -986,6 +2146,18 @@ def listenformessage(localip, localport):
     # Check if localip is on loopback
     on_loopback = _is_loopback_ipaddr(localip) 
 
+    # A pooled send socket may be holding the address, close it first.
+    # If it is being sent on, give the sends a moment to finish.
+    _udp_send_pool_lock.acquire()
+    try:
+      entry = _close_pooled_udp_socket((localip, localport))
+    finally:
+      _udp_send_pool_lock.release()
+
+    waituntil = nonportable.getruntime() + RETRY_INTERVAL
+    while entry is not None and entry[2] > 0 and nonportable.getruntime() < waituntil:
+      time.sleep(0.001)
+
     # Get the socket
     sock = _get_udp_socket(localip,localport)
     
@@ -1024,47 +2196,346 @@ def listenformessage(localip, localport):
 
 
 ####################### Connection oriented #############################
-def _conn_alreadyexists_check(identity):
+
+##### Socket table cache
+
+# When a bind fails with EADDRINUSE, we look at the system socket table to
+# tell the user why. Reading the table (e.g. parsing /proc/net/tcp) is
+# slow, so a parsed and indexed snapshot is kept for SOCKET_TABLE_TTL
+# seconds and shared by all of the checks. On Linux, sock_diag netlink
+# queries are used instead where possible, these are exact and cheap.
+SOCKET_TABLE_TTL = 0.5 # In seconds
+
+_socket_table = None
+_socket_table_updated_at = None
+_socket_table_lock = threading.Lock()
+
+# The names of the TCP states, as used in /proc/net/tcp and sock_diag.
+# These match what netstat prints.
+_TCP_STATE_NAMES = {1:"ESTABLISHED", 2:"SYN_SENT", 3:"SYN_RECV", 4:"FIN_WAIT1",
+                    5:"FIN_WAIT2", 6:"TIME_WAIT", 7:"CLOSE", 8:"CLOSE_WAIT",
+                    9:"LAST_ACK", 10:"LISTEN", 11:"CLOSING"}
+_TCP_LISTEN = 10
+_TCP_CLOSE = 7
+
+# Netlink sock_diag constants, from linux/netlink.h and linux/sock_diag.h
+_NETLINK_SOCK_DIAG = 4
+_SOCK_DIAG_BY_FAMILY = 20
+_NLM_F_REQUEST = 0x1
+_NLM_F_DUMP = 0x300
+_NLMSG_ERROR = 0x2
+_NLMSG_DONE = 0x3
+_INET_DIAG_NOCOOKIE = 0xffffffff
+_NLMSG_HEADER = struct.Struct("=IHHII")
+_INET_DIAG_REQ = struct.Struct("=BBBBI")
+_INET_DIAG_PORTS = struct.Struct("!HH")
+_INET_DIAG_TAIL = struct.Struct("=III")
+
+# Set to False the first time sock_diag turns out not to be usable
+_sock_diag_available = hasattr(socket, "AF_NETLINK")
+
+
+class _SocketTable:
   """
-  <Purpose>
-    This private function checks if a socket that
-    got EADDRINUSE is because the socket is active,
-    or not
+  An indexed snapshot of the system's IPv4 TCP and UDP sockets.
+  """
+  __slots__ = ["outgoing", "listening"]
 
-  <Arguments>
-    identity: A tuple to check for cleanup
+  def __init__(self):
+    # Maps (localip, localport, remoteip, remoteport) -> state name
+    self.outgoing = {}
+    # A set of (is_tcp, localip, localport) for listening sockets.
+    # Unconnected UDP sockets count as listening.
+    self.listening = set()
+
+
+
+def _parse_proc_address(hexaddr):
+  # Converts an address like "0100007F:1F90" from /proc/net/* to an
+  # (ip, port) tuple. The IP is printed in host byte order.
+  hexip, hexport = hexaddr.split(":")
+  return (socket.inet_ntoa(struct.pack("=I", int(hexip, 16))), int(hexport, 16))
 
-  <Exceptions>
-    Raises DuplicateTupleError if the socket is actively being used.
 
-    Raises AddressBindingError if the binding is not allowed 
+
+def _read_socket_table():
+  """
+  <Purpose>
+    Reads a new socket table snapshot from /proc/net/tcp and /proc/net/udp.
 
   <Returns>
-    None
+    A _SocketTable, or None if the tables are not available.
   """
-  # Decompose the tuple
-  family, localip, localport, desthost, destport = identity
-  
-  # Check the sockets status
-  (exists, status) = nonportable.os_api.exists_outgoing_network_socket(localip,localport,desthost,destport)
+  table = _SocketTable()
+  for (filename, is_tcp) in [("/proc/net/tcp", True), ("/proc/net/udp", False)]:
+    try:
+      procfile = open(filename)
+      try:
+        lines = procfile.readlines()
+      finally:
+        procfile.close()
+    except (IOError, OSError):
+      return None
+
+    # The first line is a header
+    for line in lines[1:]:
+      fields = line.split()
+      if len(fields) < 4:
+        continue
+      localip, localport = _parse_proc_address(fields[1])
+      remoteip, remoteport = _parse_proc_address(fields[2])
+      state = int(fields[3], 16)
+
+      if is_tcp and state == _TCP_LISTEN:
+        table.listening.add((True, localip, localport))
+      elif not is_tcp and remoteport == 0:
+        table.listening.add((False, localip, localport))
+      else:
+        table.outgoing[(localip, localport, remoteip, remoteport)] = _TCP_STATE_NAMES.get(state, "UNKNOWN")
 
-  # Check if the socket is actively being used
-  # If the socket is these states:
-  #  ESTABLISHED : Connection is active
-  #  CLOSE_WAIT : Connection is closed, but waiting on local program to close
-  #  SYN_SENT (SENT) : Connection is just being established
-  if exists and ("ESTABLISH" in status or "CLOSE_WAIT" in status or "SENT" in status):
-    raise DuplicateTupleError("There is a duplicate connection which conflicts with the request!")
+  return table
 
-  # Otherwise, the socket is being cleaned up
-  raise AddressBindingError("Cannot bind to the specified local ip, invalid!")
 
 
-def _conn_cleanup_check(identity):
+def _get_socket_table(fresh=False):
   """
   <Purpose>
-    This private function checks if a socket that
-    got EADDRINUSE is because the socket is active,
+    Returns the socket table snapshot, reading a new one if the current
+    one is older than SOCKET_TABLE_TTL.
+
+  <Arguments>
+    fresh: If True, always read a new snapshot.
+
+  <Returns>
+    A (table, is_fresh) tuple. table is None if the socket table is not
+    available. is_fresh is True if the table was read by this call.
+  """
+  global _socket_table
+  global _socket_table_updated_at
+
+  _socket_table_lock.acquire()
+  try:
+    now = nonportable.getruntime()
+    if (not fresh and _socket_table is not None and
+        now - _socket_table_updated_at < SOCKET_TABLE_TTL):
+      return (_socket_table, False)
+
+    _socket_table = _read_socket_table()
+    _socket_table_updated_at = now
+    return (_socket_table, True)
+  finally:
+    _socket_table_lock.release()
+
+
+
+def _sock_diag_query(protocol, states, sockid=None):
+  """
+  <Purpose>
+    Queries the kernel's IPv4 socket table with a sock_diag netlink
+    request.
+
+  <Arguments>
+    protocol: socket.IPPROTO_TCP or socket.IPPROTO_UDP
+    states: A bitmask of the TCP states to return.
+    sockid: A (localip, localport, remoteip, remoteport) tuple to look up
+            exactly, or None to dump every matching socket.
+
+  <Returns>
+    A list of (state, localip, localport, remoteip, remoteport) tuples,
+    or None if sock_diag is not usable.
+  """
+  global _sock_diag_available
+
+  if sockid is None:
+    flags = _NLM_F_REQUEST | _NLM_F_DUMP
+    (localip, localport, remoteip, remoteport) = ("0.0.0.0", 0, "0.0.0.0", 0)
+  else:
+    flags = _NLM_F_REQUEST
+    (localip, localport, remoteip, remoteport) = sockid
+
+  request = (_INET_DIAG_REQ.pack(socket.AF_INET, protocol, 0, 0, states) +
+             _INET_DIAG_PORTS.pack(localport, remoteport) +
+             socket.inet_aton(localip) + "\0" * 12 +
+             socket.inet_aton(remoteip) + "\0" * 12 +
+             _INET_DIAG_TAIL.pack(0, _INET_DIAG_NOCOOKIE, _INET_DIAG_NOCOOKIE))
+  header = _NLMSG_HEADER.pack(_NLMSG_HEADER.size + len(request), _SOCK_DIAG_BY_FAMILY, flags, 1, 0)
+
+  try:
+    nlsock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, _NETLINK_SOCK_DIAG)
+  except socket.error:
+    _sock_diag_available = False
+    return None
+
+  results = []
+  try:
+    try:
+      nlsock.sendall(header + request)
+      while True:
+        data = nlsock.recv(65536)
+        offset = 0
+        while offset + _NLMSG_HEADER.size <= len(data):
+          (msglen, msgtype, msgflags, msgseq, msgpid) = _NLMSG_HEADER.unpack_from(data, offset)
+          if msglen < _NLMSG_HEADER.size:
+            return results
+
+          if msgtype == _NLMSG_DONE:
+            return results
+
+          if msgtype == _NLMSG_ERROR:
+            # A negative errno. ENOENT just means there is no such socket.
+            (error,) = struct.unpack_from("=i", data, offset + _NLMSG_HEADER.size)
+            if error == 0 or -error == errno.ENOENT:
+              return results
+            if sockid is None:
+              _sock_diag_available = False
+            return None
+
+          if msgtype == _SOCK_DIAG_BY_FAMILY:
+            # This is an inet_diag_msg
+            body = offset + _NLMSG_HEADER.size
+            state = ord(data[body + 1])
+            (sport, dport) = _INET_DIAG_PORTS.unpack_from(data, body + 4)
+            srcip = socket.inet_ntoa(data[body + 8:body + 12])
+            dstip = socket.inet_ntoa(data[body + 24:body + 28])
+            results.append((state, srcip, sport, dstip, dport))
+
+          # Messages are aligned to 4 bytes
+          offset += (msglen + 3) & ~3
+
+        # An exact lookup is answered in a single message
+        if sockid is not None:
+          return results
+
+    except socket.error:
+      _sock_diag_available = False
+      return None
+  finally:
+    nlsock.close()
+
+
+
+def _exists_outgoing_socket(localip, localport, remoteip, remoteport):
+  """
+  <Purpose>
+    Checks if a socket exists with the given local and remote address.
+    This is a faster replacement for
+    nonportable.os_api.exists_outgoing_network_socket().
+
+  <Returns>
+    An (exists, status) tuple, where status is the netstat-style name of
+    the socket state.
+  """
+  # Like nonportable, this only works for a full tuple
+  if not (localip and localport and remoteip and remoteport):
+    return (False, None)
+
+  sockid = (localip, localport, remoteip, remoteport)
+
+  if _sock_diag_available:
+    results = _sock_diag_query(socket.IPPROTO_TCP, 0xffffffff, sockid)
+    if results is not None:
+      for (state, srcip, sport, dstip, dport) in results:
+        return (True, _TCP_STATE_NAMES.get(state, "UNKNOWN"))
+      return (False, None)
+
+  (table, is_fresh) = _get_socket_table()
+  if table is None:
+    return nonportable.os_api.exists_outgoing_network_socket(localip, localport, remoteip, remoteport)
+
+  # A socket that is missing from an older snapshot may have been created
+  # since, so re-check against a new one before saying it doesn't exist.
+  if sockid not in table.outgoing and not is_fresh:
+    (table, is_fresh) = _get_socket_table(fresh=True)
+    if table is None:
+      return nonportable.os_api.exists_outgoing_network_socket(localip, localport, remoteip, remoteport)
+
+  if sockid in table.outgoing:
+    return (True, table.outgoing[sockid])
+  return (False, None)
+
+
+
+def _exists_listening_socket(localip, localport, is_tcp):
+  """
+  <Purpose>
+    Checks if there is a listening socket on the given local address,
+    including one listening on all addresses. This is a faster
+    replacement for nonportable.os_api.exists_listening_network_socket().
+
+  <Returns>
+    True if there is a listening socket, False otherwise.
+  """
+  if _sock_diag_available:
+    if is_tcp:
+      results = _sock_diag_query(socket.IPPROTO_TCP, 1 << _TCP_LISTEN)
+    else:
+      results = _sock_diag_query(socket.IPPROTO_UDP, 0xffffffff)
+
+    if results is not None:
+      for (state, srcip, sport, dstip, dport) in results:
+        if sport == localport and dport == 0 and srcip in (localip, "0.0.0.0"):
+          return True
+      return False
+
+  (table, is_fresh) = _get_socket_table()
+  if table is None:
+    return nonportable.os_api.exists_listening_network_socket(localip, localport, is_tcp)
+
+  def _is_listening(table):
+    return ((is_tcp, localip, localport) in table.listening or
+            (is_tcp, "0.0.0.0", localport) in table.listening)
+
+  # As above, re-check a negative result against a new snapshot
+  if not _is_listening(table) and not is_fresh:
+    (table, is_fresh) = _get_socket_table(fresh=True)
+    if table is None:
+      return nonportable.os_api.exists_listening_network_socket(localip, localport, is_tcp)
+
+  return _is_listening(table)
+
+
+
+def _conn_alreadyexists_check(identity):
+  """
+  <Purpose>
+    This private function checks if a socket that
+    got EADDRINUSE is because the socket is active,
+    or not
+
+  <Arguments>
+    identity: A tuple to check for cleanup
+
+  <Exceptions>
+    Raises DuplicateTupleError if the socket is actively being used.
+
+    Raises AddressBindingError if the binding is not allowed 
+
+  <Returns>
+    None
+  """
+  # Decompose the tuple
+  family, localip, localport, desthost, destport = identity
+  
+  # Check the sockets status
+  (exists, status) = _exists_outgoing_socket(localip,localport,desthost,destport)
+
+  # Check if the socket is actively being used
+  # If the socket is these states:
+  #  ESTABLISHED : Connection is active
+  #  CLOSE_WAIT : Connection is closed, but waiting on local program to close
+  #  SYN_SENT (SENT) : Connection is just being established
+  if exists and ("ESTABLISH" in status or "CLOSE_WAIT" in status or "SENT" in status):
+    raise DuplicateTupleError("There is a duplicate connection which conflicts with the request!")
+
+  # Otherwise, the socket is being cleaned up
+  raise AddressBindingError("Cannot bind to the specified local ip, invalid!")
+
+
+def _conn_cleanup_check(identity):
+  """
+  <Purpose>
+    This private function checks if a socket that
+    got EADDRINUSE is because the socket is active,
     or because the socket is listening or 
     because the socket is being cleaned up.
 
@@ -1088,7 +2559,7 @@ def _conn_cleanup_check(identity):
   family, localip, localport, desthost, destport = identity
   
   # Check the sockets status
-  (exists, status) = nonportable.os_api.exists_outgoing_network_socket(localip,localport,desthost,destport)
+  (exists, status) = _exists_outgoing_socket(localip,localport,desthost,destport)
 
   # Check if the socket is actively being used
   # If the socket is these states:
@@ -1100,13 +2571,108 @@ def _conn_cleanup_check(identity):
   else:
     # Checking if a listening TCP or UDP socket exists with given local address
     # The third argument is True if socket type is TCP,False if socket type is UDP 
-    if (nonportable.os_api.exists_listening_network_socket(localip, localport, (family == "TCP"))):
+    if (_exists_listening_socket(localip, localport, (family == "TCP"))):
       raise AlreadyListeningError("There is a listening socket on the provided localip and localport!")
       # Otherwise, the socket is being cleaned up
     else:
       raise CleanupInProgressError("The socket is being cleaned up by the operating system!")
 
 
+# These errors from a non-blocking connect mean that the connection
+# is still being established
+_CONNECT_IN_PROGRESS_ERRORS = ["EINPROGRESS", "EALREADY", "EWOULDBLOCK",
+                               "WSAEINPROGRESS", "WSAEALREADY", "WSAEWOULDBLOCK"]
+
+# The error numbers of the above on this platform
+_CONNECT_IN_PROGRESS_ERRNOS = frozenset([errnum for (errnum, errname) in errno.errorcode.items()
+                                         if errname in _CONNECT_IN_PROGRESS_ERRORS])
+
+
+def _is_connect_in_progress(errnum):
+  """
+  <Purpose>
+    Determines if an error number returned by a non-blocking connect
+    means the connection is still being established.
+
+  <Arguments>
+    errnum: The error number from connect_ex() or SO_ERROR.
+
+  <Returns>
+    True if the connect is in progress, False otherwise.
+  """
+  return (errnum in _CONNECT_IN_PROGRESS_ERRNOS)
+
+
+def _check_connect_error(errnum):
+  """
+  <Purpose>
+    Checks the result of a non-blocking connect, and raises the
+    appropriate exception if it failed.
+
+  <Arguments>
+    errnum: The error number from connect_ex() or SO_ERROR.
+
+  <Exceptions>
+    Raises DuplicateTupleError if the socket is already connected.
+    Raises InternetConnectivityError if the network is down.
+    Raises ConnectionRefusedError if the connection was refused.
+    Raises socket.error for any other non-recoverable error.
+
+  <Returns>
+    None, if the connect succeeded or may still succeed.
+  """
+  if errnum == 0:
+    return
+
+  error_category = _ERRNO_CATEGORIES.get(errnum)
+
+  # Check if we are already connected
+  if error_category is _ERROR_ALREADY_CONNECTED:
+    raise DuplicateTupleError("There is a duplicate connection which conflicts with the request!")
+
+  # Check if the network is down
+  if error_category is _ERROR_NETWORK_DOWN:
+    raise InternetConnectivityError("The network is down or cannot be reached from the local IP!")
+
+  # Check if the connection was refused
+  if error_category is _ERROR_CONN_REFUSED:
+    raise ConnectionRefusedError("The connection was refused!")
+
+  # Check if this is recoverable (in progress, try again, etc)
+  elif error_category is not _ERROR_RECOVERABLE:
+    raise socket.error(errnum, os.strerror(errnum))
+
+
+def _next_connect_wait(errnum, starttime, timeout):
+  """
+  <Purpose>
+    Decides what to do after a non-blocking connect returned errnum.
+
+  <Arguments>
+    errnum: The nonzero error number from connect_ex() or SO_ERROR.
+    starttime: The nonportable.getruntime() when connecting started.
+    timeout: Maximum time to try
+
+  <Exceptions>
+    Raises TimeoutError if we are out of time, or the errors of
+    _check_connect_error() if the connect failed.
+
+  <Returns>
+    A tuple (in_progress, remaining). If in_progress is True, the caller
+    should wait up to remaining seconds for the socket to become
+    writable, and then read SO_ERROR. Otherwise it should sleep briefly
+    and call connect_ex() again.
+  """
+  # Raises unless we may still connect
+  _check_connect_error(errnum)
+
+  remaining = timeout - (nonportable.getruntime() - starttime)
+  if remaining <= 0:
+    raise TimeoutError("Timed-out connecting to the remote host!")
+
+  return (_is_connect_in_progress(errnum), remaining)
+
+
 def _timed_conn_initialize(localip,localport,destip,destport, timeout):
   """
   <Purpose> 
@@ -1136,41 +2702,27 @@ def _timed_conn_initialize(localip,localport,destip,destport, timeout):
 
   # Get a TCP socket bound to the local ip / port
   sock = _get_tcp_socket(localip, localport)
-  sock.settimeout(timeout)
+  sock.setblocking(0)
 
   try:
-    # Try to connect until we timeout
-    connected = False
-    while nonportable.getruntime() - starttime < timeout:
-      try:
-        sock.connect((destip, destport))
-        connected = True
-        break
-      except Exception, e:
-        # Check if we are already connected
-        if _is_already_connected_exception(e):
-          connected = True     
-          raise DuplicateTupleError("There is a duplicate connection which conflicts with the request!")
-          break
+    # Start connecting, then wait for the connect to finish
+    errnum = sock.connect_ex((destip, destport))
 
-        # Check if the network is down
-        if _is_network_down_exception(e):
-          raise InternetConnectivityError("The network is down or cannot be reached from the local IP!")
+    while errnum != 0:
+      (in_progress, remaining) = _next_connect_wait(errnum, starttime, timeout)
 
-        # Check if the connection was refused
-        if _is_conn_refused_exception(e):
-          raise ConnectionRefusedError("The connection was refused!") 
+      if in_progress:
+        # Wait for exactly as long as we have left. The socket becomes
+        # writable once the connect has finished, one way or the other.
+        (read_will_block, write_will_block) = _check_socket_state(sock, "w", remaining)
+        if not write_will_block:
+          errnum = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
 
-        # Check if this is recoverable (try again, timeout, etc)
-        elif not _is_recoverable_network_exception(e):
-          raise
-
-        # Sleep and retry, avoid busy waiting
-        time.sleep(RETRY_INTERVAL)
-
-    # Check if we timed out
-    if not connected:
-      raise TimeoutError("Timed-out connecting to the remote host!")
+      else:
+        # A recoverable error other than the connect being in progress.
+        # Sleep briefly and retry, avoid busy waiting.
+        time.sleep(min(RETRY_INTERVAL, remaining))
+        errnum = sock.connect_ex((destip, destport))
 
     # Return the socket
     return sock
@@ -1181,69 +2733,55 @@ def _timed_conn_initialize(localip,localport,destip,destport, timeout):
     raise
 
 
-# Public interface!!!
-def openconnection(destip, destport,localip, localport, timeout):
+def _raise_openconnection_error(exceptionobj, identity):
   """
-    <Purpose>
-      Opens a connection, returning a socket-like object
-
-
-    <Arguments>
-      destip: The destination ip to open communications with
-
-      destport: The destination port to use for communication
-
-      localip: The local ip to use for the communication
-
-      localport: The local port to use for communication
-
-      timeout: The maximum amount of time to wait to connect.   This may
-               be a floating point number or an integer
-
-
-    <Exceptions>
-
-      RepyArgumentError if the arguments are invalid.   This includes both
-      the types and values of arguments. If the localip matches the destip,
-      and the localport matches the destport this will also be raised.
-
-      AddressBindingError (descends NetworkError) if the localip isn't 
-      associated with the local system or is not allowed.
-
-      ResourceForbiddenError (descends ResourceError) if the localport isn't 
-      allowed.
+  <Purpose>
+    Raises the appropriate exception for an error encountered while
+    opening an outgoing connection.
 
-      DuplicateTupleError (descends NetworkError) if the (localip, localport, 
-      destip, destport) tuple is already used.   This will also occur if the 
-      operating system prevents the local IP / port from being used.
+  <Arguments>
+    exceptionobj: The exception that was raised.
+    identity: The ("TCP", localip, localport, destip, destport) tuple of
+              the connection.
 
-      AlreadyListeningError if the (localip, localport) tuple is already used
-      for a listening TCP socket.
+  <Exceptions>
+    As with openconnection(). Unknown errors are re-raised.
 
-      CleanupInProgress if the (localip, localport, destip, destport) tuple is
-      still being cleaned up by the OS.
+  <Returns>
+    Never returns.
+  """
+  # Check if this an already in use error
+  if _is_addr_in_use_exception(exceptionobj):
+    # Call _conn_cleanup_check to determine if this is because
+    # the socket is being cleaned up or if it is actively being used
+    # This will always raise DuplicateTupleError or
+    # CleanupInProgressError or AlreadyListeningError
+    _conn_cleanup_check(identity)
 
-      ConnectionRefusedError (descends NetworkError) if the connection cannot 
-      be established because the destination port isn't being listened on.
+  # Check if this is a binding error
+  if _is_addr_unavailable_exception(exceptionobj):
+    # Call _conn_alreadyexists_check to determine if this is because
+    # the connection is active or not
+    _conn_alreadyexists_check(identity)
 
-      TimeoutError (common to all API functions that timeout) if the 
-      connection times out
+  # Unknown error...
+  raise exceptionobj
 
-      InternetConnectivityError if the network is down, or if the host
-      cannot be reached from the local IP that has been bound to.
 
+def _check_openconnection_args(destip, destport, localip, localport, timeout):
+  """
+  <Purpose>
+    Checks the arguments to openconnection(), including that the local
+    IP and port are allowed.
 
-    <Side Effects>
-      TODO
+  <Arguments>
+    As with openconnection().
 
-    <Resource Consumption>
-      This operation consumes 64*2 bytes of netsend (SYN, ACK) and 64 bytes 
-      of netrecv (SYN/ACK). This requires that the localport is allowed. Upon 
-      success, this call consumes an outsocket.
+  <Exceptions>
+    RepyArgumentError, ResourceForbiddenError as with openconnection().
 
-    <Returns>
-      A socket-like object that can be used for communication. Use send, 
-      recv, and close just like you would an actual socket object in python.
+  <Returns>
+    True if destip is a loopback address, False otherwise.
   """
   # Check the input arguments (type)
   if type(destip) is not str:
@@ -1261,7 +2799,8 @@ def openconnection(destip, destport,localip, localport, timeout):
 
 
   # Check the input arguments (sanity)
-  if not _is_valid_ip_address(destip):
+  (destip_valid, on_loopback, destip_int) = _get_address_info(destip)
+  if not destip_valid:
     raise RepyArgumentError("Provided destip is not valid! IP: '"+destip+"'")
   if not _is_valid_ip_address(localip):
     raise RepyArgumentError("Provided localip is not valid! IP: '"+localip+"'")
@@ -1286,63 +2825,371 @@ def openconnection(destip, destport,localip, localport, timeout):
   if not _is_allowed_localport("TCP", localport):
     raise ResourceForbiddenError("Provided localport is not allowed! Port: "+str(localport))
 
+  return on_loopback
+
+
+
+def _begin_openconnection(destip, destport, localip, localport, timeout):
+  """
+  <Purpose>
+    Does what openconnection() does before connecting. This is shared with
+    the asynchronous openconnection() in emulcomm_async.
+
+  <Arguments>
+    As with openconnection().
+
+  <Exceptions>
+    RepyArgumentError, ResourceForbiddenError as with openconnection().
+
+  <Side Effects>
+    Releases sockets that were dropped without being closed.
+
+  <Resource Consumption>
+    Waits for netsend / netrecv (or loopsend / looprecv).
+
+  <Returns>
+    A tuple (on_loopback, identity). identity is the ("TCP", localip,
+    localport, destip, destport) tuple of the connection.
+  """
+  on_loopback = _check_openconnection_args(destip, destport, localip, localport, timeout)
 
+  # Release sockets that were dropped without being closed, as they may
+  # hold the port or the insockets / outsockets we need
+  reclaim_sockets()
 
   # use this tuple during connection clean up check
   identity = ("TCP", localip, localport, destip, destport)
   
   # Wait for netsend / netrecv
-  if _is_loopback_ipaddr(destip):
+  if on_loopback:
     nanny.tattle_quantity('loopsend', 0)
     nanny.tattle_quantity('looprecv', 0)
   else:
     nanny.tattle_quantity('netsend', 0)
     nanny.tattle_quantity('netrecv', 0)
 
-  try:
-    # To Know if remote IP is on loopback or not
-    on_loopback = _is_loopback_ipaddr(destip)
+  return (on_loopback, identity)
 
-    # Get the socket
-    sock = _timed_conn_initialize(localip,localport,destip,destport, timeout)
-    
-    # Register this socket as an outsocket
-    nanny.tattle_add_item('outsockets',id(sock))
-  except Exception, e:
 
-    # Check if this an already in use error
-    if _is_addr_in_use_exception(e):
-      # Call _conn_cleanup_check to determine if this is because
-      # the socket is being cleaned up or if it is actively being used
-      # This will always raise DuplicateTupleError or
-      # CleanupInProgressError or AlreadyListeningError
-      _conn_cleanup_check(identity)
- 
-    # Check if this is a binding error
-    if _is_addr_unavailable_exception(e):
-      # Call _conn_alreadyexists_check to determine if this is because
-      # the connection is active or not
-      _conn_alreadyexists_check(identity)
-      
 
-    # Unknown error...
-    else:
-      raise
+def _finish_openconnection(sock, on_loopback):
+  """
+  <Purpose>
+    Does what openconnection() does once a socket has connected. This is
+    shared with the asynchronous openconnection() in emulcomm_async.
 
-  emul_sock = EmulatedSocket(sock, on_loopback)
+  <Arguments>
+    sock: The connected socket
+    on_loopback: As returned by _begin_openconnection()
+
+  <Exceptions>
+    ResourceExhaustedError if there are no outsockets left. The socket
+    is closed.
+
+  <Resource Consumption>
+    Consumes an outsocket, 64*2 bytes of netsend and 64 bytes of netrecv
+    (or loopsend / looprecv).
+
+  <Returns>
+    The EmulatedSocket.
+  """
+  # Register this socket as an outsocket
+  try:
+    _tattle_add_outsocket(id(sock))
+  except:
+    sock.close()
+    raise
+
+  emul_sock = EmulatedSocket(sock, on_loopback)
 
   # Tattle the resources used
-  if _is_loopback_ipaddr(destip):
+  if on_loopback:
     nanny.tattle_quantity('loopsend', 128)
     nanny.tattle_quantity('looprecv', 64)
   else:
     nanny.tattle_quantity('netsend', 128)
     nanny.tattle_quantity('netrecv', 64)
 
-  # Return the EmulatedSocket
   return emul_sock
 
 
+
+# Public interface!!!
+def openconnection(destip, destport,localip, localport, timeout):
+  """
+    <Purpose>
+      Opens a connection, returning a socket-like object
+
+
+    <Arguments>
+      destip: The destination ip to open communications with
+
+      destport: The destination port to use for communication
+
+      localip: The local ip to use for the communication
+
+      localport: The local port to use for communication
+
+      timeout: The maximum amount of time to wait to connect.   This may
+               be a floating point number or an integer
+
+
+    <Exceptions>
+
+      RepyArgumentError if the arguments are invalid.   This includes both
+      the types and values of arguments. If the localip matches the destip,
+      and the localport matches the destport this will also be raised.
+
+      AddressBindingError (descends NetworkError) if the localip isn't 
+      associated with the local system or is not allowed.
+
+      ResourceForbiddenError (descends ResourceError) if the localport isn't 
+      allowed.
+
+      DuplicateTupleError (descends NetworkError) if the (localip, localport, 
+      destip, destport) tuple is already used.   This will also occur if the 
+      operating system prevents the local IP / port from being used.
+
+      AlreadyListeningError if the (localip, localport) tuple is already used
+      for a listening TCP socket.
+
+      CleanupInProgress if the (localip, localport, destip, destport) tuple is
+      still being cleaned up by the OS.
+
+      ConnectionRefusedError (descends NetworkError) if the connection cannot 
+      be established because the destination port isn't being listened on.
+
+      TimeoutError (common to all API functions that timeout) if the 
+      connection times out
+
+      InternetConnectivityError if the network is down, or if the host
+      cannot be reached from the local IP that has been bound to.
+
+
+    <Side Effects>
+      TODO
+
+    <Resource Consumption>
+      This operation consumes 64*2 bytes of netsend (SYN, ACK) and 64 bytes 
+      of netrecv (SYN/ACK). This requires that the localport is allowed. Upon 
+      success, this call consumes an outsocket.
+
+    <Returns>
+      A socket-like object that can be used for communication. Use send, 
+      recv, and close just like you would an actual socket object in python.
+  """
+  (on_loopback, identity) = _begin_openconnection(destip, destport, localip, localport, timeout)
+
+  try:
+    # Get the socket
+    sock = _timed_conn_initialize(localip,localport,destip,destport, timeout)
+  except Exception, e:
+    _raise_openconnection_error(e, identity)
+
+  # Return the EmulatedSocket
+  return _finish_openconnection(sock, on_loopback)
+
+
+
+# Public interface!!!
+def openconnections(destlist, localip, localport, timeout):
+  """
+    <Purpose>
+      Races connections to several destinations, such as the advertised
+      locations of a node, and returns the first one to be established.
+      The others are abandoned.
+
+    <Arguments>
+      destlist: A list of (destip, destport) tuples to connect to.
+
+      localip: The local ip to use for the communication
+
+      localport: The local port to use for communication
+
+      timeout: The maximum amount of time to wait to connect.   This may
+               be a floating point number or an integer
+
+    <Exceptions>
+      As with openconnection(). If every connection fails, the exception
+      for the first destination that failed is raised. If none of them
+      fail before the timeout, TimeoutError is raised.
+
+    <Side Effects>
+      None.
+
+    <Resource Consumption>
+      This operation consumes 64 bytes of netsend (SYN) for each
+      destination tried, and 64 bytes of netsend (ACK) and 64 bytes of
+      netrecv (SYN/ACK) for the connection that is established. This
+      requires that the localport is allowed. Upon success, this call
+      consumes an outsocket.
+
+    <Returns>
+      A tuple containing: (destip, destport, socket object) for the
+      connection that was established.
+  """
+  # Check the input arguments (type)
+  if type(destlist) is not list:
+    raise RepyArgumentError("Provided destlist must be a list!")
+  if type(localip) is not str:
+    raise RepyArgumentError("Provided localip must be a string!")
+  if type(localport) is not int:
+    raise RepyArgumentError("Provided localport must be an int!")
+  if type(timeout) not in [float, int]:
+    raise RepyArgumentError("Provided timeout must be an int or float!")
+
+  for item in destlist:
+    if type(item) is not tuple or len(item) != 2:
+      raise RepyArgumentError("Provided destlist must contain (destip, destport) tuples!")
+    if type(item[0]) is not str:
+      raise RepyArgumentError("Provided destip must be a string!")
+    if type(item[1]) is not int:
+      raise RepyArgumentError("Provided destport must be an int!")
+
+
+  # Check the input arguments (sanity)
+  if len(destlist) == 0:
+    raise RepyArgumentError("Provided destlist must not be empty!")
+
+  if not _is_valid_ip_address(localip):
+    raise RepyArgumentError("Provided localip is not valid! IP: '"+localip+"'")
+  if not _is_valid_network_port(localport):
+    raise RepyArgumentError("Provided localport is not valid! Port: "+str(localport))
+
+  for destip, destport in destlist:
+    if not _is_valid_ip_address(destip):
+      raise RepyArgumentError("Provided destip is not valid! IP: '"+destip+"'")
+    if not _is_valid_network_port(destport):
+      raise RepyArgumentError("Provided destport is not valid! Port: "+str(destport))
+
+    # Check that if localip == destip, then localport != destport
+    if localip == destip and localport == destport:
+      raise RepyArgumentError("Local socket name cannot match destination socket name! Local/Dest IP and Port match.")
+
+  if timeout <= 0:
+    raise RepyArgumentError("Provided timeout is not valid, must be positive! Timeout: "+str(timeout))
+
+  # Check the input arguments (permission)
+  update_ip_cache()
+  if not _ip_is_allowed(localip):
+    raise ResourceForbiddenError("Provided localip is not allowed! IP: "+localip)
+
+  if not _is_allowed_localport("TCP", localport):
+    raise ResourceForbiddenError("Provided localport is not allowed! Port: "+str(localport))
+
+  # Release sockets that were dropped without being closed, as they may
+  # hold the port or the insockets / outsockets we need
+  reclaim_sockets()
+
+  # Wait for netsend / netrecv
+  loopsend = 0
+  netsend = 0
+  for destip, destport in destlist:
+    if _is_loopback_ipaddr(destip):
+      loopsend += 64
+    else:
+      netsend += 64
+
+  if loopsend:
+    nanny.tattle_quantity('loopsend', 0)
+    nanny.tattle_quantity('looprecv', 0)
+  if netsend:
+    nanny.tattle_quantity('netsend', 0)
+    nanny.tattle_quantity('netrecv', 0)
+
+  # Store our start time
+  starttime = nonportable.getruntime()
+
+  # Each attempt is a list of [destip, destport, socket, errnum]
+  attempts = []
+  winner = None
+  first_error = None
+
+  try:
+    # Start connecting to every destination at once
+    for destip, destport in destlist:
+      identity = ("TCP", localip, localport, destip, destport)
+      try:
+        sock = _get_tcp_socket(localip, localport)
+      except Exception, e:
+        _raise_openconnection_error(e, identity)
+      sock.setblocking(0)
+      attempts.append([destip, destport, sock, 0])
+      _readiness_engine.register(sock)
+
+      attempts[-1][3] = sock.connect_ex((destip, destport))
+      if attempts[-1][3] == 0:
+        winner = attempts[-1]
+        break
+
+    # Wait for the first connection to be established
+    while winner is None:
+      for attempt in attempts[:]:
+        destip, destport, sock, errnum = attempt
+        if errnum == 0 or _is_connect_in_progress(errnum):
+          continue
+
+        # This attempt has failed, remember why and drop it
+        attempts.remove(attempt)
+        _readiness_engine.unregister(sock)
+        sock.close()
+        try:
+          _check_connect_error(errnum)
+          # Recoverable errors, such as the connect timing out in the
+          # kernel, are not retried while racing
+          raise TimeoutError("Timed-out connecting to the remote host!")
+        except Exception, e:
+          if first_error is None:
+            first_error = (e, ("TCP", localip, localport, destip, destport))
+
+      if not attempts:
+        _raise_openconnection_error(*first_error)
+
+      remaining = timeout - (nonportable.getruntime() - starttime)
+      if remaining <= 0:
+        raise TimeoutError("Timed-out connecting to the remote host!")
+
+      # Each socket becomes writable once its connect has finished
+      readylist = _readiness_engine.wait([attempt[2] for attempt in attempts], "w", remaining)
+      readyattempts = [attempts[index] for index in readylist]
+      for attempt in readyattempts:
+        attempt[3] = attempt[2].getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if attempt[3] == 0:
+          winner = attempt
+          break
+
+    destip, destport, sock, errnum = winner
+
+    # Register this socket as an outsocket
+    _tattle_add_outsocket(id(sock))
+
+  finally:
+    # Abandon all the other attempts
+    for attempt in attempts:
+      if attempt is not winner:
+        _readiness_engine.unregister(attempt[2])
+        attempt[2].close()
+
+    # Every attempt sent a SYN
+    if loopsend:
+      nanny.tattle_quantity('loopsend', loopsend)
+    if netsend:
+      nanny.tattle_quantity('netsend', netsend)
+
+  on_loopback = _is_loopback_ipaddr(destip)
+  emul_sock = EmulatedSocket(sock, on_loopback)
+
+  # Tattle the resources used by the established connection
+  if on_loopback:
+    nanny.tattle_quantity('loopsend', 64)
+    nanny.tattle_quantity('looprecv', 64)
+  else:
+    nanny.tattle_quantity('netsend', 64)
+    nanny.tattle_quantity('netrecv', 64)
+
+  return (destip, destport, emul_sock)
+
+
 def listenforconnection(localip, localport):
   """
   <Purpose>
@@ -1375,6 +3222,31 @@ def listenforconnection(localip, localport):
   <Returns>
     A TCPServerSocket object.
   """
+  _check_listenforconnection_args(localip, localport)
+
+  # Release sockets that were dropped without being closed, as they may
+  # hold the port or the insockets / outsockets we need
+  reclaim_sockets()
+
+  return _listen_tcp(localip, localport, False)
+
+
+
+def _check_listenforconnection_args(localip, localport):
+  """
+  <Purpose>
+    Checks the arguments to listenforconnection(), including that the
+    local IP and port are allowed.
+
+  <Arguments>
+    As with listenforconnection().
+
+  <Exceptions>
+    RepyArgumentError, ResourceForbiddenError as with listenforconnection().
+
+  <Returns>
+    None
+  """
   # Check the input arguments (type)
   if type(localip) is not str:
     raise RepyArgumentError("Provided localip must be a string!")
@@ -1399,6 +3271,24 @@ def listenforconnection(localip, localport):
   if not _is_allowed_localport("TCP", localport):
     raise ResourceForbiddenError("Provided localport is not allowed! Port: "+str(localport))
 
+
+
+def _listen_tcp(localip, localport, reuseport):
+  """
+  <Purpose>
+    Creates a listening TCP socket, once the arguments have been checked.
+
+  <Arguments>
+    localip: The local IP to listen on
+    localport: The local port to listen on
+    reuseport: If True, the socket is set to SO_REUSEPORT
+
+  <Exceptions>
+    As with listenforconnection().
+
+  <Returns>
+    A TCPServerSocket object.
+  """
   # This is used to check if there is an existing connection with the same identity
   identity = ("TCP", localip, localport, None, None) 
 
@@ -1406,17 +3296,16 @@ def listenforconnection(localip, localport):
     # Check if localip is on loopback
     on_loopback = _is_loopback_ipaddr(localip)
     # Get the socket
-    sock = _get_tcp_socket(localip,localport)     
+    sock = _get_tcp_socket(localip, localport, reuseport)
     nanny.tattle_add_item('insockets',id(sock))
     # Get the maximum number of outsockets
     max_outsockets = nanny.get_resource_limit("outsockets")        
-    # If we have restrictions, then we want to set the outsocket
-    # limit
+    # If we have restrictions, then we don't want a backlog of more
+    # connections than we could accept
     if max_outsockets:
-      # Set the backlog to be the maximum number of outsockets
-      sock.listen(max_outsockets)
+      sock.listen(min(LISTEN_BACKLOG, int(max_outsockets)))
     else:
-      sock.listen(5)
+      sock.listen(LISTEN_BACKLOG)
 
   except Exception, e:
     
@@ -1443,52 +3332,251 @@ def listenforconnection(localip, localport):
   return server_sock
 
 
-# Private method to create a TCP socket and bind
-# to a localip and localport.
-# 
-def _get_tcp_socket(localip, localport):
-  # Create the TCP socket
-  s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)  
-  # Reuse the socket if it's "pseudo-availible"
-  s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 
-  if localip and localport:
-    try:
-      s.bind((localip,localport))
-    except: # Raise the exception un-tainted
-      # don't leak sockets
-      s.close()
-      raise
-  return s
+def listenforconnections(localip, localport, count):
+  """
+  <Purpose>
+    Sets up several TCPServerSockets listening on the same address, using
+    SO_REUSEPORT, so that each can be served by its own thread. The
+    kernel spreads the incoming connections over them.
+
+  <Arguments>
+    localip:
+        The local IP to listen on
+    localport:
+        The local port to listen on
+    count:
+        The number of TCPServerSockets to create
 
+  <Exceptions>
+    As with listenforconnection(). AlreadyListeningError is also raised
+    if anything is listening on the address already.
 
-# Private method to create a UDP socket and bind
-# to a localip and localport.
-# 
-def _get_udp_socket(localip, localport):
-  # Create the UDP socket
-  s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-  if localip and localport:
-    try:
-      s.bind((localip, localport))
-    except:
-      # don't leak sockets
-      s.close()
-      raise
-  return s
+  <Side Effects>
+    The IP / Port combination cannot be used until all the
+    TCPServerSockets are closed.
 
+  <Resource Consumption>
+    Uses an insocket for each TCPServerSocket.
 
-# Checks if the given real socket would block
-def _check_socket_state(realsock, waitfor="rw", timeout=0.0):
+  <Returns>
+    A list of TCPServerSocket objects. This has only one if the platform
+    does not support SO_REUSEPORT.
   """
-  <Purpose>
-    Checks if the given socket would block on a send() or recv().
-    In the case of a listening socket, read_will_block equates to
-    accept_will_block.
+  if type(count) is not int:
+    raise RepyArgumentError("Provided count must be a int!")
+  if count < 1:
+    raise RepyArgumentError("Provided count must be positive! Count: "+str(count))
 
-  <Arguments>
-    realsock:
-              A real socket.socket() object to check for.
+  if _SO_REUSEPORT is None:
+    return [listenforconnection(localip, localport)]
+
+  _check_listenforconnection_args(localip, localport)
+
+  # Release sockets that were dropped without being closed, as they may
+  # hold the port or the insockets / outsockets we need
+  reclaim_sockets()
+
+  # The kernel would let us join another set of SO_REUSEPORT sockets
+  if _exists_listening_socket(localip, localport, True):
+    raise AlreadyListeningError("There is a listening socket on the provided localip and localport!")
+
+  server_socks = []
+  try:
+    for index in range(count):
+      server_socks.append(_listen_tcp(localip, localport, True))
+  except:
+    for server_sock in server_socks:
+      server_sock.close()
+    raise
+
+  return server_socks
+
+
+
+####################### Socket readiness #############################
+
+# Public interface!!!
+def waitforsockets(socketlist, waitfor, timeout):
+  """
+  <Purpose>
+    Blocks until at least one of the given sockets is ready, so that
+    programs do not have to spin on SocketWouldBlockError.
+
+  <Arguments>
+    socketlist:
+        A list of socket-like objects returned by openconnection,
+        listenforconnection, getconnection or listenformessage.
+    waitfor:
+        "r" to wait until a socket is readable, "w" to wait until a
+        socket is writable, or "rw" for either. For TCPServerSockets and
+        UDPServerSockets, readable means that getconnection() or
+        getmessage() would not block.
+    timeout:
+        The maximum amount of time to wait. This may be a floating point
+        number or an integer.
+
+  <Exceptions>
+    RepyArgumentError if the arguments are invalid.
+
+  <Side Effects>
+    None.
+
+  <Resource Consumption>
+    Waits until the netrecv / looprecv (and netsend / loopsend when
+    waiting for writability) resources of the sockets are available.
+    With traffic shaping, also waits until the token buckets of those
+    resources have refilled.
+
+  <Returns>
+    A list of the indices into socketlist of the sockets that are ready.
+    Sockets that have been closed are always ready. The list is empty if
+    the timeout expired.
+  """
+  # Check the input arguments (type)
+  if type(socketlist) is not list:
+    raise RepyArgumentError("Provided socketlist must be a list!")
+
+  if type(waitfor) is not str:
+    raise RepyArgumentError("Provided waitfor must be a string!")
+
+  if type(timeout) not in [float, int]:
+    raise RepyArgumentError("Provided timeout must be an int or float!")
+
+  # Check the input arguments (sanity)
+  if len(socketlist) == 0:
+    raise RepyArgumentError("Provided socketlist must not be empty!")
+
+  for sockobj in socketlist:
+    if not isinstance(sockobj, (EmulatedSocket, TCPServerSocket, UDPServerSocket)):
+      raise RepyArgumentError("Provided socketlist must only contain sockets!")
+
+  if waitfor not in ["r", "w", "rw"]:
+    raise RepyArgumentError("Provided waitfor must be 'r', 'w' or 'rw'!")
+
+  if timeout < 0:
+    raise RepyArgumentError("Provided timeout is not valid, must be non-negative! Timeout: "+str(timeout))
+
+  # Wait for resources, so that a program that is over its limits
+  # cannot use this to get around them
+  resources = set()
+  for sockobj in socketlist:
+    if sockobj.on_loopback:
+      if "r" in waitfor:
+        resources.add('looprecv')
+      if "w" in waitfor:
+        resources.add('loopsend')
+    else:
+      if "r" in waitfor:
+        resources.add('netrecv')
+      if "w" in waitfor:
+        resources.add('netsend')
+
+  for resource in resources:
+    nanny.tattle_quantity(resource, 0)
+
+  # Get the real sockets. Closed sockets are ready immediately, since the
+  # next call on them will raise SocketClosedLocal.
+  realsocks = []
+  for index in range(len(socketlist)):
+    realsock = socketlist[index].socketobj
+    if realsock is None:
+      return [index]
+    realsocks.append(realsock)
+
+  # If the traffic shaper has no tokens for any of the sockets, they are
+  # not usable yet even if they are ready, so sleep until it refills.
+  delay = _shaping_delay(socketlist, waitfor)
+  if delay > 0:
+    if delay >= timeout:
+      time.sleep(timeout)
+      return []
+    time.sleep(delay)
+    timeout -= delay
+
+  return _readiness_engine.wait(realsocks, waitfor, timeout)
+
+
+
+# Public interface!!!
+def waitforsocket(sockobj, waitfor, timeout):
+  """
+  <Purpose>
+    Blocks until the given socket is ready. See waitforsockets().
+
+  <Arguments>
+    sockobj:
+        A socket-like object.
+    waitfor:
+        "r", "w" or "rw", as with waitforsockets().
+    timeout:
+        The maximum amount of time to wait.
+
+  <Exceptions>
+    RepyArgumentError if the arguments are invalid.
+
+  <Side Effects>
+    None.
+
+  <Resource Consumption>
+    As with waitforsockets().
+
+  <Returns>
+    True if the socket is ready, False if the timeout expired.
+  """
+  return len(waitforsockets([sockobj], waitfor, timeout)) > 0
+
+
+# Private method to create a TCP socket and bind
+# to a localip and localport.
+# 
+def _get_tcp_socket(localip, localport, reuseport=False):
+  # Create the TCP socket
+  s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)  
+  # Reuse the socket if it's "pseudo-availible"
+  s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+
+  # Let other shards listen on the same address
+  if reuseport:
+    s.setsockopt(socket.SOL_SOCKET, _SO_REUSEPORT, 1)
+
+  if localip and localport:
+    try:
+      s.bind((localip,localport))
+    except: # Raise the exception un-tainted
+      # don't leak sockets
+      s.close()
+      raise
+  return s
+
+
+# Private method to create a UDP socket and bind
+# to a localip and localport.
+# 
+def _get_udp_socket(localip, localport):
+  # Create the UDP socket
+  s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+  if localip and localport:
+    try:
+      s.bind((localip, localport))
+    except:
+      # don't leak sockets
+      s.close()
+      raise
+  return s
+
+
+# Checks if the given real socket would block
+def _check_socket_state(realsock, waitfor="rw", timeout=0.0):
+  """
+  <Purpose>
+    Checks if the given socket would block on a send() or recv().
+    In the case of a listening socket, read_will_block equates to
+    accept_will_block.
+
+  <Arguments>
+    realsock:
+              A real socket.socket() object to check for.
 
     waitfor:
               An optional specifier of what to wait for. "r" for read only, "w" for write only,
@@ -1511,33 +3599,1361 @@ def _check_socket_state(realsock, waitfor="rw", timeout=0.0):
   if waitfor not in ["rw","r","w"]:
     raise Exception, "Illegal waitfor argument!"
 
-  # Array to hold the socket
-  sock_array = [realsock]
+  # Block on the readiness engine rather than in select(), so that we
+  # are woken up along with any other threads waiting on this socket.
+  # Sockets that are not wrapped yet are not tracked by the engine.
+  if timeout > 0 and _readiness_engine.is_registered(realsock):
+    _readiness_engine.wait([realsock], waitfor, timeout)
+    timeout = 0.0
+
+  # select() can't handle file descriptors of FD_SETSIZE (usually 1024)
+  # or more, which we reach with many sockets open, so use poll() where
+  # it is available.
+  if hasattr(select, "poll"):
+    mask = 0
+    if "r" in waitfor:
+      mask |= select.POLLIN | select.POLLPRI
+    if "w" in waitfor:
+      mask |= select.POLLOUT
+
+    poller = select.poll()
+    poller.register(realsock, mask)
+    events = poller.poll(int(timeout * 1000 + 0.999))
+
+    event = 0
+    for (fd, fdevent) in events:
+      event |= fdevent
+
+    # If the socket has an error, then assume its both read and writable
+    if event & (select.POLLERR | select.POLLHUP | select.POLLNVAL):
+      return (False, False)
+
+    return (not event & (select.POLLIN | select.POLLPRI), not event & select.POLLOUT)
+
+  # Array to hold the socket
+  sock_array = [realsock]
+
+  # Generate the read/write arrays
+  read_array = []
+  if "r" in waitfor:
+    read_array = sock_array
+
+  write_array = []
+  if "w" in waitfor:
+    write_array = sock_array
+
+  # Call select()
+  (readable, writeable, exception) = select.select(read_array,write_array,sock_array,timeout)
+
+  # If the socket is in the exception list, then assume its both read and writable
+  if (realsock in exception):
+    return (False, False)
+
+  # Return normally then
+  return (realsock not in readable, realsock not in writeable)
+
+
+
+##### Socket statistics
+
+# Per-socket statistics are kept for every socket created while this is
+# True. Set it to False to take the bookkeeping off the hot path; sockets
+# created before the change keep their statistics.
+SOCKET_STATISTICS_ENABLED = True
+
+# The latency histograms split each power of two into this many linear
+# buckets, so a recorded latency is off by at most 1 / 2**bits of itself.
+_HISTOGRAM_SUB_BUCKET_BITS = 2
+_HISTOGRAM_SUB_BUCKETS = 1 << _HISTOGRAM_SUB_BUCKET_BITS
+
+# The percentiles included in a statistics snapshot
+_SNAPSHOT_PERCENTILES = [50.0, 90.0, 99.0, 99.9]
+
+# Maps id(stats) -> _SocketStatistics for every open socket
+_socket_statistics = {}
+_socket_statistics_lock = threading.Lock()
+
+# The nanny resources each kind of socket operation waits on
+_LOOPBACK_RESOURCES = ('looprecv', 'loopsend')
+_NETWORK_RESOURCES = ('netrecv', 'netsend')
+_LOOPBACK_RECV_RESOURCES = ('looprecv',)
+_NETWORK_RECV_RESOURCES = ('netrecv',)
+
+
+class _LatencyHistogram:
+  """
+  A sparse log-linear histogram of latencies, in the style of
+  HdrHistogram. Values are recorded in whole microseconds. Values below
+  2 * _HISTOGRAM_SUB_BUCKETS get a bucket each, above that every power
+  of two is split into _HISTOGRAM_SUB_BUCKETS buckets. Recording is a
+  bit_length() and a dict update.
+
+  This is not thread safe, the owner must serialize calls to record().
+  """
+  __slots__ = ["counts", "total", "maxvalue"]
+
+  def __init__(self):
+    # Maps bucket index -> count
+    self.counts = {}
+    self.total = 0
+    self.maxvalue = 0
+
+
+  def record(self, seconds):
+    value = int(seconds * 1000000)
+    if value < 0:
+      value = 0
+
+    shift = value.bit_length() - _HISTOGRAM_SUB_BUCKET_BITS - 1
+    if shift <= 0:
+      bucket = value
+    else:
+      bucket = (shift << _HISTOGRAM_SUB_BUCKET_BITS) + (value >> shift)
+
+    counts = self.counts
+    counts[bucket] = counts.get(bucket, 0) + 1
+    self.total += 1
+    if value > self.maxvalue:
+      self.maxvalue = value
+
+
+  def _bucket_upper_bound(self, bucket):
+    # Returns the largest value, in microseconds, that lands in bucket
+    if bucket < 2 * _HISTOGRAM_SUB_BUCKETS:
+      return bucket
+    shift = (bucket >> _HISTOGRAM_SUB_BUCKET_BITS) - 1
+    top = (bucket & (_HISTOGRAM_SUB_BUCKETS - 1)) + _HISTOGRAM_SUB_BUCKETS
+    return ((top + 1) << shift) - 1
+
+
+  def percentile(self, percent):
+    """
+    Returns the latency, in microseconds, that percent of the recorded
+    values are at or below, or 0 if nothing has been recorded.
+    """
+    if self.total == 0:
+      return 0
+
+    # The rank of the value we are looking for, rounded up
+    rank = max(1, int(self.total * percent / 100.0 + 0.999999))
+    seen = 0
+    for bucket in sorted(self.counts):
+      seen += self.counts[bucket]
+      if seen >= rank:
+        return min(self._bucket_upper_bound(bucket), self.maxvalue)
+
+    return self.maxvalue
+
+
+
+class _SocketStatistics:
+  """
+  Counters for a single socket. These are only updated while the
+  socket lock is held, so they need no locking of their own.
+  """
+  __slots__ = ["kind", "localaddr", "remoteaddr", "createdat", "calls",
+               "bytes_in", "bytes_out", "would_block", "nanny_wait_time",
+               "lock_wait_time", "latency"]
+
+  def __init__(self, kind, localaddr, remoteaddr):
+    self.kind = kind
+    self.localaddr = localaddr
+    self.remoteaddr = remoteaddr
+    self.createdat = time.time()
+    self.calls = 0
+    self.bytes_in = 0
+    self.bytes_out = 0
+    self.would_block = 0
+    self.nanny_wait_time = 0.0
+    self.lock_wait_time = 0.0
+    self.latency = _LatencyHistogram()
+
+
+  def snapshot(self):
+    """
+    Returns the statistics as a dict. Latencies are in microseconds,
+    wait times are in seconds.
+    """
+    latency = self.latency
+    result = {"kind" : self.kind,
+              "localaddr" : self.localaddr,
+              "remoteaddr" : self.remoteaddr,
+              "age" : time.time() - self.createdat,
+              "calls" : self.calls,
+              "bytes_in" : self.bytes_in,
+              "bytes_out" : self.bytes_out,
+              "would_block" : self.would_block,
+              "nanny_wait_time" : self.nanny_wait_time,
+              "lock_wait_time" : self.lock_wait_time,
+              "latency_max" : latency.maxvalue}
+    for percent in _SNAPSHOT_PERCENTILES:
+      result["latency_p" + str(percent).rstrip("0").rstrip(".")] = latency.percentile(percent)
+    return result
+
+
+
+def _new_socket_statistics(kind, sock, connected):
+  """
+  <Purpose>
+    Creates and registers the statistics for a new socket.
+
+  <Arguments>
+    kind: A short name for the type of socket, e.g. "tcp"
+    sock: The real socket
+    connected: Is the socket connected to a remote end?
+
+  <Returns>
+    A _SocketStatistics, or None if statistics are disabled.
+  """
+  if not SOCKET_STATISTICS_ENABLED:
+    return None
+
+  localaddr = remoteaddr = None
+  try:
+    localaddr = sock.getsockname()
+    if connected:
+      remoteaddr = sock.getpeername()
+  except socket.error:
+    pass
+
+  stats = _SocketStatistics(kind, localaddr, remoteaddr)
+  _socket_statistics_lock.acquire()
+  try:
+    _socket_statistics[id(stats)] = stats
+  finally:
+    _socket_statistics_lock.release()
+
+  return stats
+
+
+
+def _forget_socket_statistics(stats):
+  # Stops reporting the statistics of a closed socket
+  _socket_statistics_lock.acquire()
+  try:
+    _socket_statistics.pop(id(stats), None)
+  finally:
+    _socket_statistics_lock.release()
+
+
+
+def _begin_socket_operation(self, resources):
+  """
+  <Purpose>
+    Waits for the given nanny resources, then acquires the socket lock.
+    The wait is skipped if the socket's accounting buffer waited
+    recently and has not charged nanny since. If the socket keeps
+    statistics, the time spent in each is recorded.
+
+  <Arguments>
+    self: An EmulatedSocket, UDPServerSocket or TCPServerSocket
+    resources: The nanny resources to wait on
+
+  <Returns>
+    The time the operation started, or None if the socket does not keep
+    statistics. This should be passed to _end_socket_operation().
+  """
+  stats = self.stats
+  accounting = self.accounting
+  if stats is None:
+    if accounting is None or accounting.should_wait():
+      for resource in resources:
+        nanny.tattle_quantity(resource, 0)
+      if accounting is not None:
+        accounting.waited()
+    self.sock_lock.acquire()
+    return None
+
+  starttime = time.time()
+  if accounting is None or accounting.should_wait():
+    for resource in resources:
+      nanny.tattle_quantity(resource, 0)
+    if accounting is not None:
+      accounting.waited()
+  waitedtime = time.time()
+  self.sock_lock.acquire()
+
+  stats.nanny_wait_time += waitedtime - starttime
+  stats.lock_wait_time += time.time() - waitedtime
+  return starttime
+
+
+
+def _end_socket_operation(self, starttime):
+  """
+  <Purpose>
+    Records the operation started by _begin_socket_operation(), and
+    releases the socket lock.
+
+  <Arguments>
+    self: The socket passed to _begin_socket_operation()
+    starttime: The value returned by _begin_socket_operation()
+
+  <Returns>
+    None
+  """
+  if starttime is not None:
+    stats = self.stats
+    stats.calls += 1
+    stats.latency.record(time.time() - starttime)
+  self.sock_lock.release()
+
+
+
+def get_socket_statistics():
+  """
+  <Purpose>
+    Returns the statistics of every open socket that keeps them. This is
+    only meant for the trusted side, it is not exported to user code.
+
+  <Arguments>
+    None
+
+  <Exceptions>
+    None
+
+  <Side Effects>
+    None
+
+  <Returns>
+    A list of dicts, see _SocketStatistics.snapshot().
+  """
+  _socket_statistics_lock.acquire()
+  try:
+    statslist = _socket_statistics.values()
+  finally:
+    _socket_statistics_lock.release()
+
+  return [stats.snapshot() for stats in statslist]
+
+
+
+def _format_socket_statistics(snapshot):
+  # Returns a one line summary of a statistics snapshot
+  return ("%(kind)s local=%(localaddr)s remote=%(remoteaddr)s calls=%(calls)d "
+          "in=%(bytes_in)d out=%(bytes_out)d wouldblock=%(would_block)d "
+          "nannywait=%(nanny_wait_time).3fs lockwait=%(lock_wait_time).3fs "
+          "p50=%(latency_p50)dus p99=%(latency_p99)dus max=%(latency_max)dus") % snapshot
+
+
+
+def _statistics_dump_loop(interval):
+  # servicelogger is only available when running under the nodemanager,
+  # so it is imported here rather than at the top.
+  import servicelogger
+
+  while True:
+    time.sleep(interval)
+    try:
+      for snapshot in get_socket_statistics():
+        servicelogger.log("[socket statistics] " + _format_socket_statistics(snapshot))
+    except Exception:
+      # Never let a logging problem kill the dump thread
+      pass
+
+
+
+def start_statistics_dump(interval):
+  """
+  <Purpose>
+    Starts a thread which writes the statistics of every open socket to
+    the service log every interval seconds.
+
+  <Arguments>
+    interval: The number of seconds between dumps.
+
+  <Exceptions>
+    None
+
+  <Side Effects>
+    Starts a daemon thread.
+
+  <Returns>
+    None
+  """
+  dumper = threading.Thread(target=_statistics_dump_loop, args=(interval,), name="SocketStatisticsDump")
+  dumper.setDaemon(True)
+  dumper.start()
+
+
+
+##### Batched resource accounting
+
+# Socket operations charge nanny through a per-socket buffer, so nanny's
+# locks are taken once per batch rather than several times per call.
+# At most ACCOUNTING_BATCH_BYTES of charges are pending, over all sockets
+# and resources together: a socket passes its charges on to nanny once
+# the total reaches that, or once its oldest pending charge is
+# ACCOUNTING_FLUSH_INTERVAL seconds old. A background thread flushes
+# buffers of idle sockets, so every byte reaches nanny within about
+# 2 * ACCOUNTING_FLUSH_INTERVAL seconds. Setting ACCOUNTING_BATCH_BYTES
+# to 0 makes sockets created afterwards charge nanny directly.
+ACCOUNTING_BATCH_BYTES = 16 * 1024
+ACCOUNTING_FLUSH_INTERVAL = 0.05 # In seconds
+
+# Maps id(buffer) -> _AccountingBuffer for every buffer with pending
+# charges, and the total of those charges. Both are protected by
+# _pending_accounting_lock.
+_pending_accounting = {}
+_pending_accounting_bytes = 0
+_pending_accounting_lock = threading.Lock()
+
+# Is the thread that flushes idle buffers running?
+_accounting_flusher_started = False
+_accounting_flusher_lock = threading.Lock()
+
+
+class _AccountingBuffer:
+  """
+  Holds the charges of one socket that have not been passed on to nanny
+  yet. The pending charges are only changed while the socket lock is
+  held.
+  """
+  __slots__ = ["lock", "recv_resource", "send_resource", "recv_pending",
+               "send_pending", "pending_since", "waited_at", "charged"]
+
+  def __init__(self, lock, on_loopback):
+    # The lock of the socket this buffer belongs to
+    self.lock = lock
+    if on_loopback:
+      self.recv_resource = 'looprecv'
+      self.send_resource = 'loopsend'
+    else:
+      self.recv_resource = 'netrecv'
+      self.send_resource = 'netsend'
+    self.recv_pending = 0
+    self.send_pending = 0
+    self.pending_since = 0.0
+    # When the socket last waited on nanny, and whether nanny has been
+    # charged for it since
+    self.waited_at = 0.0
+    self.charged = False
+
+
+  def charge(self, recvamount, sendamount):
+    global _pending_accounting_bytes
+
+    if not (recvamount or sendamount):
+      return
+
+    now = time.time()
+    if not (self.recv_pending or self.send_pending):
+      self.pending_since = now
+
+    self.recv_pending += recvamount
+    self.send_pending += sendamount
+
+    _pending_accounting_lock.acquire()
+    try:
+      _pending_accounting[id(self)] = self
+      _pending_accounting_bytes += recvamount + sendamount
+      totalpending = _pending_accounting_bytes
+    finally:
+      _pending_accounting_lock.release()
+
+    if (totalpending >= ACCOUNTING_BATCH_BYTES or
+        now - self.pending_since >= ACCOUNTING_FLUSH_INTERVAL):
+      self.flush()
+    elif not _accounting_flusher_started:
+      _start_accounting_flusher()
+
+
+  def take(self):
+    # Returns the pending (recvamount, sendamount) and clears them. The
+    # socket lock must be held.
+    global _pending_accounting_bytes
+
+    recvamount = self.recv_pending
+    sendamount = self.send_pending
+    self.recv_pending = 0
+    self.send_pending = 0
+
+    _pending_accounting_lock.acquire()
+    try:
+      _pending_accounting.pop(id(self), None)
+      _pending_accounting_bytes -= recvamount + sendamount
+    finally:
+      _pending_accounting_lock.release()
+
+    return (recvamount, sendamount)
+
+
+  def tattle(self, recvamount, sendamount):
+    # Passes charges from take() on to nanny. Charging a resource also
+    # waits for it, if it is oversubscribed, so this need not hold the
+    # socket lock.
+    if recvamount:
+      nanny.tattle_quantity(self.recv_resource, recvamount)
+    if sendamount:
+      nanny.tattle_quantity(self.send_resource, sendamount)
+    if recvamount or sendamount:
+      self.charged = True
+
+
+  def flush(self):
+    # Passes the pending charges on to nanny. The socket lock must be held.
+    (recvamount, sendamount) = self.take()
+    self.tattle(recvamount, sendamount)
+
+
+  def should_wait(self):
+    # The nanny waits are skipped if we waited recently and nanny has not
+    # been charged for this socket since. Buffered charges do not change
+    # what nanny would decide, and they are bounded by
+    # ACCOUNTING_BATCH_BYTES over all sockets.
+    return self.charged or time.time() - self.waited_at >= ACCOUNTING_FLUSH_INTERVAL
+
+
+  def waited(self):
+    # Records that the socket has just waited on nanny
+    self.waited_at = time.time()
+    self.charged = False
+
+
+
+def _new_accounting_buffer(lock, on_loopback):
+  # Returns the accounting buffer for a new socket, or None if sockets
+  # should charge nanny directly.
+  if ACCOUNTING_BATCH_BYTES <= 0:
+    return None
+  return _AccountingBuffer(lock, on_loopback)
+
+
+
+def _charge_socket(self, recvamount, sendamount):
+  """
+  <Purpose>
+    Charges nanny for a socket operation. The socket lock must be held.
+
+  <Arguments>
+    self: An EmulatedSocket, UDPServerSocket or TCPServerSocket
+    recvamount: The bytes of netrecv (or looprecv) to charge
+    sendamount: The bytes of netsend (or loopsend) to charge
+
+  <Returns>
+    None
+  """
+  accounting = self.accounting
+  if accounting is not None:
+    accounting.charge(recvamount, sendamount)
+    return
+
+  if self.on_loopback:
+    if recvamount:
+      nanny.tattle_quantity('looprecv', recvamount)
+    if sendamount:
+      nanny.tattle_quantity('loopsend', sendamount)
+  else:
+    if recvamount:
+      nanny.tattle_quantity('netrecv', recvamount)
+    if sendamount:
+      nanny.tattle_quantity('netsend', sendamount)
+
+
+
+def _accounting_flush_loop():
+  # Flushes the buffers of sockets that have gone idle with charges
+  # pending. Buffers whose socket is busy are skipped, the thread using
+  # the socket will flush them. The charges are taken under the socket
+  # lock, but nanny is called after releasing it, so a nanny sleep does
+  # not hold up the socket. Sockets that were dropped without being closed
+  # are released here too, so that does not wait for a new socket.
+  while True:
+    time.sleep(ACCOUNTING_FLUSH_INTERVAL)
+    reclaim_sockets()
+    now = time.time()
+
+    _pending_accounting_lock.acquire()
+    try:
+      pending = _pending_accounting.values()
+    finally:
+      _pending_accounting_lock.release()
+
+    for accounting in pending:
+      if now - accounting.pending_since < ACCOUNTING_FLUSH_INTERVAL:
+        continue
+      if accounting.lock.acquire(False):
+        try:
+          (recvamount, sendamount) = accounting.take()
+        finally:
+          accounting.lock.release()
+        accounting.tattle(recvamount, sendamount)
+
+
+
+def _start_accounting_flusher():
+  global _accounting_flusher_started
+
+  _accounting_flusher_lock.acquire()
+  try:
+    if _accounting_flusher_started:
+      return
+    _accounting_flusher_started = True
+  finally:
+    _accounting_flusher_lock.release()
+
+  flusher = threading.Thread(target=_accounting_flush_loop, name="AccountingFlusher")
+  flusher.setDaemon(True)
+  flusher.start()
+
+
+
+##### Traffic shaping
+
+# Nanny enforces the netsend / netrecv / loopsend / looprecv rates by
+# sleeping after a vessel has gone over them, which gives bursty
+# stop-and-go transfers. With traffic shaping, each of those resources
+# also has a token bucket that fills at the resource's rate, and TCP
+# sockets only send or receive as much as there are tokens for. When a
+# bucket is empty, the operation would block, and the readiness waits
+# sleep until it has refilled.
+TRAFFIC_SHAPING_ENABLED = True
+
+# A bucket holds at most this many seconds worth of its rate, which is
+# the largest burst allowed, but never less than SHAPER_MIN_BURST bytes.
+SHAPER_BURST_TIME = 0.05 # In seconds
+SHAPER_MIN_BURST = 4096
+
+# Waiting for tokens is only worth it once there are enough for this
+# much data, or the 64 bytes of overhead per operation would dominate.
+SHAPER_MIN_TRANSFER = 1024
+
+# Maps resource -> _TokenBucket, or None if the resource is not limited
+_token_buckets = {}
+_token_buckets_lock = threading.Lock()
+
+
+class _TokenBucket:
+  """
+  A token bucket for one resource. A token is a byte. The tokens may go
+  negative, as an operation is charged for what it actually transferred
+  plus overhead, and the debt is paid back before the bucket can be
+  used again.
+  """
+  __slots__ = ["rate", "capacity", "tokens", "updated_at", "lock"]
+
+  def __init__(self, rate):
+    self.rate = float(rate)
+    self.capacity = max(self.rate * SHAPER_BURST_TIME, SHAPER_MIN_BURST)
+    self.tokens = self.capacity
+    self.updated_at = nonportable.getruntime()
+    self.lock = threading.Lock()
+
+
+  def _refill(self):
+    # Adds the tokens accumulated since the last refill. The lock must be held.
+    now = nonportable.getruntime()
+    self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+    self.updated_at = now
+
+
+  def available(self):
+    """
+    Returns the number of whole tokens in the bucket, which may be
+    negative.
+    """
+    self.lock.acquire()
+    try:
+      self._refill()
+      return int(self.tokens)
+    finally:
+      self.lock.release()
+
+
+  def consume(self, amount):
+    self.lock.acquire()
+    try:
+      self._refill()
+      self.tokens -= amount
+    finally:
+      self.lock.release()
+
+
+  def refill_time(self, amount):
+    """
+    Returns how many seconds until the bucket holds amount tokens, or as
+    many as it can hold.
+    """
+    self.lock.acquire()
+    try:
+      self._refill()
+      missing = min(amount, self.capacity) - self.tokens
+      if missing <= 0:
+        return 0.0
+      return missing / self.rate
+    finally:
+      self.lock.release()
+
+
+
+def _get_token_bucket(resource):
+  """
+  <Purpose>
+    Returns the token bucket of a resource, creating it with the rate
+    nanny enforces.
+
+  <Arguments>
+    resource: 'netsend', 'netrecv', 'loopsend' or 'looprecv'
+
+  <Returns>
+    A _TokenBucket, or None if shaping is disabled or the resource has
+    no rate limit.
+  """
+  if not TRAFFIC_SHAPING_ENABLED:
+    return None
+
+  try:
+    return _token_buckets[resource]
+  except KeyError:
+    pass
+
+  _token_buckets_lock.acquire()
+  try:
+    if resource not in _token_buckets:
+      try:
+        rate = nanny.get_resource_limit(resource)
+      except Exception:
+        rate = None
+      if rate:
+        _token_buckets[resource] = _TokenBucket(rate)
+      else:
+        _token_buckets[resource] = None
+    return _token_buckets[resource]
+  finally:
+    _token_buckets_lock.release()
+
+
+
+def reset_traffic_shaping():
+  """
+  <Purpose>
+    Forgets the token buckets, so they are re-created with the current
+    resource limits. Call this after the limits change.
+
+  <Arguments>
+    None
+
+  <Exceptions>
+    None
+
+  <Returns>
+    None
+  """
+  _token_buckets_lock.acquire()
+  try:
+    _token_buckets.clear()
+  finally:
+    _token_buckets_lock.release()
+
+
+
+def _shape_transfer(resource, size):
+  """
+  <Purpose>
+    Limits a transfer to the tokens available for a resource. Each
+    operation also costs 64 bytes of overhead, so a transfer only goes
+    ahead once there are tokens for SHAPER_MIN_TRANSFER bytes, or all of
+    a smaller transfer.
+
+  <Arguments>
+    resource: The resource the transfer uses
+    size: The number of bytes the caller would like to transfer
+
+  <Exceptions>
+    socket.error with EAGAIN if the bucket is empty, so that callers
+    treat it as a would-block error.
+
+  <Returns>
+    A (bucket, size) tuple, with the number of bytes that may be
+    transferred. bucket is None if the resource is not shaped.
+  """
+  bucket = _get_token_bucket(resource)
+  if bucket is None:
+    return (None, size)
+
+  budget = bucket.available() - 64
+  if budget < min(size, SHAPER_MIN_TRANSFER):
+    raise socket.error(errno.EAGAIN, "Waiting for the "+resource+" token bucket to refill")
+  return (bucket, min(size, budget))
+
+
+
+def _shaping_delay(socketlist, waitfor):
+  """
+  <Purpose>
+    Works out how long to wait before any of the given sockets can be
+    used, because of traffic shaping.
+
+  <Arguments>
+    socketlist: A list of sockets being waited on
+    waitfor: "r", "w" or "rw", as with waitforsockets()
+
+  <Returns>
+    The number of seconds until one of the sockets has tokens to transfer
+    with, or 0.0 if one has tokens now.
+  """
+  if not TRAFFIC_SHAPING_ENABLED:
+    return 0.0
+
+  delay = None
+  for sockobj in socketlist:
+    # Only TCP sockets are shaped
+    if not isinstance(sockobj, EmulatedSocket):
+      return 0.0
+
+    resources = []
+    if "r" in waitfor:
+      if sockobj.on_loopback:
+        resources.append('looprecv')
+      else:
+        resources.append('netrecv')
+    if "w" in waitfor:
+      if sockobj.on_loopback:
+        resources.append('loopsend')
+      else:
+        resources.append('netsend')
+
+    for resource in resources:
+      bucket = _get_token_bucket(resource)
+      if bucket is None:
+        return 0.0
+      socketdelay = bucket.refill_time(SHAPER_MIN_TRANSFER + 64)
+      if socketdelay == 0.0:
+        return 0.0
+      if delay is None or socketdelay < delay:
+        delay = socketdelay
+
+  if delay is None:
+    return 0.0
+  return delay
+
+
+
+##### Socket readiness engine
+
+# These are the epoll event masks used by the readiness engine. Older
+# versions of python do not export EPOLLRDHUP, so use the Linux value.
+if hasattr(select, "epoll"):
+  _EPOLLRDHUP = getattr(select, "EPOLLRDHUP", 0x2000)
+  _READ_EVENTS = select.EPOLLIN | select.EPOLLPRI | _EPOLLRDHUP
+  _WRITE_EVENTS = select.EPOLLOUT
+  _ERROR_EVENTS = select.EPOLLERR | select.EPOLLHUP
+
+
+class _WakePipe:
+  """
+  The pipe the poller thread uses to wake up one waiting thread. Each
+  thread that waits has one, which is closed when the thread exits and
+  its threading.local() storage is freed.
+  """
+  # Fields:
+  # readfd, writefd: The ends of the pipe, both non-blocking.
+  # poller: A select.poll() object watching readfd. poll() is used rather
+  #         than select(), which can't handle file descriptors of
+  #         FD_SETSIZE (usually 1024) or more.
+  __slots__ = ["readfd", "writefd", "poller"]
+
+  def __init__(self):
+    import fcntl
+    (self.readfd, self.writefd) = os.pipe()
+    for fd in (self.readfd, self.writefd):
+      flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+      fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+    self.poller = select.poll()
+    self.poller.register(self.readfd, select.POLLIN)
+
+
+  def __del__(self):
+    # os may already be gone if this runs during interpreter shutdown
+    if os is not None:
+      for fd in (self.readfd, self.writefd):
+        try:
+          os.close(fd)
+        except OSError:
+          pass
+
+
+
+class _ReadinessWaiter:
+  """
+  A single thread waiting on one or more sockets registered with the
+  readiness engine. The poller thread wakes the waiter by writing to a
+  pipe owned by the waiting thread, so the wait itself is a single
+  poll() call with an exact timeout.
+  """
+  # Fields:
+  # mask: The epoll events the waiter is interested in.
+  # ready: The set of file descriptors that were found to be ready.
+  # woken: True once the waiter has been signaled.
+  # wakepipe: The _WakePipe of the waiting thread.
+  __slots__ = ["mask", "ready", "woken", "wakepipe"]
+
+  def __init__(self, mask, wakepipe):
+    self.mask = mask
+    self.ready = set()
+    self.woken = False
+    self.wakepipe = wakepipe
+
+
+  def wake(self, fd):
+    # Called with the engine lock held
+    self.ready.add(fd)
+    if not self.woken:
+      self.woken = True
+      try:
+        os.write(self.wakepipe.writefd, "x")
+      except OSError:
+        # The pipe is full, so the waiter will wake up anyways
+        pass
+
+
+  def block(self, timeout):
+    """
+    Blocks until woken, or until timeout seconds have elapsed.
+    """
+    readfd = self.wakepipe.readfd
+    poller = self.wakepipe.poller
+    starttime = nonportable.getruntime()
+    while not self.woken:
+      remaining = timeout - (nonportable.getruntime() - starttime)
+      if remaining <= 0:
+        break
+
+      try:
+        poller.poll(int(remaining * 1000 + 0.999))
+      except select.error, e:
+        if not _is_recoverable_network_exception(e):
+          raise
+
+      # Drain the pipe. Stale wakeups from an earlier wait may be in here,
+      # which is harmless since we re-check woken.
+      try:
+        os.read(readfd, 64)
+      except OSError:
+        pass
+
+
+
+class _ReadinessEngine:
+  """
+  This object tracks every real socket wrapped by an EmulatedSocket,
+  TCPServerSocket or UDPServerSocket, and allows threads to block until
+  any of a set of them becomes readable (or acceptable) or writable.
+
+  Where epoll is available, a single shared epoll object is serviced by
+  a poller thread. Sockets are armed in one-shot mode only while a thread
+  is waiting on them, so idle sockets cost nothing. On other platforms,
+  waits fall back to select().
+  """
+  # Fields:
+  # epoll: The shared epoll object, or None if epoll is not available.
+  # sockets: A dict of fd -> [real socket, list of waiters, hung up flag]
+  # lock: Protects sockets and the waiter lists.
+  # poller: The poller thread, started on the first wait.
+  # threadlocal: Holds the _WakePipe of each waiting thread.
+
+  def __init__(self):
+    self.sockets = {}
+    self.lock = threading.Lock()
+    self.poller = None
+    self.threadlocal = threading.local()
+
+    if hasattr(select, "epoll"):
+      self.epoll = select.epoll()
+    else:
+      self.epoll = None
+
+
+  def register(self, realsock):
+    """
+    <Purpose>
+      Starts tracking a real socket. Called when a socket is wrapped.
+
+    <Arguments>
+      realsock: A real socket.socket() object.
+
+    <Returns>
+      None
+    """
+    fd = realsock.fileno()
+
+    self.lock.acquire()
+    try:
+      self.sockets[fd] = [realsock, [], False]
+      if self.epoll is not None:
+        # Register watching only for a remote hangup. The one-shot flag
+        # ensures a hangup on an idle socket is only ever reported once.
+        try:
+          self.epoll.register(fd, _EPOLLRDHUP | select.EPOLLONESHOT)
+        except IOError:
+          # A stale registration for a re-used fd
+          self.epoll.modify(fd, _EPOLLRDHUP | select.EPOLLONESHOT)
+
+        # The poller has to be running to notice hangups
+        self._start_poller()
+    finally:
+      self.lock.release()
+
+
+  def unregister(self, realsock):
+    """
+    <Purpose>
+      Stops tracking a real socket. This must be called before the socket
+      is closed. Any threads waiting on the socket are woken up.
+
+    <Arguments>
+      realsock: A real socket.socket() object.
+
+    <Returns>
+      None
+    """
+    try:
+      fd = realsock.fileno()
+    except socket.error:
+      # Already closed
+      return
+
+    self.lock.acquire()
+    try:
+      entry = self.sockets.get(fd)
+      if entry is None or entry[0] is not realsock:
+        return
+      del self.sockets[fd]
+
+      if self.epoll is not None:
+        try:
+          self.epoll.unregister(fd)
+        except (IOError, ValueError):
+          pass
+
+      # A closed socket is "ready", the next operation will raise
+      for waiter in entry[1]:
+        waiter.wake(fd)
+    finally:
+      self.lock.release()
+
+
+  def is_registered(self, realsock):
+    """
+    Returns True if the engine is tracking the given real socket.
+    """
+    try:
+      entry = self.sockets.get(realsock.fileno())
+    except socket.error:
+      return False
+    return entry is not None and entry[0] is realsock
+
+
+  def is_hungup(self, realsock):
+    """
+    Returns True if the engine has seen the remote end hang up.
+    """
+    try:
+      entry = self.sockets.get(realsock.fileno())
+    except socket.error:
+      return True
+    return entry is not None and entry[0] is realsock and entry[2]
+
+
+  def wait(self, realsocks, waitfor, timeout):
+    """
+    <Purpose>
+      Blocks until at least one of the given sockets is ready.
+
+    <Arguments>
+      realsocks: A list of real socket.socket() objects.
+      waitfor: "r" for readable, "w" for writable, or "rw" for either.
+      timeout: The maximum time to block, in seconds.
+
+    <Returns>
+      A list of the indices into realsocks of the sockets that are ready.
+      This is empty if the wait timed out.
+    """
+    if self.epoll is None:
+      return self._select_wait(realsocks, waitfor, timeout)
+
+    mask = 0
+    if "r" in waitfor:
+      mask |= _READ_EVENTS
+    if "w" in waitfor:
+      mask |= _WRITE_EVENTS
+
+    waiter = _ReadinessWaiter(mask, self._get_wakepipe())
+    fds = []
+
+    self.lock.acquire()
+    try:
+      for realsock in realsocks:
+        try:
+          fd = realsock.fileno()
+        except socket.error:
+          fd = None
+
+        entry = self.sockets.get(fd)
+        fds.append(fd)
+        if entry is None or entry[0] is not realsock:
+          # Closed or unknown sockets are always ready
+          waiter.wake(fd)
+          continue
+
+        entry[1].append(waiter)
+        self._arm(fd, entry)
+    finally:
+      self.lock.release()
+
+    waiter.block(timeout)
+
+    # Stop waiting on all of the sockets
+    self.lock.acquire()
+    try:
+      for fd in fds:
+        entry = self.sockets.get(fd)
+        if entry is not None and waiter in entry[1]:
+          entry[1].remove(waiter)
+
+      # The poller thread may still hold on to the waiter for a while, so
+      # let go of the pipe here. Otherwise it could outlive this thread.
+      waiter.woken = True
+      waiter.wakepipe = None
+    finally:
+      self.lock.release()
+
+    readylist = []
+    for index in range(len(fds)):
+      if fds[index] in waiter.ready:
+        readylist.append(index)
+    return readylist
+
+
+  def _get_wakepipe(self):
+    # Each thread has a single pipe which is re-used across waits, and
+    # closed when the thread exits
+    wakepipe = getattr(self.threadlocal, "wakepipe", None)
+    if wakepipe is None:
+      wakepipe = _WakePipe()
+      self.threadlocal.wakepipe = wakepipe
+    return wakepipe
+
+
+  def _start_poller(self):
+    # Called with the lock held
+    if self.poller is None:
+      self.poller = threading.Thread(target=self._poll_loop, name="ReadinessEngine")
+      self.poller.setDaemon(True)
+      self.poller.start()
+
+
+  def _arm(self, fd, entry):
+    # Called with the lock held. Arms the socket for the union of the
+    # events its waiters are interested in, and for a remote hangup
+    # unless we have already seen one.
+    mask = 0
+    for waiter in entry[1]:
+      mask |= waiter.mask
+    if not entry[2]:
+      mask |= _EPOLLRDHUP
+
+    try:
+      self.epoll.modify(fd, mask | select.EPOLLONESHOT)
+    except (IOError, ValueError):
+      # The socket went away underneath us, wake everyone up
+      for waiter in entry[1]:
+        waiter.wake(fd)
+      entry[1] = []
+
+
+  def _poll_loop(self):
+    while True:
+      try:
+        events = self.epoll.poll(-1)
+      except IOError, e:
+        if e.errno == errno.EINTR:
+          continue
+        raise
+
+      self.lock.acquire()
+      try:
+        for fd, eventmask in events:
+          entry = self.sockets.get(fd)
+          if entry is None:
+            continue
+
+          if eventmask & (_ERROR_EVENTS | _EPOLLRDHUP):
+            entry[2] = True
+
+          remaining = []
+          for waiter in entry[1]:
+            if eventmask & (waiter.mask | _ERROR_EVENTS):
+              waiter.wake(fd)
+            else:
+              remaining.append(waiter)
+          entry[1] = remaining
+
+          # One-shot disarmed the socket, re-arm if anyone is still waiting
+          # or if we still need to watch for a hangup
+          if remaining or not entry[2]:
+            self._arm(fd, entry)
+      finally:
+        self.lock.release()
+
+
+  def _select_wait(self, realsocks, waitfor, timeout):
+    # Used when epoll is not available
+    read_array = []
+    write_array = []
+    readylist = []
+
+    for index in range(len(realsocks)):
+      realsock = realsocks[index]
+      try:
+        realsock.fileno()
+      except socket.error:
+        # Closed sockets are always ready
+        readylist.append(index)
+        continue
+      if "r" in waitfor:
+        read_array.append(realsock)
+      if "w" in waitfor:
+        write_array.append(realsock)
+
+    if readylist:
+      return readylist
+
+    # select() can't handle file descriptors of FD_SETSIZE (usually 1024)
+    # or more, so use poll() where it is available.
+    if hasattr(select, "poll"):
+      return self._poll_wait(realsocks, waitfor, timeout)
+
+    (readable, writeable, exception) = select.select(read_array, write_array, read_array + write_array, timeout)
+
+    for index in range(len(realsocks)):
+      realsock = realsocks[index]
+      if realsock in readable or realsock in writeable or realsock in exception:
+        readylist.append(index)
+    return readylist
+
+
+  def _poll_wait(self, realsocks, waitfor, timeout):
+    # Used by _select_wait() when poll() is available. None of the
+    # sockets are closed.
+    mask = 0
+    if "r" in waitfor:
+      mask |= select.POLLIN | select.POLLPRI
+    if "w" in waitfor:
+      mask |= select.POLLOUT
+
+    poller = select.poll()
+    fdindices = {}
+    for index in range(len(realsocks)):
+      fd = realsocks[index].fileno()
+      fdindices.setdefault(fd, []).append(index)
+      poller.register(fd, mask)
+
+    starttime = nonportable.getruntime()
+    while True:
+      remaining = max(0.0, timeout - (nonportable.getruntime() - starttime))
+      try:
+        events = poller.poll(int(remaining * 1000 + 0.999))
+        break
+      except select.error, e:
+        if not _is_recoverable_network_exception(e):
+          raise
+
+    readylist = []
+    for (fd, fdevent) in events:
+      readylist.extend(fdindices.get(fd, []))
+    readylist.sort()
+    return readylist
+
+
+# The shared readiness engine
+_readiness_engine = _ReadinessEngine()
+
+
+
+##### File transfer
+
+# These sendfile() errors mean the file can't be sent this way (e.g. it
+# is not a regular file), so EmulatedSocket.sendfile() copies it instead.
+_SENDFILE_UNSUPPORTED_ERRNOS = frozenset([errnum for (errnum, errname) in errno.errorcode.items()
+                                          if errname in ["EINVAL", "ENOSYS", "EOVERFLOW", "ENOTSUP", "EOPNOTSUPP"]])
+
+def _find_sendfile():
+  """
+  <Purpose>
+    Finds a sendfile(outfd, infd, offset, count) function, which copies
+    from a file to a socket inside the kernel and returns the number of
+    bytes sent. Python 2 has no os.sendfile(), so on Linux sendfile64()
+    is called from libc with ctypes.
+
+  <Returns>
+    The function, or None if there is no way to call sendfile().
+  """
+  if hasattr(os, "sendfile"):
+    return os.sendfile
+
+  if not nonportable.ostype == "Linux":
+    return None
+
+  try:
+    import ctypes
+    libc = ctypes.CDLL(None, use_errno=True)
+    libc_sendfile = libc.sendfile64
+  except (ImportError, OSError, AttributeError):
+    return None
+
+  libc_sendfile.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t]
+  libc_sendfile.restype = ctypes.c_ssize_t
+
+  def _libc_sendfile(outfd, infd, offset, count):
+    # The kernel updates fileoffset instead of the file position
+    fileoffset = ctypes.c_int64(offset)
+    bytes_sent = libc_sendfile(outfd, infd, ctypes.byref(fileoffset), count)
+    if bytes_sent < 0:
+      errnum = ctypes.get_errno()
+      raise OSError(errnum, os.strerror(errnum))
+    return bytes_sent
+
+  return _libc_sendfile
+
+_sendfile = _find_sendfile()
 
-  # Generate the read/write arrays
-  read_array = []
-  if "r" in waitfor:
-    read_array = sock_array
 
-  write_array = []
-  if "w" in waitfor:
-    write_array = sock_array
 
-  # Call select()
-  (readable, writeable, exception) = select.select(read_array,write_array,sock_array,timeout)
+def _get_str_argument(value, name):
+  """
+  <Purpose>
+    Returns a string argument of a socket method as a str. A unicode
+    string is encoded as ASCII, as the real socket methods would, so that
+    it can be sliced and viewed like any other message.
 
-  # If the socket is in the exception list, then assume its both read and writable
-  if (realsock in exception):
-    return (False, False)
+  <Arguments>
+    value: The argument
+    name: The name of the argument, for the error message
+
+  <Exceptions>
+    RepyArgumentError if value is not a str, or is a unicode string
+    that is not ASCII.
+
+  <Returns>
+    The argument as a str.
+  """
+  if type(value) is str:
+    return value
+  if type(value) is unicode:
+    try:
+      return str(value)
+    except UnicodeError:
+      raise RepyArgumentError("Provided "+name+" must be ASCII if it is unicode!")
+  raise RepyArgumentError("Provided "+name+" must be a string!")
 
-  # Return normally then
-  return (realsock not in readable, realsock not in writeable)
 
 
 ##### Class Definitions
 
 # Public.   We pass these to the users for communication purposes
-class EmulatedSocket:
+class EmulatedSocket (object):
   """
   This object is a wrapper around a tcp
   TCP socket. It allows for sending and
@@ -1557,7 +4973,16 @@ class EmulatedSocket:
   #              this is used for resource accounting.
   # sock_lock: Threading Lock on socket object used for 
   #            synchronization.
-  __slots__ = ["socketobj", "send_buffer_size", "on_loopback", "sock_lock"]
+  # remote_closed: True once we know the remote end has closed the socket.
+  # recv_buffer: A bytearray holding received data that has not been
+  #              returned yet. This is allocated on first use.
+  # recv_reservation: The _RecvBufferReservation of recv_buffer.
+  # recv_start, recv_end: The bounds of the unreturned data in recv_buffer.
+  # stats: The _SocketStatistics of the socket, or None.
+  # accounting: The _AccountingBuffer of the socket, or None.
+  __slots__ = ["socketobj", "send_buffer_size", "on_loopback", "sock_lock", "remote_closed",
+               "recv_buffer", "recv_start", "recv_end", "recv_reservation", "stats",
+               "accounting", "__weakref__"]
 
   
   def __init__(self, sock, on_loopback):
@@ -1582,6 +5007,13 @@ class EmulatedSocket:
     self.socketobj = sock
     self.on_loopback = on_loopback
     self.sock_lock = threading.Lock()
+    self.remote_closed = False
+    self.recv_buffer = None
+    self.recv_start = 0
+    self.recv_end = 0
+    self.recv_reservation = _RecvBufferReservation()
+    self.stats = _new_socket_statistics("tcp", sock, True)
+    self.accounting = _new_accounting_buffer(self.sock_lock, on_loopback)
     
     # Store the socket send buffer size and set to non-blocking
     self.send_buffer_size = sock.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF)
@@ -1589,6 +5021,12 @@ class EmulatedSocket:
     # reference here yet
     sock.setblocking(0)
 
+    # Track the socket so that threads can wait for it to become ready
+    _readiness_engine.register(sock)
+
+    # Reclaim the socket if this object goes away without being closed
+    _track_socket(self, self.recv_reservation)
+
     
   def _close(self):
     """
@@ -1612,6 +5050,115 @@ class EmulatedSocket:
     # Replace the socket
     self.socketobj = None
 
+    # Release the receive buffer
+    self.recv_buffer = None
+    self.recv_start = 0
+    self.recv_end = 0
+    self.recv_reservation.resize(0)
+
+
+  def _take_buffered(self, count):
+    """
+    <Purpose>
+      Private method to remove data from the front of the receive buffer.
+      Called when the socket lock is held.
+
+    <Arguments>
+      count: The number of bytes to remove. There must be at least
+             this many bytes buffered.
+
+    <Returns>
+      The data, as a string.
+    """
+    start = self.recv_start
+    data = memoryview(self.recv_buffer)[start:start+count].tobytes()
+
+    self.recv_start = start + count
+    if self.recv_start == self.recv_end:
+      # Empty, so start again from the front. A buffer that has grown is
+      # released, giving back its memory.
+      if len(self.recv_buffer) > RECV_BUFFER_SIZE:
+        self.recv_buffer = None
+        self.recv_reservation.resize(0)
+      self.recv_start = 0
+      self.recv_end = 0
+
+    return data
+
+
+  def _fill_buffer(self, sock, needed):
+    """
+    <Purpose>
+      Private method to receive whatever data is available into the
+      receive buffer, with a single recv_into() call. Called when the
+      socket lock is held.
+
+    <Arguments>
+      sock: The real socket.
+      needed: The total number of bytes the caller wants buffered. The
+              buffer is grown or compacted to make room for this.
+
+    <Exceptions>
+      SocketClosedRemote if the remote end has closed the socket.
+      ResourceExhaustedError if the buffer cannot grow past
+      RECV_BUFFER_SIZE without going over MAX_TOTAL_RECV_BUFFER_SIZE.
+      As with socket.recv_into() otherwise.
+
+    <Resource Consumption>
+      As with recv(), for the data received.
+
+    <Returns>
+      None
+    """
+    recv_buffer = self.recv_buffer
+    buffered = self.recv_end - self.recv_start
+
+    if recv_buffer is None:
+      size = max(RECV_BUFFER_SIZE, needed)
+      self.recv_reservation.resize(size)
+      recv_buffer = bytearray(size)
+
+    elif needed > len(recv_buffer):
+      # Grow the buffer, moving the data to the front
+      size = max(needed, min(2 * len(recv_buffer), MAX_RECV_BUFFER_SIZE))
+      self.recv_reservation.resize(size)
+      new_buffer = bytearray(size)
+      new_buffer[0:buffered] = recv_buffer[self.recv_start:self.recv_end]
+      recv_buffer = new_buffer
+      self.recv_start = 0
+      self.recv_end = buffered
+
+    elif len(recv_buffer) - self.recv_start < needed or self.recv_end == len(recv_buffer):
+      # Compact the buffer, moving the data to the front
+      recv_buffer[0:buffered] = recv_buffer[self.recv_start:self.recv_end]
+      self.recv_start = 0
+      self.recv_end = buffered
+
+    self.recv_buffer = recv_buffer
+
+    # Receive no more than the traffic shaper allows
+    if self.on_loopback:
+      bucket, allowed = _shape_transfer('looprecv', len(recv_buffer) - self.recv_end)
+    else:
+      bucket, allowed = _shape_transfer('netrecv', len(recv_buffer) - self.recv_end)
+
+    # Receive straight into the free space at the end of the buffer
+    data_length = sock.recv_into(memoryview(recv_buffer)[self.recv_end:self.recv_end+allowed])
+
+    if bucket is not None:
+      bucket.consume(data_length + 64)
+
+    if data_length == 0:
+      self.remote_closed = True
+      raise SocketClosedRemote("The socket has been closed remotely!")
+
+    self.recv_end += data_length
+
+    if self.stats is not None:
+      self.stats.bytes_in += data_length
+
+    _charge_socket(self, data_length + 64, 64)
+
 
   def close(self):
     """
@@ -1697,19 +5244,12 @@ class EmulatedSocket:
         The data received from the socket (as a string).   If '' is returned,
         the other side has closed the socket and no more data will arrive.
     """
-    # Get the socket lock
-    socket_lock = self.sock_lock
-    # Wait if already oversubscribed
+    # Wait if already oversubscribed, then get the socket lock
     if self.on_loopback:
-      nanny.tattle_quantity('looprecv',0)
-      nanny.tattle_quantity('loopsend',0)
+      starttime = _begin_socket_operation(self, _LOOPBACK_RESOURCES)
     else:
-      nanny.tattle_quantity('netrecv',0)
-      nanny.tattle_quantity('netsend',0)
-
+      starttime = _begin_socket_operation(self, _NETWORK_RESOURCES)
 
-    # Acquire the socket lock
-    socket_lock.acquire()
     try:
       # Get the socket
       sock = self.socketobj
@@ -1719,41 +5259,356 @@ class EmulatedSocket:
       # Try to recieve the data
       if ((bytes) <= 0):
         return ""
+      elif self.recv_end > self.recv_start:
+        # Return data left over from recvexactly() / recvuntil() first.
+        # This was accounted for when it was received.
+        return self._take_buffered(min(bytes, self.recv_end - self.recv_start))
       else:
-        data_recieved = sock.recv(bytes)
+        # Receive no more than the traffic shaper allows
+        if self.on_loopback:
+          bucket, allowed = _shape_transfer('looprecv', bytes)
+        else:
+          bucket, allowed = _shape_transfer('netrecv', bytes)
+
+        data_recieved = sock.recv(allowed)
+
+      # Calculate the length of the data
+      data_length = len(data_recieved)
+
+      if bucket is not None:
+        bucket.consume(data_length + 64)
       
+      # Raise an exception if there was no data
+      if data_length == 0:
+        self.remote_closed = True
+        raise SocketClosedRemote("The socket has been closed remotely!")
+
+      if self.stats is not None:
+        self.stats.bytes_in += data_length
+
+      _charge_socket(self, data_length + 64, 64)
+
+      return data_recieved
+
+    except KeyError:
+      raise SocketClosedLocal("The socket is closed!")
+  
+    except RepyException:
+      raise # Pass up from inner block
+
+    except Exception, e:
+      error_category = _classify_network_exception(e)
+
+      # Check if this a recoverable error
+      if error_category is _ERROR_RECOVERABLE:
+        # Operation would block
+        if self.stats is not None:
+          self.stats.would_block += 1
+        raise SocketWouldBlockError("There is no data! recv() would block.")
+
+      elif error_category is _ERROR_TERMINATED:
+        # Remote close
+        self.remote_closed = True
+        self._close()
+        raise SocketClosedRemote("The socket has been closed remotely!")
+
+      else:
+        # Unknown error
+        self._close()
+        raise SocketClosedLocal("The socket has encountered an unexpected error! Error:"+str(e))
+
+    finally:
+      _end_socket_operation(self, starttime)
+
+
+
+  def recvexactly(self,bytes):
+    """
+      <Purpose>
+        Receives exactly the given number of bytes from a socket. Data is
+        accumulated in a buffer inside the socket until enough has arrived,
+        so callers do not need to concatenate partial reads.
+
+      <Arguments>
+        bytes:
+           The number of bytes to read. This may not be more than
+           MAX_RECV_BUFFER_SIZE.
+
+      <Exceptions>
+        RepyArgumentError is raised if bytes is too large.
+        SocketClosedLocal is raised if the socket was closed locally.
+        SocketClosedRemote is raised if the socket was closed remotely.
+        SocketWouldBlockError is raised if fewer than bytes bytes are
+        available. The data that has arrived is kept for the next call.
+        ResourceExhaustedError is raised if the receive buffer would have to
+        grow past what MAX_TOTAL_RECV_BUFFER_SIZE allows.
+
+      <Side Effects>
+        None.
+
+      <Resource Consumptions>
+        As with recv(), charged as the data arrives.
+
+      <Returns>
+        A string of exactly bytes bytes.
+    """
+    if bytes > MAX_RECV_BUFFER_SIZE:
+      raise RepyArgumentError("Cannot read more than "+str(MAX_RECV_BUFFER_SIZE)+" bytes at once!")
+
+    # Wait if already oversubscribed, then get the socket lock
+    if self.on_loopback:
+      starttime = _begin_socket_operation(self, _LOOPBACK_RESOURCES)
+    else:
+      starttime = _begin_socket_operation(self, _NETWORK_RESOURCES)
+
+    try:
+      # Get the socket
+      sock = self.socketobj
+      if sock is None:
+        raise KeyError # Socket is closed locally
+
+      if bytes <= 0:
+        return ""
+
+      # Receive until we have enough, or would block
+      while self.recv_end - self.recv_start < bytes:
+        self._fill_buffer(sock, bytes)
+
+      return self._take_buffered(bytes)
+
+    except KeyError:
+      raise SocketClosedLocal("The socket is closed!")
+
+    except RepyException:
+      raise # Pass up from inner block
+
+    except Exception, e:
+      error_category = _classify_network_exception(e)
+
+      # Check if this a recoverable error
+      if error_category is _ERROR_RECOVERABLE:
+        # Operation would block
+        if self.stats is not None:
+          self.stats.would_block += 1
+        raise SocketWouldBlockError("There is not enough data! recvexactly() would block.")
+
+      elif error_category is _ERROR_TERMINATED:
+        # Remote close
+        self.remote_closed = True
+        self._close()
+        raise SocketClosedRemote("The socket has been closed remotely!")
+
+      else:
+        # Unknown error
+        self._close()
+        raise SocketClosedLocal("The socket has encountered an unexpected error! Error:"+str(e))
+
+    finally:
+      _end_socket_operation(self, starttime)
+
+
+
+  def recvuntil(self,delimiter,maxbytes):
+    """
+      <Purpose>
+        Receives data from a socket up to and including the first
+        occurrence of delimiter. Data is accumulated in a buffer inside
+        the socket until the delimiter arrives.
+
+      <Arguments>
+        delimiter:
+           The non-empty string that ends the data to return.
+        maxbytes:
+           The maximum number of bytes to read, including the delimiter.
+           This may not be more than MAX_RECV_BUFFER_SIZE.
+
+      <Exceptions>
+        RepyArgumentError is raised if the arguments are invalid, including
+        a unicode delimiter that is not ASCII, or if maxbytes bytes have
+        arrived without the delimiter.
+        SocketClosedLocal is raised if the socket was closed locally.
+        SocketClosedRemote is raised if the socket was closed remotely.
+        SocketWouldBlockError is raised if the delimiter has not arrived.
+        The data that has arrived is kept for the next call.
+        ResourceExhaustedError is raised if the receive buffer would have to
+        grow past what MAX_TOTAL_RECV_BUFFER_SIZE allows.
+
+      <Side Effects>
+        None.
+
+      <Resource Consumptions>
+        As with recv(), charged as the data arrives.
+
+      <Returns>
+        The data, ending with delimiter.
+    """
+    delimiter = _get_str_argument(delimiter, "delimiter")
+    if len(delimiter) == 0:
+      raise RepyArgumentError("Provided delimiter must not be empty!")
+    if maxbytes > MAX_RECV_BUFFER_SIZE:
+      raise RepyArgumentError("Cannot read more than "+str(MAX_RECV_BUFFER_SIZE)+" bytes at once!")
+
+    # Wait if already oversubscribed, then get the socket lock
+    if self.on_loopback:
+      starttime = _begin_socket_operation(self, _LOOPBACK_RESOURCES)
+    else:
+      starttime = _begin_socket_operation(self, _NETWORK_RESOURCES)
+
+    try:
+      # Get the socket
+      sock = self.socketobj
+      if sock is None:
+        raise KeyError # Socket is closed locally
+
+      # Where to start looking for the delimiter. We don't re-scan data
+      # that we already know doesn't contain it.
+      search_start = self.recv_start
+
+      while True:
+        if self.recv_buffer is not None:
+          index = self.recv_buffer.find(delimiter, search_start, self.recv_end)
+          if index != -1 and index + len(delimiter) - self.recv_start <= maxbytes:
+            return self._take_buffered(index + len(delimiter) - self.recv_start)
+
+        if self.recv_end - self.recv_start >= maxbytes:
+          raise RepyArgumentError("The delimiter was not found in the first "+str(maxbytes)+" bytes!")
+
+        # The delimiter may straddle the old and new data
+        search_offset = max(0, self.recv_end - self.recv_start - len(delimiter) + 1)
+        self._fill_buffer(sock, maxbytes)
+        search_start = self.recv_start + search_offset
+
+    except KeyError:
+      raise SocketClosedLocal("The socket is closed!")
+
+    except RepyException:
+      raise # Pass up from inner block
+
+    except Exception, e:
+      error_category = _classify_network_exception(e)
+
+      # Check if this a recoverable error
+      if error_category is _ERROR_RECOVERABLE:
+        # Operation would block
+        if self.stats is not None:
+          self.stats.would_block += 1
+        raise SocketWouldBlockError("The delimiter has not arrived! recvuntil() would block.")
+
+      elif error_category is _ERROR_TERMINATED:
+        # Remote close
+        self.remote_closed = True
+        self._close()
+        raise SocketClosedRemote("The socket has been closed remotely!")
+
+      else:
+        # Unknown error
+        self._close()
+        raise SocketClosedLocal("The socket has encountered an unexpected error! Error:"+str(e))
+
+    finally:
+      _end_socket_operation(self, starttime)
+
+
+
+  def send(self,message):
+    """
+      <Purpose>
+        Sends data on a socket.   It may send fewer bytes than requested.   
+
+      <Arguments>
+        message:
+          The string to send.
+
+      <Exceptions>
+        SocketClosedLocal is raised if the socket is closed locally.
+        SocketClosedRemote is raised if the socket is closed remotely.
+        SocketWouldBlockError is raised if the operation would block.
+        RepyArgumentError is raised if message is not a string, or is a
+        unicode string that is not ASCII.
+
+      <Side Effects>
+        None.
+
+      <Resource Consumption>
+        This operations consumes 64 + size of sent data of netsend and
+        64 bytes of netrecv.
+
+      <Returns>
+        The number of bytes sent.   Be sure not to assume this is always the 
+        complete amount!
+    """
+    # sendall() passes views into its message, which it has checked
+    if type(message) is not memoryview:
+      message = _get_str_argument(message, "message")
+
+    # Trim the message size to be less than the send buffer size.
+    # This is a fix for http://support.microsoft.com/kb/823764
+    # We take a view of the message rather than slicing it, to avoid
+    # copying the data.
+    if len(message) >= self.send_buffer_size:
+      message = memoryview(message)[:self.send_buffer_size-1]
+
+    # Wait if already oversubscribed, then get the socket lock
+    if self.on_loopback:
+      starttime = _begin_socket_operation(self, _LOOPBACK_RESOURCES)
+    else:
+      starttime = _begin_socket_operation(self, _NETWORK_RESOURCES)
+
+    try:
+      # Get the socket
+      sock = self.socketobj
+      if sock is None:
+        raise KeyError # Socket is closed locally
  
+      # Detect Socket Closed Remote
+      # Fixes ticket#974. Rather than probing the socket on every call, we
+      # rely on the readiness engine watching for the remote hangup, and on
+      # what recv() has seen.
+      if self.remote_closed or _readiness_engine.is_hungup(sock):
+        self.remote_closed = True
+        raise SocketClosedRemote("The socket has been closed by the remote end!")
+
+      # Send no more than the traffic shaper allows
+      if self.on_loopback:
+        bucket, allowed = _shape_transfer('loopsend', len(message))
+      else:
+        bucket, allowed = _shape_transfer('netsend', len(message))
+
+      if allowed < len(message):
+        message = memoryview(message)[:allowed]
+
+      # Try to send the data
+      bytes_sent = sock.send(message)
+
+      if bucket is not None:
+        bucket.consume(bytes_sent + 64)
 
-      # Calculate the length of the data
-      data_length = len(data_recieved)
+      if self.stats is not None:
+        self.stats.bytes_out += bytes_sent
       
-      # Raise an exception if there was no data
-      if data_length == 0:
-        raise SocketClosedRemote("The socket has been closed remotely!")
+      _charge_socket(self, 64, 64 + bytes_sent)
 
-      if self.on_loopback:
-        nanny.tattle_quantity('looprecv',data_length+64)
-        nanny.tattle_quantity('loopsend',64)
-      else:
-        nanny.tattle_quantity('netrecv',data_length+64)
-        nanny.tattle_quantity('netsend',64)
+      # Return the number of bytes sent
+      return bytes_sent
 
-      return data_recieved
 
     except KeyError:
       raise SocketClosedLocal("The socket is closed!")
-  
     except RepyException:
-      raise # Pass up from inner block
-
+      raise # pass up from inner block
     except Exception, e:
+      error_category = _classify_network_exception(e)
+
       # Check if this a recoverable error
-      if _is_recoverable_network_exception(e):
+      if error_category is _ERROR_RECOVERABLE:
         # Operation would block
-        raise SocketWouldBlockError("There is no data! recv() would block.")
+        if self.stats is not None:
+          self.stats.would_block += 1
+        raise SocketWouldBlockError("send() would block.")
 
-      elif _is_terminated_connection_exception(e):
+      elif error_category is _ERROR_TERMINATED:
         # Remote close
+        self.remote_closed = True
         self._close()
         raise SocketClosedRemote("The socket has been closed remotely!")
 
@@ -1763,14 +5618,16 @@ class EmulatedSocket:
         raise SocketClosedLocal("The socket has encountered an unexpected error! Error:"+str(e))
 
     finally:
-      socket_lock.release()
+      _end_socket_operation(self, starttime)
 
 
 
-  def send(self,message):
+  def sendall(self,message):
     """
       <Purpose>
-        Sends data on a socket.   It may send fewer bytes than requested.   
+        Sends all of the data on a socket, blocking until it has been sent.
+        The data is sent directly from views into the message, so it is
+        never copied.
 
       <Arguments>
         message:
@@ -1779,113 +5636,223 @@ class EmulatedSocket:
       <Exceptions>
         SocketClosedLocal is raised if the socket is closed locally.
         SocketClosedRemote is raised if the socket is closed remotely.
-        SocketWouldBlockError is raised if the operation would block.
+        RepyArgumentError is raised if message is not a string, or is a
+        unicode string that is not ASCII.
 
       <Side Effects>
         None.
 
       <Resource Consumption>
-        This operations consumes 64 + size of sent data of netsend and
-        64 bytes of netrecv.
+        As with send(), for every chunk that is sent. The resources are
+        waited for before each chunk, so rate limits are respected.
 
       <Returns>
-        The number of bytes sent.   Be sure not to assume this is always the 
-        complete amount!
+        The number of bytes sent, which is always the length of message.
     """
-    # Get the socket lock
-    socket_lock = self.sock_lock
-    # Wait if already oversubscribed
+    message_view = memoryview(_get_str_argument(message, "message"))
+    message_length = len(message_view)
+    bytes_sent = 0
+
+    while bytes_sent < message_length:
+      try:
+        bytes_sent += self.send(message_view[bytes_sent:])
+      except SocketWouldBlockError:
+        # If the traffic shaper is out of tokens, sleep until it refills.
+        # Otherwise block until the socket is writable. If the socket is
+        # closed in the meantime, the next send will raise.
+        delay = _shaping_delay([self], "w")
+        if delay > 0:
+          time.sleep(min(delay, 1.0))
+          continue
+
+        sock = self.socketobj
+        if sock is not None:
+          _readiness_engine.wait([sock], "w", 1.0)
+
+    return bytes_sent
+
+
+  def sendfile(self, fileobj, offset, count):
+    """
+      <Purpose>
+        Sends part of a file on the socket, without reading it into a
+        string first. Where possible, the kernel copies the data from the
+        file to the socket directly. It may send fewer bytes than
+        requested. This is for the trusted side, and is not exported to
+        sandboxed code.
+
+      <Arguments>
+        fileobj:
+          An emulated_file, or a Python file object.
+        offset:
+          The offset in the file to start sending from.
+        count:
+          The maximum number of bytes to send.
+
+      <Exceptions>
+        RepyArgumentError is raised if offset or count are invalid.
+        FileClosedError is raised if the file is closed.
+        SocketClosedLocal is raised if the socket is closed locally.
+        SocketClosedRemote is raised if the socket is closed remotely.
+        SocketWouldBlockError is raised if the operation would block.
+
+      <Side Effects>
+        Any data buffered for writing to the file is flushed.
+
+      <Resource Consumption>
+        As with send(), for every chunk of up to the send buffer size that
+        is sent, and the size of each chunk of fileread.
+
+      <Returns>
+        The number of bytes sent. This is 0 if offset is at or past the
+        end of the file.
+    """
+    if type(offset) not in [int, long] or offset < 0:
+      raise RepyArgumentError("Provided offset must be a non-negative int!")
+    if type(count) not in [int, long] or count < 0:
+      raise RepyArgumentError("Provided count must be a non-negative int!")
+
+    # Use the real file behind an emulated_file, and its lock, which
+    # guards the file position
+    fobj = getattr(fileobj, "fobj", fileobj)
+    seek_lock = getattr(fileobj, "seek_lock", None)
+    if fobj is None or fobj.closed:
+      raise FileClosedError("The file is closed!")
+
     if self.on_loopback:
-      nanny.tattle_quantity('loopsend',0)
-      nanny.tattle_quantity('looprecv',0)
+      starttime = _begin_socket_operation(self, _LOOPBACK_RESOURCES + ('fileread',))
     else:
-      nanny.tattle_quantity('netsend',0)
-      nanny.tattle_quantity('netrecv',0)
-
-    # Trim the message size to be less than the send buffer size.
-    # This is a fix for http://support.microsoft.com/kb/823764
-    message = message[:self.send_buffer_size-1]
+      starttime = _begin_socket_operation(self, _NETWORK_RESOURCES + ('fileread',))
 
-    # Acquire the socket lock
-    socket_lock.acquire()
+    bytes_sent = 0
     try:
       # Get the socket
       sock = self.socketobj
       if sock is None:
         raise KeyError # Socket is closed locally
- 
-      # Detect Socket Closed Remote
-      # Fixes ticket#974
-      (readable, writable, exception) = select.select([sock],[],[],0)
-      # check if socket is readable.   This is true if the remote end closed.
-      if readable:
-
-         # if socket is readable but there was no data this means the remote end
-         # has closed the socket.   We peek so that we don't consume a character.
-         data_peeked = sock.recv(1,socket.MSG_PEEK)
-         if len(data_peeked) == 0:
-            # remote socket is closed
-            raise SocketClosedRemote("The socket has been closed by the remote end!")
 
-      # Try to send the data
-      bytes_sent = sock.send(message)
-      
-      if self.on_loopback:
-        nanny.tattle_quantity('looprecv', 64)
-        nanny.tattle_quantity('loopsend', 64 + bytes_sent)
-      else:
-        nanny.tattle_quantity('netrecv', 64)
-        nanny.tattle_quantity('netsend', 64 + bytes_sent)
+      if self.remote_closed or _readiness_engine.is_hungup(sock):
+        self.remote_closed = True
+        raise SocketClosedRemote("The socket has been closed by the remote end!")
 
-      # Return the number of bytes sent
-      return bytes_sent
+      # Write out anything buffered, so the kernel sees the whole file
+      if seek_lock is not None:
+        seek_lock.acquire()
+      try:
+        fobj.flush()
+      finally:
+        if seek_lock is not None:
+          seek_lock.release()
+
+      use_sendfile = _sendfile is not None
+      copy_buffer = None
+
+      # Send in chunks smaller than the send buffer, as send() does, so
+      # each chunk is accounted for as a separate send
+      while bytes_sent < count:
+        chunk_size = min(count - bytes_sent, self.send_buffer_size - 1)
+
+        try:
+          # Send no more than the traffic shaper allows
+          if self.on_loopback:
+            bucket, chunk_size = _shape_transfer('loopsend', chunk_size)
+          else:
+            bucket, chunk_size = _shape_transfer('netsend', chunk_size)
+
+          if use_sendfile:
+            try:
+              chunk_sent = _sendfile(sock.fileno(), fobj.fileno(), offset + bytes_sent, chunk_size)
+              chunk_read = chunk_sent
+            except OSError, e:
+              if e.errno not in _SENDFILE_UNSUPPORTED_ERRNOS:
+                # The error is about the socket, report it as such
+                raise socket.error(e.errno, e.strerror)
+              use_sendfile = False
+              continue
+
+          else:
+            if copy_buffer is None:
+              copy_buffer = memoryview(bytearray(min(count, self.send_buffer_size - 1)))
+            if seek_lock is not None:
+              seek_lock.acquire()
+            try:
+              fobj.seek(offset + bytes_sent)
+              chunk_read = fobj.readinto(copy_buffer[:chunk_size])
+            finally:
+              if seek_lock is not None:
+                seek_lock.release()
+
+            chunk_sent = 0
+            if chunk_read:
+              chunk_sent = sock.send(copy_buffer[:chunk_read])
+
+        except Exception, e:
+          # If some of the file was sent, report that, and let the next
+          # call raise the error
+          if bytes_sent > 0 and not isinstance(e, RepyException):
+            break
+          raise
+
+        if chunk_read:
+          nanny.tattle_quantity('fileread', chunk_read)
 
+        if bucket is not None:
+          bucket.consume(chunk_sent + 64)
+
+        if chunk_sent == 0:
+          # The end of the file
+          break
+
+        if self.stats is not None:
+          self.stats.bytes_out += chunk_sent
+        _charge_socket(self, 64, 64 + chunk_sent)
+        bytes_sent += chunk_sent
+
+        if chunk_sent < chunk_size:
+          # The socket buffer is full, or we are at the end of the file
+          break
+
+      return bytes_sent
 
     except KeyError:
       raise SocketClosedLocal("The socket is closed!")
     except RepyException:
       raise # pass up from inner block
     except Exception, e:
+      error_category = _classify_network_exception(e)
+
       # Check if this a recoverable error
-      if _is_recoverable_network_exception(e):
+      if error_category is _ERROR_RECOVERABLE:
         # Operation would block
-        raise SocketWouldBlockError("send() would block.")
+        if self.stats is not None:
+          self.stats.would_block += 1
+        raise SocketWouldBlockError("sendfile() would block.")
 
-      elif _is_terminated_connection_exception(e):
+      elif error_category is _ERROR_TERMINATED:
         # Remote close
+        self.remote_closed = True
         self._close()
         raise SocketClosedRemote("The socket has been closed remotely!")
 
-      else:
+      elif type(e) is socket.error:
         # Unknown error
         self._close()
         raise SocketClosedLocal("The socket has encountered an unexpected error! Error:"+str(e))
 
-    finally:
-      socket_lock.release()
-
-
-  def __del__(self):
-    # Get the socket lock
-    try:
-      socket_lock = self.sock_lock
-    except KeyError:
-      # Closed, done
-      return
+      else:
+        # An error reading the file, the socket is fine
+        raise
 
-    # Acquire the lock and close
-    socket_lock.acquire()
-    try:
-      self._close()
     finally:
-      socket_lock.release()
+      _end_socket_operation(self, starttime)
+
 
 
 # End of EmulatedSocket class
 
 
 # Public: Class the behaves represents a listening UDP socket.
-class UDPServerSocket:
+class UDPServerSocket (object):
   """
   This object is a wrapper around a listening
   UDP socket. It allows for accepting incoming
@@ -1901,7 +5868,12 @@ class UDPServerSocket:
   #              This is used for resource accounting.
   # sock_lock: Threading Lock on socket object used for 
   #            synchronization.
-  __slots__ = ["socketobj", "on_loopback", "sock_lock"]
+  # recv_buffer: A memoryview of a buffer large enough for any message.
+  #              This is re-used by every getmessage() call.
+  # stats: The _SocketStatistics of the socket, or None.
+  # accounting: The _AccountingBuffer of the socket, or None.
+  __slots__ = ["socketobj", "on_loopback", "sock_lock", "recv_buffer", "stats",
+               "accounting", "__weakref__"]
 
   # UDP listening socket interface
   def __init__(self, sock, on_loopback):
@@ -1926,12 +5898,23 @@ class UDPServerSocket:
     self.socketobj = sock
     self.on_loopback = on_loopback
     self.sock_lock = threading.Lock()
+    self.stats = _new_socket_statistics("udpserver", sock, False)
+    self.accounting = _new_accounting_buffer(self.sock_lock, on_loopback)
+
+    # 64K is the max that fits in the UDP header
+    self.recv_buffer = memoryview(bytearray(65535))
     
     # Set the socket to non-blocking
     # locking should be unnecessary because there isn't another external
     # reference here yet
     sock.setblocking(0)
 
+    # Track the socket so that threads can wait for it to become ready
+    _readiness_engine.register(sock)
+
+    # Reclaim the socket if this object goes away without being closed
+    _track_socket(self)
+
   def getmessage(self):
     """
     <Purpose>
@@ -1954,17 +5937,12 @@ class UDPServerSocket:
         A tuple consisting of the remote IP, remote port, and message.
 
     """
-    # Get the socket lock
-    
-    socket_lock = self.sock_lock
-    # Wait for netrecv resources
+    # Wait for netrecv resources, then get the socket lock
     if self.on_loopback:
-      nanny.tattle_quantity('looprecv',0)
+      starttime = _begin_socket_operation(self, _LOOPBACK_RECV_RESOURCES)
     else:
-      nanny.tattle_quantity('netrecv',0)
+      starttime = _begin_socket_operation(self, _NETWORK_RECV_RESOURCES)
 
-    # Acquire the lock
-    socket_lock.acquire()
     try:
       # Get the socket itself. This must be done after
       # we acquire the lock because it is possible that the
@@ -1974,16 +5952,16 @@ class UDPServerSocket:
       if mysocketobj is None:
         raise KeyError # Indicates socket is closed
 
-      # Try to get a message of any size.   (64K is the max that fits in the 
-      # UDP header)
-      message, addr = mysocketobj.recvfrom(65535)
+      # Try to get a message of any size into the receive buffer
+      bytesreceived, addr = mysocketobj.recvfrom_into(self.recv_buffer)
+      message = self.recv_buffer[:bytesreceived].tobytes()
       remote_ip, remote_port = addr
 
+      if self.stats is not None:
+        self.stats.bytes_in += bytesreceived
+
       # Do some resource accounting
-      if self.on_loopback:
-        nanny.tattle_quantity('looprecv', 64 + len(message))
-      else:
-        nanny.tattle_quantity('netrecv', 64 + len(message))
+      _charge_socket(self, 64 + bytesreceived, 0)
 
       # Return everything
       return (remote_ip, remote_port, message)
@@ -1999,6 +5977,8 @@ class UDPServerSocket:
     except Exception, e:
       # Check if this is a would-block error
       if _is_recoverable_network_exception(e):
+        if self.stats is not None:
+          self.stats.would_block += 1
         raise SocketWouldBlockError("No messages currently available!")
 
       else: 
@@ -2008,7 +5988,101 @@ class UDPServerSocket:
 
     finally:
       # Release the lock
-      socket_lock.release()
+      _end_socket_operation(self, starttime)
+
+
+
+  def getmessages(self, maxcount):
+    """
+    <Purpose>
+        Obtains up to maxcount incoming messages at once. This is
+        equivalent to calling getmessage() until it would block, but
+        the lock and resources are only acquired once.
+
+    <Arguments>
+        maxcount: The maximum number of messages to return.
+
+    <Exceptions>
+        RepyArgumentError if maxcount is not a positive int.
+        SocketClosedLocal if UDPServerSocket.close() was called.
+        Raises SocketWouldBlockError if no messages are available.
+
+    <Side Effects>
+        None
+
+    <Resource Consumption>
+        This operation consumes 64 + size of message bytes of netrecv
+        for each message.
+
+    <Returns>
+        A list of (remote IP, remote port, message) tuples. This is
+        never empty.
+    """
+    if type(maxcount) is not int:
+      raise RepyArgumentError("Provided maxcount must be an int!")
+    if maxcount < 1:
+      raise RepyArgumentError("Provided maxcount must be positive! Count: "+str(maxcount))
+
+    messages = []
+    bytesreceived_total = 0
+
+    # Wait for netrecv resources, then get the socket lock
+    if self.on_loopback:
+      starttime = _begin_socket_operation(self, _LOOPBACK_RECV_RESOURCES)
+    else:
+      starttime = _begin_socket_operation(self, _NETWORK_RECV_RESOURCES)
+
+    try:
+      mysocketobj = self.socketobj
+      if mysocketobj is None:
+        raise KeyError # Indicates socket is closed
+
+      # Drain messages until we have enough or would block
+      recv_buffer = self.recv_buffer
+      while len(messages) < maxcount:
+        try:
+          bytesreceived, addr = mysocketobj.recvfrom_into(recv_buffer)
+        except Exception, e:
+          if messages and _is_recoverable_network_exception(e):
+            break
+          raise
+
+        remote_ip, remote_port = addr
+        messages.append((remote_ip, remote_port, recv_buffer[:bytesreceived].tobytes()))
+        bytesreceived_total += 64 + bytesreceived
+
+      if self.stats is not None:
+        self.stats.bytes_in += bytesreceived_total - 64 * len(messages)
+
+      return messages
+
+    except KeyError:
+      # Socket is closed
+      raise SocketClosedLocal("The socket has been closed!")
+
+    except RepyException:
+      # Let these through from the inner block
+      raise
+
+    except Exception, e:
+      # Check if this is a would-block error
+      if _is_recoverable_network_exception(e):
+        if self.stats is not None:
+          self.stats.would_block += 1
+        raise SocketWouldBlockError("No messages currently available!")
+
+      else:
+        # Unexpected, close the socket, and then raise SocketClosedLocal
+        _cleanup_socket(self)
+        raise SocketClosedLocal("Unexpected error, socket closed!")
+
+    finally:
+      # Do the resource accounting for the whole batch
+      if bytesreceived_total:
+        _charge_socket(self, bytesreceived_total, 0)
+
+      # Release the lock
+      _end_socket_operation(self, starttime)
 
 
 
@@ -2049,11 +6123,6 @@ class UDPServerSocket:
 
     finally:
       socket_lock.release()
- 
-
-  def __del__(self):
-    # Clean up global resources on garbage collection.
-    self.close()
 
 
 
@@ -2074,9 +6143,11 @@ class TCPServerSocket (object):
   #            synchronization.
   # on_loopback: true if the remote ip is a loopback address.
   #              this is used for resource accounting.
+  # stats: The _SocketStatistics of the socket, or None.
+  # accounting: The _AccountingBuffer of the socket, or None.
   #
 
-  __slots__ = ["socketobj", "on_loopback", "sock_lock"]
+  __slots__ = ["socketobj", "on_loopback", "sock_lock", "stats", "accounting", "__weakref__"]
   def __init__(self, sock, on_loopback):
     """
     <Purpose>
@@ -2100,11 +6171,19 @@ class TCPServerSocket (object):
     self.socketobj = sock
     self.sock_lock = threading.Lock()
     self.on_loopback = on_loopback     
+    self.stats = _new_socket_statistics("tcpserver", sock, False)
+    self.accounting = _new_accounting_buffer(self.sock_lock, on_loopback)
 
     # Set the socket to non-blocking
     # locking should be unnecessary because there isn't another external
     # reference here yet
     sock.setblocking(0)
+
+    # Track the socket so that threads can wait for it to become ready
+    _readiness_engine.register(sock)
+
+    # Reclaim the socket if this object goes away without being closed
+    _track_socket(self)
         
 
 
@@ -2129,19 +6208,16 @@ class TCPServerSocket (object):
     <Returns>
       A tuple containing: (remote ip, remote port, socket object)
     """
-    # Get the socket lock
-    socket_lock = self.sock_lock
+    # Release sockets that were dropped without being closed, as they may
+    # hold the outsocket we need
+    reclaim_sockets()
 
-    # Wait for netsend and netrecv resources
+    # Wait for netsend and netrecv resources, then get the socket lock
     if self.on_loopback:
-      nanny.tattle_quantity('looprecv',0)
-      nanny.tattle_quantity('loopsend',0)
+      starttime = _begin_socket_operation(self, _LOOPBACK_RESOURCES)
     else:
-      nanny.tattle_quantity('netrecv',0)
-      nanny.tattle_quantity('netsend',0)
+      starttime = _begin_socket_operation(self, _NETWORK_RESOURCES)
 
-    # Acquire the lock
-    socket_lock.acquire()
     try:
       # Get the socket itself. This must be done after
       # we acquire the lock because it is possible that the
@@ -2153,31 +6229,148 @@ class TCPServerSocket (object):
 
       # Try to accept
       new_socket, remote_host_info = socket.accept()
-      remote_ip, remote_port = remote_host_info
-      
-      # Get new_socket id to register new_socket with nanny
-      new_sockid = id(new_socket)
-      # Check if remote_ip is on loopback
-      is_on_loopback = _is_loopback_ipaddr(remote_ip)
+
       # Do some resource accounting
-      if self.on_loopback:
-        nanny.tattle_quantity('looprecv', 128)
-        nanny.tattle_quantity('loopsend', 64)
-      else:
-        nanny.tattle_quantity('netrecv', 128)
-        nanny.tattle_quantity('netsend', 64)
+      _charge_socket(self, 128, 64)
 
-      try:
-        nanny.tattle_add_item('outsockets', new_sockid)
-      except ResourceExhaustedError:
-        # Close the socket, and raise
-        new_socket.close()
-        raise
+      # Return everything
+      return self._wrap_accepted(new_socket, remote_host_info)
 
-      wrapped_socket = EmulatedSocket(new_socket, is_on_loopback)
+    except KeyError:
+      # Socket is closed
+      raise SocketClosedLocal("The socket has been closed!")
+  
+    except RepyException:
+      # Let these through from the inner block
+      raise
 
-      # Return everything
-      return (remote_ip, remote_port, wrapped_socket)
+    except Exception, e:
+      # Check if this is a would-block error
+      if _is_recoverable_network_exception(e):
+        if self.stats is not None:
+          self.stats.would_block += 1
+        raise SocketWouldBlockError("No connections currently available!")
+
+      else: 
+        # Unexpected, close the socket, and then raise SocketClosedLocal
+        _cleanup_socket(self)       
+        raise SocketClosedLocal("Unexpected error, socket closed!")
+
+    finally:
+      # Release the lock
+      _end_socket_operation(self, starttime)
+
+
+  def _wrap_accepted(self, new_socket, remote_host_info):
+    """
+    <Purpose>
+      Private method to register an accepted socket with nanny and wrap
+      it. Called when the socket lock is held.
+
+    <Arguments>
+      new_socket: The socket returned by accept()
+      remote_host_info: The address returned by accept()
+
+    <Exceptions>
+      ResourceExhaustedError if there are no free outsockets. The socket
+      is closed.
+
+    <Returns>
+      A tuple containing: (remote ip, remote port, socket object)
+    """
+    remote_ip, remote_port = remote_host_info
+
+    # Get new_socket id to register new_socket with nanny
+    new_sockid = id(new_socket)
+    # Check if remote_ip is on loopback
+    is_on_loopback = _get_address_info(remote_ip)[1]
+
+    try:
+      _tattle_add_outsocket(new_sockid)
+    except ResourceExhaustedError:
+      # Close the socket, and raise
+      new_socket.close()
+      raise
+
+    wrapped_socket = EmulatedSocket(new_socket, is_on_loopback)
+
+    return (remote_ip, remote_port, wrapped_socket)
+
+
+
+  def getconnections(self, maxcount):
+    """
+    <Purpose>
+      Accepts up to maxcount incoming connections at once. This is
+      equivalent to calling getconnection() until it would block, but
+      the lock and resources are only acquired once.
+
+    <Arguments>
+      maxcount: The maximum number of connections to accept.
+
+    <Exceptions>
+      Raises RepyArgumentError if maxcount is not a positive int.
+      Raises SocketClosedLocal if close() has been called.
+      Raises SocketWouldBlockError if no connections are available.
+      Raises ResourcesExhaustedError if there are no free outsockets for
+      the first connection. Otherwise the connections accepted so far are
+      returned, and the next call raises it.
+      Raises SocketClosedLocal, and closes the socket, on an unexpected
+      error while accepting the first connection. As above, later ones
+      are left to the next call.
+
+    <Resource Consumption>
+      As with getconnection(), for each connection.
+
+    <Returns>
+      A list of (remote ip, remote port, socket object) tuples. This is
+      never empty.
+    """
+    if type(maxcount) is not int:
+      raise RepyArgumentError("Provided maxcount must be an int!")
+    if maxcount < 1:
+      raise RepyArgumentError("Provided maxcount must be positive! Count: "+str(maxcount))
+
+    # Release sockets that were dropped without being closed, as they may
+    # hold the outsockets we need
+    reclaim_sockets()
+
+    connections = []
+    accepted = 0
+
+    # Wait for netsend and netrecv resources, then get the socket lock
+    if self.on_loopback:
+      starttime = _begin_socket_operation(self, _LOOPBACK_RESOURCES)
+    else:
+      starttime = _begin_socket_operation(self, _NETWORK_RESOURCES)
+
+    try:
+      socket = self.socketobj
+      if socket is None:
+        raise KeyError # Indicates socket is closed
+
+      # Drain the accept queue until we have enough or would block
+      while len(connections) < maxcount:
+        try:
+          new_socket, remote_host_info = socket.accept()
+        except Exception, e:
+          # Return what we have. An error that is not because we would
+          # block will happen again on the next call, and be raised then,
+          # so the connections we accepted are not lost.
+          if connections:
+            break
+          raise
+
+        accepted += 1
+        try:
+          connections.append(self._wrap_accepted(new_socket, remote_host_info))
+        except ResourceExhaustedError:
+          # This connection is lost either way, as with getconnection()
+          if connections:
+            break
+          raise
+
+      return connections
 
     except KeyError:
       # Socket is closed
@@ -2190,6 +6383,8 @@ class TCPServerSocket (object):
     except Exception, e:
       # Check if this is a would-block error
       if _is_recoverable_network_exception(e):
+        if self.stats is not None:
+          self.stats.would_block += 1
         raise SocketWouldBlockError("No connections currently available!")
 
       else: 
@@ -2198,8 +6393,12 @@ class TCPServerSocket (object):
         raise SocketClosedLocal("Unexpected error, socket closed!")
 
     finally:
+      # Do the resource accounting for the whole batch
+      if accepted:
+        _charge_socket(self, 128 * accepted, 64 * accepted)
+
       # Release the lock
-      socket_lock.release()
+      _end_socket_operation(self, starttime)
 
 
   def close(self):
@@ -2238,9 +6437,5 @@ class TCPServerSocket (object):
 
     finally:
       socket_lock.release()
- 
 
-  def __del__(self):
-    # Close the socket
-    self.close()
 
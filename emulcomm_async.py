@@ -0,0 +1,768 @@
+"""
+   Description:
+
+   An event loop facade over the emulcomm network API, for trusted
+   services that want to drive many sockets from one thread rather than
+   a thread per connection.
+
+   Python 2 has no asyncio, so coroutines are generators. A coroutine
+   yields a Future (or another coroutine) and is resumed with its result,
+   or has its exception raised at the yield. Use "raise Return(value)"
+   to return a value from a coroutine. For example:
+
+     def echo(sock):
+       while True:
+         data = yield emulcomm_async.recv(sock, 4096)
+         yield emulcomm_async.sendall(sock, data)
+
+     def serve():
+       server = emulcomm_async.listenforconnection("127.0.0.1", 12345)
+       while True:
+         (ip, port, sock) = yield emulcomm_async.getconnection(server)
+         emulcomm_async.get_event_loop().spawn(echo(sock))
+
+     emulcomm_async.get_event_loop().run_until_complete(serve())
+
+   Every operation is carried out by the real emulcomm functions and
+   methods, so the argument, IP and port checks and the nanny accounting
+   are exactly those of emulcomm. The loop only waits for sockets to
+   become ready instead of blocking. Note that if nanny throttles an
+   operation, the whole loop is paused for that time.
+"""
+
+import socket
+import select
+import threading
+import heapq
+import collections
+import sys
+import os
+import traceback
+
+import nonportable
+import emulcomm
+
+from exception_hierarchy import *
+
+# These are non-blocking already, and are provided for convenience
+listenforconnection = emulcomm.listenforconnection
+listenformessage = emulcomm.listenformessage
+sendmessage = emulcomm.sendmessage
+
+
+
+class Return(Exception):
+  """
+  Raised by a coroutine to return a value, as generators cannot
+  return values in Python 2.
+  """
+  def __init__(self, value=None):
+    Exception.__init__(self)
+    self.value = value
+
+
+
+class Future(object):
+  """
+  The result of an operation that has not finished yet.
+  """
+  __slots__ = ["_done", "_result", "_exc_info", "_callbacks"]
+
+  def __init__(self):
+    self._done = False
+    self._result = None
+    self._exc_info = None
+    self._callbacks = []
+
+
+  def done(self):
+    return self._done
+
+
+  def result(self):
+    """
+    Returns the result, or raises the exception, of the operation.
+    """
+    if not self._done:
+      raise InternalRepyError("The result of the future is not available yet!")
+    if self._exc_info is not None:
+      raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+    return self._result
+
+
+  def set_result(self, result):
+    if self._done:
+      return
+    self._result = result
+    self._finish()
+
+
+  def set_exception(self, exc_info):
+    """
+    Finishes the future with an exception. exc_info is a tuple as
+    returned by sys.exc_info().
+    """
+    if self._done:
+      return
+    self._exc_info = exc_info
+    self._finish()
+
+
+  def add_done_callback(self, callback):
+    """
+    Calls callback(future) once the future is done.
+    """
+    if self._done:
+      callback(self)
+    else:
+      self._callbacks.append(callback)
+
+
+  def _finish(self):
+    self._done = True
+    callbacks = self._callbacks
+    self._callbacks = []
+    for callback in callbacks:
+      callback(self)
+
+
+
+class _UnobservedExceptionReport(object):
+  """
+  Writes the traceback of a task's exception to sys.stderr when it is
+  freed, unless the exception was looked at first. The traceback is
+  formatted up front, so this holds no frames that could keep it alive.
+  """
+  __slots__ = ["lines"]
+
+  def __init__(self, exc_info):
+    self.lines = traceback.format_exception(exc_info[0], exc_info[1], exc_info[2])
+
+
+  def __del__(self):
+    if self.lines is None:
+      return
+    try:
+      sys.stderr.write("Exception in a task that nothing waited for:\n")
+      sys.stderr.writelines(self.lines)
+    except Exception:
+      pass
+
+
+
+class Task(Future):
+  """
+  Runs a coroutine on an event loop. The task is done when the
+  coroutine finishes.
+  """
+  __slots__ = ["_loop", "_coroutine", "_observed", "_report"]
+
+  def __init__(self, loop, coroutine):
+    Future.__init__(self)
+    self._loop = loop
+    self._coroutine = coroutine
+    # Whether anything has waited for the task or asked for its result,
+    # and the report of an exception that nothing has seen yet
+    self._observed = False
+    self._report = None
+    loop.call_soon(self._step, None, None)
+
+
+  def result(self):
+    self._observe()
+    return Future.result(self)
+
+
+  def add_done_callback(self, callback):
+    self._observe()
+    Future.add_done_callback(self, callback)
+
+
+  def _observe(self):
+    # The exception, if there is one, will be seen, so do not report it
+    self._observed = True
+    if self._report is not None:
+      self._report.lines = None
+      self._report = None
+
+
+  def set_exception(self, exc_info):
+    """
+    As Future.set_exception(). If nothing has waited for the task, the
+    exception is reported when the task is freed, unless its result is
+    asked for by then.
+    """
+    if not self._done and not self._observed:
+      self._report = _UnobservedExceptionReport(exc_info)
+    Future.set_exception(self, exc_info)
+
+
+  def _step(self, value, exc_info):
+    try:
+      if exc_info is not None:
+        yielded = self._coroutine.throw(exc_info[0], exc_info[1], exc_info[2])
+      else:
+        yielded = self._coroutine.send(value)
+    except StopIteration:
+      self.set_result(None)
+      return
+    except Return, e:
+      self.set_result(e.value)
+      return
+    except Exception:
+      self.set_exception(sys.exc_info())
+      return
+
+    # A coroutine may yield another coroutine, which runs as a sub-task
+    if hasattr(yielded, "send") and hasattr(yielded, "throw"):
+      yielded = Task(self._loop, yielded)
+
+    if yielded is None:
+      # A bare yield lets other tasks run
+      self._loop.call_soon(self._step, None, None)
+    elif isinstance(yielded, Future):
+      yielded.add_done_callback(self._wakeup)
+    else:
+      self._loop.call_soon(self._step, None, (RepyArgumentError,
+          RepyArgumentError("Coroutines must yield a Future or a coroutine, not "+str(type(yielded))), None))
+
+
+  def _wakeup(self, future):
+    # Resume from the event loop, never from inside another task
+    if future._exc_info is not None:
+      self._loop.call_soon(self._step, None, future._exc_info)
+    else:
+      self._loop.call_soon(self._step, future._result, None)
+
+
+
+class EventLoop(object):
+  """
+  A single threaded event loop which waits for socket readiness with
+  epoll (or select, where epoll is not available) and runs timers.
+  Except for call_soon_threadsafe(), it must only be used from the
+  thread that runs it.
+  """
+
+  def __init__(self):
+    # Callbacks that are ready to run, as (function, args) tuples
+    self._ready = collections.deque()
+    # A heap of [when, sequence, function, args] timers. A cancelled
+    # timer has its function set to None.
+    self._timers = []
+    self._timer_sequence = 0
+    # Maps fd -> [realsock, list of read futures, list of write futures]
+    self._waiting = {}
+    self._stopping = False
+
+    if hasattr(select, "epoll"):
+      self._epoll = select.epoll()
+    else:
+      self._epoll = None
+
+    # Other threads write to this pipe to wake the loop up
+    self._wakepipe = os.pipe()
+    self._threadsafe_lock = threading.Lock()
+    self._threadsafe_ready = []
+    self._add_waker()
+
+
+  ##### Scheduling
+
+  def call_soon(self, function, *args):
+    self._ready.append((function, args))
+
+
+  def call_soon_threadsafe(self, function, *args):
+    """
+    Schedules function(*args) from another thread.
+    """
+    self._threadsafe_lock.acquire()
+    try:
+      self._threadsafe_ready.append((function, args))
+    finally:
+      self._threadsafe_lock.release()
+    try:
+      os.write(self._wakepipe[1], "x")
+    except OSError:
+      pass
+
+
+  def call_later(self, delay, function, *args):
+    """
+    Runs function(*args) after delay seconds. Returns a handle that can
+    be passed to cancel_timer().
+    """
+    self._timer_sequence += 1
+    timer = [nonportable.getruntime() + delay, self._timer_sequence, function, args]
+    heapq.heappush(self._timers, timer)
+    return timer
+
+
+  def cancel_timer(self, timer):
+    timer[2] = None
+
+
+  def spawn(self, coroutine):
+    """
+    Starts running a coroutine, and returns its Task.
+    """
+    return Task(self, coroutine)
+
+
+  def sleep(self, seconds):
+    """
+    Returns a Future that is done after seconds.
+    """
+    future = Future()
+    self.call_later(seconds, future.set_result, None)
+    return future
+
+
+  ##### Socket readiness
+
+  def wait_for_socket(self, realsock, waitfor, timeout=None):
+    """
+    <Purpose>
+      Waits for a real socket to become readable ("r") or writable ("w").
+
+    <Arguments>
+      realsock: A Python socket object.
+      waitfor: "r" or "w"
+      timeout: The maximum time to wait, or None to wait forever.
+
+    <Returns>
+      A Future whose result is True if the socket became ready, or False
+      if the timeout expired.
+    """
+    future = Future()
+    fd = realsock.fileno()
+    entry = self._waiting.get(fd)
+    if entry is None:
+      entry = [realsock, [], []]
+      self._waiting[fd] = entry
+      isnew = True
+    else:
+      isnew = False
+
+    if waitfor == "r":
+      entry[1].append(future)
+    else:
+      entry[2].append(future)
+    self._update_interest(fd, entry, isnew)
+
+    if timeout is not None:
+      timer = self.call_later(timeout, self._expire_wait, fd, future)
+      future.add_done_callback(lambda future: self.cancel_timer(timer))
+
+    return future
+
+
+  def _expire_wait(self, fd, future):
+    entry = self._waiting.get(fd)
+    if entry is not None:
+      for futures in (entry[1], entry[2]):
+        if future in futures:
+          futures.remove(future)
+      self._update_interest(fd, entry, False)
+    future.set_result(False)
+
+
+  def _update_interest(self, fd, entry, isnew):
+    # Makes the poller watch for what the waiters of fd want
+    if not entry[1] and not entry[2]:
+      del self._waiting[fd]
+      if self._epoll is not None and not isnew:
+        try:
+          self._epoll.unregister(fd)
+        except (IOError, OSError, ValueError):
+          pass
+      return
+
+    if self._epoll is None:
+      return
+
+    mask = select.EPOLLERR | select.EPOLLHUP
+    if entry[1]:
+      mask |= select.EPOLLIN | select.EPOLLPRI
+    if entry[2]:
+      mask |= select.EPOLLOUT
+
+    try:
+      if isnew:
+        self._epoll.register(fd, mask)
+      else:
+        self._epoll.modify(fd, mask)
+    except (IOError, OSError):
+      # The socket was closed, let the waiters find out for themselves
+      self._wake_waiters(fd, True, True)
+
+
+  def _wake_waiters(self, fd, readable, writable):
+    entry = self._waiting.get(fd)
+    if entry is None:
+      return
+
+    woken = []
+    if readable:
+      woken.extend(entry[1])
+      entry[1] = []
+    if writable:
+      woken.extend(entry[2])
+      entry[2] = []
+    self._update_interest(fd, entry, False)
+
+    for future in woken:
+      future.set_result(True)
+
+
+  def _add_waker(self):
+    readfd = self._wakepipe[0]
+    if self._epoll is not None:
+      self._epoll.register(readfd, select.EPOLLIN)
+
+
+  def _poll(self, timeout):
+    # Waits for up to timeout seconds (None means forever), and wakes
+    # the waiters of every socket that is ready.
+    readfd = self._wakepipe[0]
+
+    if self._epoll is not None:
+      if timeout is None:
+        timeout = -1
+      try:
+        events = self._epoll.poll(timeout)
+      except (IOError, OSError, select.error):
+        # Interrupted by a signal
+        return
+
+      for (fd, event) in events:
+        if fd == readfd:
+          self._drain_waker()
+          continue
+        failed = event & (select.EPOLLERR | select.EPOLLHUP)
+        self._wake_waiters(fd, failed or event & (select.EPOLLIN | select.EPOLLPRI),
+                           failed or event & select.EPOLLOUT)
+      return
+
+    readlist = [readfd]
+    writelist = []
+    for (fd, entry) in self._waiting.items():
+      if entry[1]:
+        readlist.append(entry[0])
+      if entry[2]:
+        writelist.append(entry[0])
+
+    try:
+      (readable, writable, failed) = select.select(readlist, writelist, writelist, timeout)
+    except (select.error, socket.error, ValueError):
+      # A socket was closed from under us, wake everyone to find out
+      for fd in self._waiting.keys():
+        self._wake_waiters(fd, True, True)
+      return
+
+    if readfd in readable:
+      self._drain_waker()
+    for realsock in readable:
+      if realsock != readfd:
+        self._wake_waiters(realsock.fileno(), True, False)
+    for realsock in writable + failed:
+      self._wake_waiters(realsock.fileno(), realsock in failed, True)
+
+
+  def _drain_waker(self):
+    try:
+      os.read(self._wakepipe[0], 4096)
+    except OSError:
+      pass
+    self._threadsafe_lock.acquire()
+    try:
+      self._ready.extend(self._threadsafe_ready)
+      self._threadsafe_ready = []
+    finally:
+      self._threadsafe_lock.release()
+
+
+  ##### Running
+
+  def _run_once(self):
+    # Work out how long we can wait for
+    if self._ready:
+      timeout = 0
+    elif self._timers:
+      timeout = max(0, self._timers[0][0] - nonportable.getruntime())
+    else:
+      timeout = None
+
+    self._poll(timeout)
+
+    # Move the expired timers to the ready queue
+    now = nonportable.getruntime()
+    while self._timers and self._timers[0][0] <= now:
+      timer = heapq.heappop(self._timers)
+      if timer[2] is not None:
+        self._ready.append((timer[2], timer[3]))
+
+    # Run only the callbacks that are ready now, new ones wait a round
+    for count in xrange(len(self._ready)):
+      (function, args) = self._ready.popleft()
+      function(*args)
+
+
+  def stop(self):
+    self._stopping = True
+
+
+  def run_forever(self):
+    """
+    Runs the loop until stop() is called.
+    """
+    self._stopping = False
+    while not self._stopping:
+      self._run_once()
+
+
+  def run_until_complete(self, future):
+    """
+    <Purpose>
+      Runs the loop until a Future or coroutine is done.
+
+    <Arguments>
+      future: A Future, or a coroutine which is started as a Task.
+
+    <Exceptions>
+      Whatever the coroutine raised.
+
+    <Returns>
+      The result of the Future.
+    """
+    if not isinstance(future, Future):
+      future = self.spawn(future)
+
+    # Any exception is raised to our caller, so it is not unobserved
+    future.add_done_callback(lambda future: None)
+
+    while not future.done():
+      self._run_once()
+    return future.result()
+
+
+  def close(self):
+    if self._epoll is not None:
+      self._epoll.close()
+    os.close(self._wakepipe[0])
+    os.close(self._wakepipe[1])
+
+
+
+# Each thread has its own default loop
+_loops = threading.local()
+
+def get_event_loop():
+  """
+  Returns the event loop of the current thread, creating it if needed.
+  """
+  loop = getattr(_loops, "loop", None)
+  if loop is None:
+    loop = EventLoop()
+    _loops.loop = loop
+  return loop
+
+
+
+##### Network operations
+
+# How long to wait for a socket before retrying anyway, in case it was
+# closed while we were waiting
+_RETRY_TIMEOUT = 1.0
+
+def _when_ready(sockobj, waitfor, operation, *args):
+  # Calls operation(*args) until it does not raise SocketWouldBlockError,
+  # waiting for sockobj to become ready in between.
+  while True:
+    try:
+      raise Return(operation(*args))
+    except SocketWouldBlockError:
+      pass
+
+    # If the traffic shaper is out of tokens, the socket may be ready but
+    # unusable, so wait for the tokens instead
+    delay = emulcomm._shaping_delay([sockobj], waitfor)
+    if delay > 0:
+      yield get_event_loop().sleep(delay)
+      continue
+
+    realsock = sockobj.socketobj
+    if realsock is None:
+      # The socket was closed, the operation will say so
+      continue
+    yield get_event_loop().wait_for_socket(realsock, waitfor, _RETRY_TIMEOUT)
+
+
+
+def gethostbyname(name):
+  """
+  <Purpose>
+    A coroutine that resolves a host name without blocking the loop. The
+    lookup is done by the emulcomm resolver threads, and shares the
+    emulcomm cache.
+
+  <Arguments>
+    As with emulcomm.gethostbyname().
+
+  <Exceptions>
+    As with emulcomm.gethostbyname().
+
+  <Resource Consumption>
+    As with emulcomm.gethostbyname().
+
+  <Returns>
+    The IPv4 address as a string.
+  """
+  if type(name) is not str:
+    raise RepyArgumentError("gethostbyname() takes a string as argument.")
+
+  # There is nothing to look up for an IP
+  if emulcomm._is_dotted_quad(name):
+    raise Return(name)
+
+  loop = get_event_loop()
+  future = Future()
+
+  def resolved(ip):
+    loop.call_soon_threadsafe(future.set_result, ip)
+
+  emulcomm._lookup_hostname(name, resolved)
+  ip = yield future
+
+  if ip is None:
+    raise NetworkAddressError("The hostname '"+name+"' could not be resolved.")
+  raise Return(ip)
+
+
+
+def openconnection(destip, destport, localip, localport, timeout):
+  """
+  <Purpose>
+    A coroutine that opens a TCP connection without blocking the loop.
+
+  <Arguments>
+    As with emulcomm.openconnection().
+
+  <Exceptions>
+    As with emulcomm.openconnection().
+
+  <Resource Consumption>
+    As with emulcomm.openconnection().
+
+  <Returns>
+    An EmulatedSocket.
+  """
+  (on_loopback, identity) = emulcomm._begin_openconnection(destip, destport, localip, localport, timeout)
+
+  starttime = nonportable.getruntime()
+  loop = get_event_loop()
+  sock = None
+
+  try:
+    sock = emulcomm._get_tcp_socket(localip, localport)
+    sock.setblocking(0)
+    errnum = sock.connect_ex((destip, destport))
+
+    while errnum != 0:
+      (in_progress, remaining) = emulcomm._next_connect_wait(errnum, starttime, timeout)
+
+      if in_progress:
+        # The socket becomes writable once the connect has finished
+        writable = yield loop.wait_for_socket(sock, "w", remaining)
+        if writable:
+          errnum = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+      else:
+        yield loop.sleep(min(emulcomm.RETRY_INTERVAL, remaining))
+        errnum = sock.connect_ex((destip, destport))
+
+  except Exception, e:
+    if sock is not None:
+      sock.close()
+    emulcomm._raise_openconnection_error(e, identity)
+
+  raise Return(emulcomm._finish_openconnection(sock, on_loopback))
+
+
+
+def getconnection(serversocket):
+  """
+  A coroutine that waits for a connection on a TCPServerSocket, and
+  returns (remote ip, remote port, EmulatedSocket) as getconnection().
+  """
+  return _when_ready(serversocket, "r", serversocket.getconnection)
+
+
+def getconnections(serversocket, maxcount):
+  """
+  A coroutine that waits for connections on a TCPServerSocket, and
+  returns up to maxcount of them as getconnections().
+  """
+  return _when_ready(serversocket, "r", serversocket.getconnections, maxcount)
+
+
+def recv(sock, bytes):
+  """
+  A coroutine that waits for data on an EmulatedSocket, and returns up
+  to bytes of it as recv().
+  """
+  return _when_ready(sock, "r", sock.recv, bytes)
+
+
+def recvexactly(sock, bytes):
+  """
+  A coroutine that returns exactly bytes of data from an EmulatedSocket.
+  """
+  return _when_ready(sock, "r", sock.recvexactly, bytes)
+
+
+def recvuntil(sock, delimiter, maxbytes):
+  """
+  A coroutine that returns data from an EmulatedSocket up to and
+  including delimiter, as recvuntil().
+  """
+  return _when_ready(sock, "r", sock.recvuntil, delimiter, maxbytes)
+
+
+def send(sock, message):
+  """
+  A coroutine that waits until an EmulatedSocket can take data, and
+  returns the number of bytes of message sent as send().
+  """
+  return _when_ready(sock, "w", sock.send, message)
+
+
+def sendall(sock, message):
+  """
+  A coroutine that sends all of message on an EmulatedSocket, and
+  returns its length.
+  """
+  sent = 0
+  while sent < len(message):
+    if sent:
+      count = yield send(sock, message[sent:])
+    else:
+      count = yield send(sock, message)
+    sent += count
+  raise Return(sent)
+
+
+def getmessage(serversocket):
+  """
+  A coroutine that waits for a message on a UDPServerSocket, and returns
+  (remote ip, remote port, message) as getmessage().
+  """
+  return _when_ready(serversocket, "r", serversocket.getmessage)
+
+
+def getmessages(serversocket, maxcount):
+  """
+  A coroutine that waits for messages on a UDPServerSocket, and returns
+  up to maxcount of them as getmessages().
+  """
+  return _when_ready(serversocket, "r", serversocket.getmessages, maxcount)
@@ -108,6 +108,13 @@
 
 import types
 
+# For the call profile.
+import atexit
+import os
+import sys
+import threading
+import time
+
 # To check if objects are thread.LockType objects.
 import thread
 
@@ -145,7 +152,7 @@ def wrap_and_insert_api_functions(usercontext):
 
   for function_name in USERCONTEXT_WRAPPER_INFO:
     function_info = USERCONTEXT_WRAPPER_INFO[function_name]
-    wrapperobj = NamespaceAPIFunctionWrapper(function_info)
+    wrapperobj = NamespaceAPIFunctionWrapper(function_info, profile_name=function_name)
     usercontext[function_name] = wrapperobj.wrapped_function
 
 
@@ -167,6 +174,7 @@ def _init_namespace():
   if not initialized:
     initialized = True
     _prepare_wrapped_functions_for_object_wrappers()
+    _enable_call_profiling_from_environment()
 
 
 
@@ -190,17 +198,20 @@ def _prepare_wrapped_functions_for_object_wrappers():
   file_object_wrapped_functions_dict have been populated and therefore can be
   used by functions such as wrap_socket_obj().
   """
-  objects_tuples = [(FILE_OBJECT_WRAPPER_INFO, file_object_wrapped_functions_dict),
-                    (LOCK_OBJECT_WRAPPER_INFO, lock_object_wrapped_functions_dict),
-                    (TCP_SOCKET_OBJECT_WRAPPER_INFO, tcp_socket_object_wrapped_functions_dict),
-                    (TCP_SERVER_SOCKET_OBJECT_WRAPPER_INFO, tcp_server_socket_object_wrapped_functions_dict),
-                    (UDP_SERVER_SOCKET_OBJECT_WRAPPER_INFO, udp_server_socket_object_wrapped_functions_dict),
-                    (VIRTUAL_NAMESPACE_OBJECT_WRAPPER_INFO, virtual_namespace_object_wrapped_functions_dict)]
-
-  for description_dict, wrapped_func_dict in objects_tuples:
+  # The last item of each tuple is the name of the type of object in the
+  # call profile, as many of the method names are shared.
+  objects_tuples = [(FILE_OBJECT_WRAPPER_INFO, file_object_wrapped_functions_dict, "file"),
+                    (LOCK_OBJECT_WRAPPER_INFO, lock_object_wrapped_functions_dict, "lock"),
+                    (TCP_SOCKET_OBJECT_WRAPPER_INFO, tcp_socket_object_wrapped_functions_dict, "socket"),
+                    (TCP_SERVER_SOCKET_OBJECT_WRAPPER_INFO, tcp_server_socket_object_wrapped_functions_dict, "tcpserversocket"),
+                    (UDP_SERVER_SOCKET_OBJECT_WRAPPER_INFO, udp_server_socket_object_wrapped_functions_dict, "udpserversocket"),
+                    (VIRTUAL_NAMESPACE_OBJECT_WRAPPER_INFO, virtual_namespace_object_wrapped_functions_dict, "VirtualNamespace")]
+
+  for description_dict, wrapped_func_dict, type_name in objects_tuples:
     for function_name in description_dict:
       function_info = description_dict[function_name]
-      wrapperobj = NamespaceAPIFunctionWrapper(function_info, is_method=True)
+      wrapperobj = NamespaceAPIFunctionWrapper(function_info, is_method=True,
+                                               profile_name=type_name + "." + function_name)
       wrapped_func_dict[function_name] = wrapperobj.wrapped_function
 
 
@@ -215,12 +226,28 @@ def _handle_internalerror(message, exitcode):
   """
   Terminate the running program. This is used rather than
   tracebackrepy.handle_internalerror directly in order to make testing easier."""
+  # The program is ended with harshexit(), which skips the atexit handlers
+  if _call_profile_interval:
+    write_call_profile_report()
   tracebackrepy.handle_internalerror(message, exitcode)
 
 
 
 
 
+def _exitall():
+  """
+  The exitall() exported to user code. The program is ended with harshexit(),
+  which skips the atexit handlers, so the call profile is written first.
+  """
+  if _call_profile_interval:
+    write_call_profile_report()
+  emulmisc.exitall()
+
+
+
+
+
 def _is_in(obj, sequence):
   """
   A helper function to do identity ("is") checks instead of equality ("==")
@@ -309,6 +336,13 @@ class Str(ValueProcessor):
 
 
 
+  def copy(self, val):
+    # Strings are immutable, and check() only allows the exact types, so there is
+    # nothing to copy.
+    return val
+
+
+
 
 
 class Int(ValueProcessor):
@@ -327,6 +361,13 @@ class Int(ValueProcessor):
       raise RepyArgumentError("Min value is %s." % self.min)
 
 
+
+  def copy(self, val):
+    # Ints are immutable, and check() only allows the exact types, so there is
+    # nothing to copy.
+    return val
+
+
 class NoneOrInt(ValueProcessor):
   """Allows a NoneType or an int. This doesn't enforce min limit on the
   ints."""
@@ -370,6 +411,13 @@ class Float(ValueProcessor):
 
 
 
+  def copy(self, val):
+    # Numbers are immutable, and check() only allows the exact types, so there is
+    # nothing to copy.
+    return val
+
+
+
 
 
 class Bool(ValueProcessor):
@@ -398,6 +446,44 @@ class ListOfStr(ValueProcessor):
 
 
 
+class ListOfMessages(ValueProcessor):
+  """Allows lists of (ip, port, message) tuples, as used by sendmessages and
+  getmessages. This doesn't enforce max/min/length limits on the strings and
+  ints."""
+
+  def check(self, val):
+    if not type(val) is list:
+      raise RepyArgumentError("Invalid type %s" % type(val))
+
+    for item in val:
+      if not type(item) is tuple or len(item) != 3:
+        raise RepyArgumentError("Invalid message %s" % type(item))
+      Str().check(item[0])
+      Int().check(item[1])
+      Str().check(item[2])
+
+
+
+
+
+class ListOfAddresses(ValueProcessor):
+  """Allows lists of (ip, port) tuples. This doesn't enforce max/min/length
+  limits on the strings and ints."""
+
+  def check(self, val):
+    if not type(val) is list:
+      raise RepyArgumentError("Invalid type %s" % type(val))
+
+    for item in val:
+      if not type(item) is tuple or len(item) != 2:
+        raise RepyArgumentError("Invalid address %s" % type(item))
+      Str().check(item[0])
+      Int().check(item[1])
+
+
+
+
+
 class List(ValueProcessor):
   """Allows lists. The list may contain anything."""
   
@@ -545,6 +631,77 @@ class TCPSocket(ObjectProcessor):
 
 
 
+class Socket(ObjectProcessor):
+  """Allows TCPSocket, TCPServerSocket or UDPServerSocket objects."""
+
+  def check(self, val):
+    if not isinstance(val, (emulcomm.EmulatedSocket, emulcomm.TCPServerSocket,
+                            emulcomm.UDPServerSocket)):
+      raise RepyArgumentError("Invalid type %s" % type(val))
+
+
+
+  def unwrap(self, val):
+    if not isinstance(val, NamespaceObjectWrapper):
+      raise RepyArgumentError("Invalid type %s" % type(val))
+    return val._wrapped__object
+
+
+
+
+
+class ListOfSockets(ObjectProcessor):
+  """Allows lists of TCPSocket, TCPServerSocket or UDPServerSocket objects."""
+
+  def check(self, val):
+    if not type(val) is list:
+      raise RepyArgumentError("Invalid type %s" % type(val))
+
+    for item in val:
+      Socket().check(item)
+
+
+
+  def unwrap(self, val):
+    if not type(val) is list:
+      raise RepyArgumentError("Invalid type %s" % type(val))
+
+    unwrapped_list = []
+    for item in val:
+      unwrapped_list.append(Socket().unwrap(item))
+    return unwrapped_list
+
+
+
+
+
+class ListOfConnections(ObjectProcessor):
+  """Allows lists of (ip, port, TCPSocket) tuples, as returned by
+  getconnections."""
+
+  def check(self, val):
+    if not type(val) is list:
+      raise RepyArgumentError("Invalid type %s" % type(val))
+
+    for item in val:
+      if not type(item) is tuple or len(item) != 3:
+        raise RepyArgumentError("Invalid connection %s" % type(item))
+      Str().check(item[0])
+      Int().check(item[1])
+      TCPSocket().check(item[2])
+
+
+
+  def wrap(self, val):
+    wrapped_list = []
+    for (ip, port, sock) in val:
+      wrapped_list.append((_copy(ip), _copy(port), TCPSocket().wrap(sock)))
+    return wrapped_list
+
+
+
+
+
 class VirtualNamespace(ObjectProcessor):
   """Allows VirtualNamespace objects."""
 
@@ -609,6 +766,10 @@ USERCONTEXT_WRAPPER_INFO = {
       {'func' : emulcomm.sendmessage,
        'args' : [Str(), Int(), Str(), Str(), Int()],
        'return' : Int()},
+  'sendmessages' :
+      {'func' : emulcomm.sendmessages,
+       'args' : [ListOfMessages(), Str(), Int()],
+       'return' : List()},
   'listenformessage' :
       {'func' : emulcomm.listenformessage,
        'args' : [Str(), Int()],
@@ -619,10 +780,22 @@ USERCONTEXT_WRAPPER_INFO = {
 #      'raise' : [AddressBindingError, PortRestrictedError, PortInUseError,
 #                 ConnectionRefusedError, TimeoutError, RepyArgumentError],
        'return' : TCPSocket()},
+  'openconnections' :
+      {'func' : emulcomm.openconnections,
+       'args' : [ListOfAddresses(), Str(), Int(), Float()],
+       'return' : (Str(), Int(), TCPSocket())},
   'listenforconnection' :
       {'func' : emulcomm.listenforconnection,
        'args' : [Str(), Int()],
        'return' : TCPServerSocket()},
+  'waitforsocket' :
+      {'func' : emulcomm.waitforsocket,
+       'args' : [Socket(), Str(), Float()],
+       'return' : Bool()},
+  'waitforsockets' :
+      {'func' : emulcomm.waitforsockets,
+       'args' : [ListOfSockets(), Str(), Float()],
+       'return' : List()},
   'openfile' :
       {'func' : emulfile.emulated_open,
        'args' : [Str(maxlen=120), Bool()],
@@ -636,7 +809,7 @@ USERCONTEXT_WRAPPER_INFO = {
        'args' : [Str(maxlen=120)],
        'return' : None},
   'exitall' :
-      {'func' : emulmisc.exitall,
+      {'func' : _exitall,
        'args' : [],
        'return' : None},
   'createlock' :
@@ -702,10 +875,22 @@ TCP_SOCKET_OBJECT_WRAPPER_INFO = {
        #'args' : [Int(min=1)],
        'args' : [Int(min=0)],
        'return' : Str("")},
+  'recvexactly' :
+      {'func' : emulcomm.EmulatedSocket.recvexactly,
+       'args' : [Int(min=0)],
+       'return' : Str()},
+  'recvuntil' :
+      {'func' : emulcomm.EmulatedSocket.recvuntil,
+       'args' : [Str(minlen=1), Int(min=1)],
+       'return' : Str()},
   'send' :
       {'func' : emulcomm.EmulatedSocket.send,
        'args' : [Str()],
        'return' : Int(min=0)},
+  'sendall' :
+      {'func' : emulcomm.EmulatedSocket.sendall,
+       'args' : [Str()],
+       'return' : Int(min=0)},
 }
 
 # TODO: Figure out which real object should be wrapped. It doesn't appear
@@ -719,6 +904,10 @@ TCP_SERVER_SOCKET_OBJECT_WRAPPER_INFO = {
       {'func' : emulcomm.TCPServerSocket.getconnection,
        'args' : [],
        'return' : (Str(), Int(), TCPSocket())},
+  'getconnections' :
+      {'func' : emulcomm.TCPServerSocket.getconnections,
+       'args' : [Int(min=1)],
+       'return' : ListOfConnections()},
 }
 
 UDP_SERVER_SOCKET_OBJECT_WRAPPER_INFO = {
@@ -730,6 +919,10 @@ UDP_SERVER_SOCKET_OBJECT_WRAPPER_INFO = {
       {'func' : emulcomm.UDPServerSocket.getmessage,
        'args' : [],
        'return' : (Str(), Int(), Str())},
+  'getmessages' :
+      {'func' : emulcomm.UDPServerSocket.getmessages,
+       'args' : [Int(min=1)],
+       'return' : ListOfMessages()},
 }
 
 LOCK_OBJECT_WRAPPER_INFO = {
@@ -762,12 +955,163 @@ VIRTUAL_NAMESPACE_OBJECT_WRAPPER_INFO = {
 # The classes we define from which actual wrappers are instantiated.
 ##############################################################################
 
+# The types that _copy() returns as they are, because they are immutable or
+# are callables we want to keep. This is keyed by the id() of the type so
+# that looking up a type never calls its __hash__ or __eq__, which a
+# metaclass could define, and the value is checked to be the same type.
+# types.InstanceType is included because the user can provide an instance
+# of a class of their own in the list of callback args to settimer.
+_UNCOPIED_TYPES = {}
+for _uncopied_type in [str, unicode, int, long, float, complex, bool, frozenset,
+                       types.NoneType, types.FunctionType, types.LambdaType,
+                       types.MethodType, types.InstanceType]:
+  _UNCOPIED_TYPES[_saved_id(_uncopied_type)] = _uncopied_type
+del _uncopied_type
+
+
+
+# The most items that _copy() will copy, counting the elements of every
+# list, tuple and set and the entries of every dict it contains. Anything
+# larger is refused rather than tying up the namespace layer.
+MAX_COPY_SIZE = 1000000
+
+
+
+# _copy() keeps a list of tasks, each of which is a tuple of
+# (target, slot, obj, finish). When finish is None, the task is to copy obj
+# and store the copy in target[slot]. The tasks are popped off the end of
+# the list, so the items of a container are copied after it.
+#
+# Each type of container we copy has a start function, which is called with
+# the object, the objectmap, the task list, the target and slot, and the
+# finish function for the type. It stores a shallow copy of the object in
+# target[slot] and adds a task for each item of it that is not immutable.
+#
+# Tuples and sets can't be changed once they're created, so they are first
+# copied into a list, with a task added before those for their items to
+# turn it into the real copy. The finish function is called as
+# finish(obj, temp_list, objectmap) and returns the copy.
+
+def _start_list_copy(obj, objectmap, tasks, target, slot, finish):
+  uncopied_types_get = _UNCOPIED_TYPES.get
+  retval = obj[:]
+  # Need to save this in the objectmap before copying the items because
+  # lists might have circular references.
+  objectmap[_saved_id(obj)] = retval
+  target[slot] = retval
+
+  for index, item in enumerate(retval):
+    itemtype = type(item)
+    if uncopied_types_get(_saved_id(itemtype)) is not itemtype:
+      tasks.append((retval, index, item, None))
+
+
+
+def _start_dict_copy(obj, objectmap, tasks, target, slot, finish):
+  uncopied_types_get = _UNCOPIED_TYPES.get
+  retval = obj.copy()
+  # Need to save this in the objectmap before copying the values because
+  # dicts might have circular references.
+  objectmap[_saved_id(obj)] = retval
+  target[slot] = retval
+
+  for key, value in retval.items():
+    keytype = type(key)
+    if uncopied_types_get(_saved_id(keytype)) is not keytype:
+      # Keys are hashable, so a key can't contain anything that refers back
+      # to this dict, and can be copied right away.
+      del retval[key]
+      if keytype is tuple:
+        key = _copy(key, objectmap)
+      else:
+        key = _copy_uncontained(key)
+      retval[key] = value
+
+    valuetype = type(value)
+    if uncopied_types_get(_saved_id(valuetype)) is not valuetype:
+      tasks.append((retval, key, value, None))
+
+
+
+def _finish_tuple_copy(obj, temp_list, objectmap):
+  # I'm not 100% confident on my reasoning here, so feel free to point
+  # out where I'm wrong: There's no way for a tuple to directly contain
+  # a circular reference to itself. Instead, it has to contain, for
+  # example, a dict which has the same tuple as a value. In that
+  # situation, we can avoid infinite recursion and properly maintain
+  # circular references in our copies by checking the objectmap right
+  # after we do the copy of each item in the tuple. The existence of the
+  # dictionary would keep the recursion from being infinite because those
+  # are properly handled. That just leaves making sure we end up with
+  # only one copy of the tuple. We do that here by checking to see if we
+  # just made a copy as a result of copying the items above. If so, we
+  # return the one that's already been made.
+  if _saved_id(obj) in objectmap:
+    return objectmap[_saved_id(obj)]
+
+  retval = tuple(temp_list)
+  objectmap[_saved_id(obj)] = retval
+  return retval
+
+
+
+def _finish_set_copy(obj, temp_list, objectmap):
+  # We can't just store the list object in the objectmap because it isn't
+  # a set yet. If it's possible to have a set contain a reference to
+  # itself, this could result in infinite recursion. However, sets can
+  # only contain hashable items so I believe this can't happen.
+  retval = set(temp_list)
+  objectmap[_saved_id(obj)] = retval
+  return retval
+
+
+
+def _start_frozen_copy(obj, objectmap, tasks, target, slot, finish):
+  """
+  The start function for tuples and sets, see above.
+  """
+  uncopied_types_get = _UNCOPIED_TYPES.get
+  temp_list = list(obj)
+
+  for item in temp_list:
+    itemtype = type(item)
+    if uncopied_types_get(_saved_id(itemtype)) is not itemtype:
+      break
+  else:
+    # All of the items are immutable, so it can be finished now.
+    target[slot] = finish(obj, temp_list, objectmap)
+    return
+
+  target[slot] = temp_list
+  tasks.append((target, slot, obj, finish))
+
+  for index, item in enumerate(temp_list):
+    itemtype = type(item)
+    if uncopied_types_get(_saved_id(itemtype)) is not itemtype:
+      tasks.append((temp_list, index, item, None))
+
+
+
+# Maps the id() of a container type -> (type, start function, finish
+# function), keyed as _UNCOPIED_TYPES is.
+_COPY_HANDLERS = {}
+for _copy_handler in [(list, _start_list_copy, None),
+                      (dict, _start_dict_copy, None),
+                      (tuple, _start_frozen_copy, _finish_tuple_copy),
+                      (set, _start_frozen_copy, _finish_set_copy)]:
+  _COPY_HANDLERS[_saved_id(_copy_handler[0])] = _copy_handler
+del _copy_handler
+
+
+
 def _copy(obj, objectmap=None):
   """
   <Purpose>
     Create a deep copy of an object without using the python 'copy' module.
     Using copy.deepcopy() doesn't work because builtins like id and hasattr
-    aren't available when this is called.
+    aren't available when this is called. Containers are copied using an
+    explicit list of tasks rather than recursion, so deeply nested objects
+    cannot exhaust the interpreter's recursion limit.
   <Arguments>
     obj
       The object to make a deep copy of.
@@ -775,10 +1119,11 @@ def _copy(obj, objectmap=None):
       A mapping between original objects and the corresponding copy. This is
       used to handle circular references.
   <Exceptions>
-    TypeError
-      If an object is encountered that we don't know how to make a copy of.
-    NamespaceViolationError
-      If an unexpected error occurs while copying. This isn't the greatest
+    RepyArgumentError
+      If obj contains more than MAX_COPY_SIZE items in total.
+    NamespaceInternalError
+      If an object is encountered that we don't know how to make a copy of,
+      or an unexpected error occurs while copying. This isn't the greatest
       solution, but in general the idea is we just need to abort the wrapped
       function call.
   <Side Effects>
@@ -787,100 +1132,88 @@ def _copy(obj, objectmap=None):
   <Returns>
     The deep copy of obj with circular/recursive references preserved.
   """
+  # Immutable objects are returned with a single lookup
+  objtype = type(obj)
+  if _UNCOPIED_TYPES.get(_saved_id(objtype)) is objtype:
+    return obj
+
   try:
     # If this is a top-level call to _copy, create a new objectmap for use
-    # by recursive calls to _copy.
+    # while copying this object.
     if objectmap is None:
       objectmap = {}
     # If this is a circular reference, use the copy we already made.
     elif _saved_id(obj) in objectmap:
       return objectmap[_saved_id(obj)]
 
-    # types.InstanceType is included because the user can provide an instance
-    # of a class of their own in the list of callback args to settimer.
-    if _is_in(type(obj), [str, unicode, int, long, float, complex, bool, frozenset,
-                          types.NoneType, types.FunctionType, types.LambdaType,
-                          types.MethodType, types.InstanceType]):
-      return obj
-
-    elif type(obj) is list:
-      temp_list = []
-      # Need to save this in the objectmap before recursing because lists
-      # might have circular references.
-      objectmap[_saved_id(obj)] = temp_list
-
-      for item in obj:
-        temp_list.append(_copy(item, objectmap))
-
-      return temp_list
-
-    elif type(obj) is tuple:
-      temp_list = []
-
-      for item in obj:
-        temp_list.append(_copy(item, objectmap))
-
-      # I'm not 100% confident on my reasoning here, so feel free to point
-      # out where I'm wrong: There's no way for a tuple to directly contain
-      # a circular reference to itself. Instead, it has to contain, for
-      # example, a dict which has the same tuple as a value. In that
-      # situation, we can avoid infinite recursion and properly maintain
-      # circular references in our copies by checking the objectmap right
-      # after we do the copy of each item in the tuple. The existence of the
-      # dictionary would keep the recursion from being infinite because those
-      # are properly handled. That just leaves making sure we end up with
-      # only one copy of the tuple. We do that here by checking to see if we
-      # just made a copy as a result of copying the items above. If so, we
-      # return the one that's already been made.
-      if _saved_id(obj) in objectmap:
-        return objectmap[_saved_id(obj)]
-
-      retval = tuple(temp_list)
-      objectmap[_saved_id(obj)] = retval
-      return retval
-
-    elif type(obj) is set:
-      temp_list = []
-      # We can't just store this list object in the objectmap because it isn't
-      # a set yet. If it's possible to have a set contain a reference to
-      # itself, this could result in infinite recursion. However, sets can
-      # only contain hashable items so I believe this can't happen.
-
-      for item in obj:
-        temp_list.append(_copy(item, objectmap))
-
-      retval = set(temp_list)
-      objectmap[_saved_id(obj)] = retval
-      return retval
-
-    elif type(obj) is dict:
-      temp_dict = {}
-      # Need to save this in the objectmap before recursing because dicts
-      # might have circular references.
-      objectmap[_saved_id(obj)] = temp_dict
-
-      for key, value in obj.items():
-        temp_key = _copy(key, objectmap)
-        temp_dict[temp_key] = _copy(value, objectmap)
-
-      return temp_dict
-
-    # We don't copy certain objects. This is because copying an emulated file
-    # object, for example, will cause the destructor of the original one to
-    # be invoked, which will close the actual underlying file. As the object
-    # is wrapped and the client does not have access to it, it's safe to not
-    # wrap it.
-    elif isinstance(obj, (NamespaceObjectWrapper, emulfile.emulated_file,
-                          emulcomm.EmulatedSocket, emulcomm.TCPServerSocket,
-                          emulcomm.UDPServerSocket, thread.LockType,
-                          virtual_namespace.VirtualNamespace)):
-      return obj
+    handler = _COPY_HANDLERS.get(_saved_id(objtype))
+    if handler is None or handler[0] is not objtype:
+      return _copy_uncontained(obj)
 
-    else:
-      raise TypeError("_copy is not implemented for objects of type " + str(type(obj)))
+    size = len(obj)
+    if size > MAX_COPY_SIZE:
+      raise RepyArgumentError("Cannot copy an object of more than " +
+                              str(MAX_COPY_SIZE) + " items")
+
+    # The copy of obj ends up in here.
+    holder = [None]
+    tasks = []
+    handler[1](obj, objectmap, tasks, holder, 0, handler[2])
+
+    copy_handlers_get = _COPY_HANDLERS.get
+    while tasks:
+      target, slot, item, finish = tasks.pop()
+
+      if finish is not None:
+        # The items of this tuple or set have been copied into a list.
+        target[slot] = finish(item, target[slot], objectmap)
+        continue
+
+      # If this is a circular reference, use the copy we already made.
+      if _saved_id(item) in objectmap:
+        target[slot] = objectmap[_saved_id(item)]
+        continue
+
+      itemtype = type(item)
+      handler = copy_handlers_get(_saved_id(itemtype))
+      if handler is None or handler[0] is not itemtype:
+        target[slot] = _copy_uncontained(item)
+        continue
+
+      size += len(item)
+      if size > MAX_COPY_SIZE:
+        raise RepyArgumentError("Cannot copy an object of more than " +
+                                str(MAX_COPY_SIZE) + " items")
+
+      handler[1](item, objectmap, tasks, target, slot, handler[2])
+
+    return holder[0]
+
+  except RepyArgumentError:
+    raise
 
   except Exception, e:
-    raise NamespaceInternalError("_copy failed on " + str(obj) + " with message " + str(e))
+    # Don't try to include the object itself, which may be enormous.
+    raise NamespaceInternalError("_copy failed on an object of type " +
+                                 str(objtype) + " with message " + str(e))
+
+
+
+def _copy_uncontained(obj):
+  """
+  Handles objects which _copy() does not make a copy of the contents of.
+  Returns obj if it is to be passed through as-is, otherwise raises a
+  TypeError.
+  """
+  # We don't copy certain objects. This is because copying an emulated file
+  # object, for example, will cause the destructor of the original one to
+  # be invoked, which will close the actual underlying file. As the object
+  # is wrapped and the client does not have access to it, it's safe to not
+  # wrap it.
+  if isinstance(obj, _WRAPPED_SELF_TYPES):
+    return obj
+
+  raise TypeError("_copy is not implemented for objects of type " + str(type(obj)))
 
 
 
@@ -904,6 +1237,11 @@ class NamespaceObjectWrapper(object):
   and next(). However, instances won't really be iterable unless a next()
   method is defined in the allowed_functions_dict.
   """
+  # There can be a great many of these, one for every handle the user code
+  # holds, so they have no __dict__. The last slot holds the functions that
+  # __getattr__() has returned, by name, or None until the first of them.
+  __slots__ = ["_wrapped__type_name", "_wrapped__object",
+               "_wrapped__allowed_functions_dict", "_wrapped__bound_functions"]
 
   def __init__(self, wrapped_type_name, wrapped_object, allowed_functions_dict):
     """
@@ -929,6 +1267,7 @@ class NamespaceObjectWrapper(object):
     self._wrapped__type_name = wrapped_type_name
     self._wrapped__object = wrapped_object
     self._wrapped__allowed_functions_dict = allowed_functions_dict
+    self._wrapped__bound_functions = None
 
 
 
@@ -938,13 +1277,27 @@ class NamespaceObjectWrapper(object):
     allowed_functions_dict that was provided to the constructor. If there
     is such a method in there, we return a function that will properly
     invoke the method with the correct 'self' as the first argument.
+    The function is made the first time and reused after that, as methods
+    of sockets, files and locks are called over and over.
     """
+    bound_functions = self._wrapped__bound_functions
+    if bound_functions is not None and name in bound_functions:
+      return bound_functions[name]
+
     if name in self._wrapped__allowed_functions_dict:
       wrapped_func = self._wrapped__allowed_functions_dict[name]
+      # The function refers to the wrapped object rather than to self, so
+      # keeping it here doesn't make a reference cycle. Otherwise the
+      # wrapper, and with it a socket, would only be freed by the garbage
+      # collector.
+      wrapped_object = self._wrapped__object
 
       def __do_func_call(*args, **kwargs):
-        return wrapped_func(self._wrapped__object, *args, **kwargs)
+        return wrapped_func(wrapped_object, *args, **kwargs)
 
+      if bound_functions is None:
+        bound_functions = self._wrapped__bound_functions = {}
+      bound_functions[name] = __do_func_call
       return __do_func_call
 
     else:
@@ -1011,6 +1364,433 @@ class NamespaceObjectWrapper(object):
 
 
 
+def _compile_args_processor(func_name, arg_types):
+  """
+  <Purpose>
+    Builds the function that checks, copies and unwraps the arguments of a
+    wrapped function. The processors are looked at once, here, rather
+    than on every call, and functions taking up to three arguments get a
+    version without a loop.
+  <Arguments>
+    func_name
+      The name of the wrapped function, for error messages.
+    arg_types
+      The list of processors of the arguments, as in the 'args' of the
+      wrapper info.
+  <Exceptions>
+    NamespaceInternalError
+      If one of the processors is of an unknown kind.
+  <Side Effects>
+    None
+  <Returns>
+    A function taking the tuple of arguments and returning a list of the
+    processed arguments. It raises RepyArgumentError if the arguments are
+    not allowed.
+  """
+  # Each step is the (convert, check) pair of bound methods of a processor.
+  # We only copy simple types, which means we only copy ValueProcessor not
+  # ObjectProcessor arguments.
+  steps = []
+  for arg_type in arg_types:
+    if isinstance(arg_type, ValueProcessor):
+      steps.append((arg_type.copy, arg_type.check))
+    elif isinstance(arg_type, ObjectProcessor):
+      steps.append((arg_type.unwrap, arg_type.check))
+    else:
+      raise NamespaceInternalError("Unknown argument expectation.")
+
+  count = len(steps)
+
+  def raise_wrong_count(args):
+    raise RepyArgumentError("Function '" + func_name + 
+        "' takes " + str(count) + " arguments, not " + 
+        str(len(args)) + " as you provided.")
+
+  # Armon: If there are more arguments than there are type specifications
+  # and we are using NonCopiedVarArgs, then check against that. Any number
+  # of arguments is allowed then.
+  if count and isinstance(arg_types[-1], NonCopiedVarArgs):
+    last_index = count - 1
+
+    def process_varargs(args):
+      args_to_return = []
+      for index in range(len(args)):
+        (convert, check) = steps[min(index, last_index)]
+        temparg = convert(args[index])
+        check(temparg)
+        args_to_return.append(temparg)
+      return args_to_return
+
+    return process_varargs
+
+  if count == 0:
+    def process_none(args):
+      if args:
+        raise_wrong_count(args)
+      return []
+    return process_none
+
+  if count == 1:
+    ((convert0, check0),) = steps
+
+    def process_one(args):
+      if len(args) != 1:
+        raise_wrong_count(args)
+      arg0 = convert0(args[0])
+      check0(arg0)
+      return [arg0]
+    return process_one
+
+  if count == 2:
+    ((convert0, check0), (convert1, check1)) = steps
+
+    def process_two(args):
+      if len(args) != 2:
+        raise_wrong_count(args)
+      arg0 = convert0(args[0])
+      check0(arg0)
+      arg1 = convert1(args[1])
+      check1(arg1)
+      return [arg0, arg1]
+    return process_two
+
+  if count == 3:
+    ((convert0, check0), (convert1, check1), (convert2, check2)) = steps
+
+    def process_three(args):
+      if len(args) != 3:
+        raise_wrong_count(args)
+      arg0 = convert0(args[0])
+      check0(arg0)
+      arg1 = convert1(args[1])
+      check1(arg1)
+      arg2 = convert2(args[2])
+      check2(arg2)
+      return [arg0, arg1, arg2]
+    return process_three
+
+  def process_many(args):
+    if len(args) != count:
+      raise_wrong_count(args)
+    args_to_return = []
+    for index in range(count):
+      (convert, check) = steps[index]
+      temparg = convert(args[index])
+      check(temparg)
+      args_to_return.append(temparg)
+    return args_to_return
+  return process_many
+
+
+
+
+
+def _compile_retval_processor(processor):
+  """
+  <Purpose>
+    Builds the function that checks and copies or wraps a single return
+    value, as _compile_args_processor() does for arguments.
+  <Arguments>
+    processor
+      The processor of the return value, or None if the function must
+      return None.
+  <Exceptions>
+    None
+  <Side Effects>
+    None
+  <Returns>
+    A function taking the return value and returning the processed value.
+    It raises InternalRepyError if the value is not allowed.
+  """
+  if isinstance(processor, ValueProcessor):
+    copy = processor.copy
+    check = processor.check
+
+    def process_value(retval):
+      tempretval = copy(retval)
+      check(tempretval)
+      return tempretval
+    process = process_value
+
+  elif isinstance(processor, ObjectProcessor):
+    check = processor.check
+    wrap = processor.wrap
+
+    def process_object(retval):
+      check(retval)
+      return wrap(retval)
+    process = process_object
+
+  elif processor is None:
+    def process_none(retval):
+      if retval is not None:
+        raise InternalRepyError("Expected None but wasn't.")
+      return None
+    return process_none
+
+  else:
+    def process_unknown(retval):
+      raise InternalRepyError("Unknown retval expectation.")
+    return process_unknown
+
+  def process_checked(retval):
+    try:
+      return process(retval)
+    except RepyArgumentError, err:
+      raise InternalRepyError("Invalid retval type: %s" % err)
+  return process_checked
+
+
+
+
+
+# The types of object that may be passed as the 'self' argument of a wrapped
+# method.
+_WRAPPED_SELF_TYPES = (NamespaceObjectWrapper, emulfile.emulated_file,
+                       emulcomm.EmulatedSocket, emulcomm.TCPServerSocket,
+                       emulcomm.UDPServerSocket, thread.LockType,
+                       virtual_namespace.VirtualNamespace)
+
+
+
+
+
+# Profiling of the calls made through NamespaceAPIFunctionWrapper. This is
+# off until enable_call_profiling() is called, or the namespace is
+# initialized with CALL_PROFILE_ENVIRONMENT_VARIABLE set. Every call of a
+# wrapped function is then counted, along with the RepyExceptions it
+# raises, and one in every _call_profile_interval calls is timed, split
+# into the time spent checking arguments and return values and the time
+# spent in the function itself. The counters are not locked, so calls made
+# at the same moment by different threads can occasionally be missed.
+
+# The default for how many calls there are per timed call
+CALL_PROFILE_SAMPLE_INTERVAL = 100
+
+# The default for how many seconds there are between reports. Besides
+# these, a report is written when the program exits normally, through
+# exitall() or on an internal error. Other ways of ending the program,
+# such as being killed by the nodemanager, skip that, so the last
+# periodic report is all there is.
+CALL_PROFILE_REPORT_INTERVAL = 60
+
+# Setting this environment variable turns on profiling when the namespace
+# is initialized. Its value is the file the report is written to, or empty
+# for sys.stderr.
+CALL_PROFILE_ENVIRONMENT_VARIABLE = "REPY_CALL_PROFILE"
+
+# How many calls there are per timed call, or 0 if profiling is off
+_call_profile_interval = 0
+
+# Where the report is written, or None for sys.stderr, which is the vessel
+# log when running under the nodemanager
+_call_profile_filename = None
+
+# Maps the name of a wrapped function -> _CallProfile
+_call_profiles = {}
+_call_profiles_lock = thread.allocate_lock()
+
+
+
+class _CallProfile(object):
+  """
+  The counters of one wrapped function. Times are in seconds and only cover
+  the timed calls.
+  """
+  __slots__ = ["name", "calls", "timed_calls", "exceptions", "check_time",
+               "function_time"]
+
+  def __init__(self, name):
+    self.name = name
+    self.calls = 0
+    self.timed_calls = 0
+    self.exceptions = 0
+    self.check_time = 0.0
+    self.function_time = 0.0
+
+
+  def snapshot(self):
+    """
+    Returns the counters as a dict, with the times of the timed calls
+    scaled up to estimate the totals of all of the calls.
+    """
+    if self.timed_calls:
+      scale = float(self.calls) / self.timed_calls
+    else:
+      scale = 0.0
+    return {"name" : self.name,
+            "calls" : self.calls,
+            "timed_calls" : self.timed_calls,
+            "exceptions" : self.exceptions,
+            "check_time" : self.check_time * scale,
+            "function_time" : self.function_time * scale}
+
+
+
+def _get_call_profile(name):
+  """
+  Returns the _CallProfile of the wrapped function with the given name,
+  creating it if there isn't one yet. Functions that are wrapped more than
+  once, such as for each VirtualNamespace, share one.
+  """
+  _call_profiles_lock.acquire()
+  try:
+    if name not in _call_profiles:
+      _call_profiles[name] = _CallProfile(name)
+    return _call_profiles[name]
+  finally:
+    _call_profiles_lock.release()
+
+
+
+def enable_call_profiling(sample_interval=CALL_PROFILE_SAMPLE_INTERVAL, filename=None,
+                          report_interval=CALL_PROFILE_REPORT_INTERVAL):
+  """
+  <Purpose>
+    Starts profiling the calls made by user code to wrapped functions. This
+    is only meant for the trusted side, it is not exported to user code.
+  <Arguments>
+    sample_interval
+      How many calls there are per call that is timed. 1 times every call.
+    filename
+      The file the report is written to, or None to write it to sys.stderr.
+    report_interval
+      How many seconds there are between reports, or None to only write
+      the report when the program exits.
+  <Exceptions>
+    ValueError
+      If sample_interval is less than 1.
+  <Side Effects>
+    Calls of wrapped functions are slightly slower. The first call starts a
+    daemon thread which writes the report every report_interval seconds.
+    The report is also written when the interpreter exits normally, when
+    user code calls exitall() and on an internal error.
+  <Returns>
+    None
+  """
+  global _call_profile_interval
+  global _call_profile_filename
+
+  if sample_interval < 1:
+    raise ValueError("The sample interval must be at least 1, not " + str(sample_interval))
+
+  _call_profile_filename = filename
+  if _call_profile_interval:
+    _call_profile_interval = sample_interval
+    return
+
+  _call_profile_interval = sample_interval
+  atexit.register(write_call_profile_report)
+
+  if report_interval:
+    reporter = threading.Thread(target=_call_profile_report_loop, args=(report_interval,),
+                                name="CallProfileReport")
+    reporter.setDaemon(True)
+    reporter.start()
+
+
+
+def _call_profile_report_loop(interval):
+  # Writes the report every interval seconds, so there is one even if the
+  # program is killed
+  while True:
+    time.sleep(interval)
+    write_call_profile_report()
+
+
+
+def _enable_call_profiling_from_environment():
+  # Turns on profiling if CALL_PROFILE_ENVIRONMENT_VARIABLE is set
+  filename = os.environ.get(CALL_PROFILE_ENVIRONMENT_VARIABLE)
+  if filename is None:
+    return
+  if not filename:
+    filename = None
+  enable_call_profiling(filename=filename)
+
+
+
+def get_call_profile():
+  """
+  <Purpose>
+    Returns the counters of every wrapped function that has been called
+    since profiling was enabled. This is only meant for the trusted side, it
+    is not exported to user code.
+  <Arguments>
+    None
+  <Exceptions>
+    None
+  <Side Effects>
+    None
+  <Returns>
+    A list of dicts, see _CallProfile.snapshot(), with the function that
+    took the most time first.
+  """
+  _call_profiles_lock.acquire()
+  try:
+    profiles = _call_profiles.values()
+  finally:
+    _call_profiles_lock.release()
+
+  snapshots = [profile.snapshot() for profile in profiles if profile.calls]
+  snapshots.sort(key=lambda snapshot: snapshot["check_time"] + snapshot["function_time"],
+                 reverse=True)
+  return snapshots
+
+
+
+def _format_call_profile(snapshot):
+  # Returns a one line summary of a call profile snapshot
+  calls = snapshot["calls"]
+  if calls:
+    check_per_call = snapshot["check_time"] / calls * 1000000
+    function_per_call = snapshot["function_time"] / calls * 1000000
+  else:
+    check_per_call = function_per_call = 0.0
+  return ("%s calls=%d timed=%d exceptions=%d checks=%.3fs (%.1fus/call) "
+          "function=%.3fs (%.1fus/call)") % (
+      snapshot["name"], calls, snapshot["timed_calls"], snapshot["exceptions"],
+      snapshot["check_time"], check_per_call,
+      snapshot["function_time"], function_per_call)
+
+
+
+def write_call_profile_report():
+  """
+  <Purpose>
+    Writes the call profile to the file given to enable_call_profiling(), or
+    to sys.stderr, one line per wrapped function.
+  <Arguments>
+    None
+  <Exceptions>
+    None. Failing to write the report is ignored, as this runs on exit.
+  <Side Effects>
+    Writes to a file or sys.stderr.
+  <Returns>
+    None
+  """
+  try:
+    lines = ["[call profile] " + _format_call_profile(snapshot) + "\n"
+             for snapshot in get_call_profile()]
+
+    if _call_profile_filename is None:
+      sys.stderr.writelines(lines)
+      sys.stderr.flush()
+    else:
+      reportfile = open(_call_profile_filename, "w")
+      try:
+        reportfile.writelines(lines)
+      finally:
+        reportfile.close()
+
+  except Exception:
+    # Never let a problem with the report get in the way of exiting
+    pass
+
+
+
+
+
 class NamespaceAPIFunctionWrapper(object):
   """
   Instances of this class exist solely to provide function wrapping. This is
@@ -1019,7 +1799,7 @@ class NamespaceAPIFunctionWrapper(object):
   to call the wrapped version of the function.
   """
 
-  def __init__(self, func_dict, is_method=False):
+  def __init__(self, func_dict, is_method=False, profile_name=None):
     """
     <Purpose>
       Constructor.
@@ -1034,6 +1814,8 @@ class NamespaceAPIFunctionWrapper(object):
           return (required)
       is_method -- if this is an object's method being wrapped
             rather than a regular function.
+      profile_name -- the name the function has in the call profile, if
+            not the name of the function.
     <Exceptions>
       None
     <Side Effects>
@@ -1061,54 +1843,39 @@ class NamespaceAPIFunctionWrapper(object):
     else:
       self.__func_name = self.__func.__name__
 
+    # Work out how to process the arguments and return values now, so that
+    # calls don't have to.
+    self.__process_args = _compile_args_processor(self.__func_name, self.__args)
 
+    self.__process_retval_item = _compile_retval_processor(self.__return)
+    if type(self.__return) is tuple:
+      self.__process_retval_items = tuple(
+          [_compile_retval_processor(processor) for processor in self.__return])
+    else:
+      self.__process_retval_items = None
 
-  def _process_args(self, args):
-    args_to_return = []
-
-    for index in range(len(args)):
-      # Armon: If there are more arguments than there are type specifications
-      # and we are using NonCopiedVarArgs, then check against that.
-      if index >= len(self.__args) and isinstance(self.__args[-1], NonCopiedVarArgs):
-        arg_type = self.__args[-1]
-      else:
-        arg_type = self.__args[index]
-
-      # We only copy simple types, which means we only copy ValueProcessor not
-      # ObjectProcessor arguments.
-      if isinstance(arg_type, ValueProcessor):
-        temparg = arg_type.copy(args[index])
-      elif isinstance(arg_type, ObjectProcessor):
-        temparg = arg_type.unwrap(args[index])
-      else:
-        raise NamespaceInternalError("Unknown argument expectation.")
-
-      arg_type.check(temparg)
+    if profile_name is None:
+      profile_name = self.__func_name
+    self.__profile = _get_call_profile(profile_name)
 
-      args_to_return.append(temparg)
-
-    return args_to_return
 
 
+  def __finish_profiled_call(self, starttime, func_to_call, args_to_use):
+    """
+    Does the rest of a call that is being timed, once the arguments have
+    been checked, and adds the times to the call profile.
+    """
+    calltime = time.time()
+    retval = func_to_call(*args_to_use)
+    returntime = time.time()
+    retval = self._process_retval(retval)
+    endtime = time.time()
 
-  def _process_retval_helper(self, processor, retval):
-    try:
-      if isinstance(processor, ValueProcessor):
-        tempretval = processor.copy(retval)
-        processor.check(tempretval)
-      elif isinstance(processor, ObjectProcessor):
-        processor.check(retval)
-        tempretval = processor.wrap(retval)
-      elif processor is None:
-        if retval is not None:
-          raise InternalRepyError("Expected None but wasn't.")
-        tempretval = None
-      else:
-        raise InternalRepyError("Unknown retval expectation.")
-      return tempretval
-
-    except RepyArgumentError, err:
-      raise InternalRepyError("Invalid retval type: %s" % err)
+    profile = self.__profile
+    profile.timed_calls += 1
+    profile.check_time += (calltime - starttime) + (endtime - returntime)
+    profile.function_time += returntime - calltime
+    return retval
 
 
 
@@ -1117,15 +1884,15 @@ class NamespaceAPIFunctionWrapper(object):
     try:
       # Allow the return value to be a tuple of processors.
       if type(retval) is tuple:
-        if len(retval) != len(self.__return):
+        process_items = self.__process_retval_items
+        if process_items is None or len(retval) != len(process_items):
           raise InternalRepyError("Returned tuple of wrong size: %s" % str(retval))
         tempretval = []
         for index in range(len(retval)):
-          tempitem = self._process_retval_helper(self.__return[index], retval[index])
-          tempretval.append(tempitem)
+          tempretval.append(process_items[index](retval[index]))
         tempretval = tuple(tempretval)
       else:
-        tempretval = self._process_retval_helper(self.__return, retval)
+        tempretval = self.__process_retval_item(retval)
 
     except Exception, e:
       raise InternalRepyError(
@@ -1157,7 +1924,16 @@ class NamespaceAPIFunctionWrapper(object):
     <Returns>
       Anything that the underlying function may return.
     """
+    # The time this call started, if it is being timed for the call profile
+    starttime = None
+
     try:
+      if _call_profile_interval:
+        profile = self.__profile
+        profile.calls += 1
+        if profile.calls % _call_profile_interval == 0:
+          starttime = time.time()
+
       # We don't allow keyword args.
       if kwargs:
         raise RepyArgumentError("Keyword arguments not allowed when calling %s." %
@@ -1172,13 +1948,8 @@ class NamespaceAPIFunctionWrapper(object):
       else:
         args_to_check = args
 
-      if len(args_to_check) != len(self.__args):
-        if not self.__args or not isinstance(self.__args[-1:][0], NonCopiedVarArgs):
-          raise RepyArgumentError("Function '" + self.__func_name + 
-              "' takes " + str(len(self.__args)) + " arguments, not " + 
-              str(len(args_to_check)) + " as you provided.")
-
-      args_copy = self._process_args(args_to_check)
+      # This checks the number of arguments too
+      args_copy = self.__process_args(args_to_check)
 
       args_to_use = None
 
@@ -1193,10 +1964,7 @@ class NamespaceAPIFunctionWrapper(object):
         func_to_call = self.__func
         if self.__is_method:
           # Sanity check the object we're adding back in as the "self" argument.
-          if not isinstance(args[0], (NamespaceObjectWrapper, emulfile.emulated_file,
-                                      emulcomm.EmulatedSocket, emulcomm.TCPServerSocket,
-                                      emulcomm.UDPServerSocket, thread.LockType,
-                                      virtual_namespace.VirtualNamespace)):
+          if not isinstance(args[0], _WRAPPED_SELF_TYPES):
             raise NamespaceInternalError("Wrong type for 'self' argument.")
           # If it's a method but the function was not provided as a string, we
           # actually do have to add the first argument back in. Yes, this whole
@@ -1205,11 +1973,16 @@ class NamespaceAPIFunctionWrapper(object):
         else:
           args_to_use = args_copy
       
+      if starttime is not None:
+        return self.__finish_profiled_call(starttime, func_to_call, args_to_use)
+
       retval = func_to_call(*args_to_use)
 
       return self._process_retval(retval)
 
     except RepyException:
+      if _call_profile_interval:
+        self.__profile.exceptions += 1
       # TODO: this should be changed to RepyError along with all references to
       # RepyException in the rest of the repy code.
       # We allow any RepyError to continue up to the client code.